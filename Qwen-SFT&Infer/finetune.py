@@ -1,21 +1,33 @@
 # This code is based on the revised code from fastchat based on tatsu-lab/stanford_alpaca.
 
 from dataclasses import dataclass, field
-import json
+from functools import partial
 import math
 import logging
 import os
+import random
 from typing import Dict, Optional, List
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
 from deepspeed import zero
 from deepspeed.runtime.zero.partition_parameters import ZeroParamStatus
 import transformers
 from transformers import Trainer, GPTQConfig, deepspeed
-from transformers.trainer_pt_utils import LabelSmoother
+from transformers.trainer_pt_utils import LabelSmoother, LengthGroupedSampler
 from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
 from accelerate.utils import DistributedType
 
+import sys
+sys.path.append('..')
+from shards import is_shard_path, ShardReader
+from data_mixer import DataMixer
+from json_io import read_json, open_text, loads, shuffle_buffer
+from token_cache import tokenize_conversations, is_token_cache, MemmapSupervisedDataset
+from packing import pack_dataset, PackedAttention
+from vit_cache import install_shard_images, install_vit_cache
+from sample_cache import LRUSampleCache, SharedSampleCache
+from prefix_cache import PrefixTokenCache, episode_id
+
 IGNORE_TOKEN_ID = LabelSmoother.ignore_index
 
 
@@ -27,12 +39,39 @@ class ModelArguments:
 @dataclass
 class DataArguments:
     data_path: str = field(
-        default=None, metadata={"help": "Path to the training data."}
+        default=None, metadata={"help": "Path to the training data, or a token cache dir written by token_cache.py."}
     )
     eval_data_path: str = field(
         default=None, metadata={"help": "Path to the evaluation data."}
     )
     lazy_preprocess: bool = False
+    prefix_cache: bool = field(
+        default=False, metadata={"help": "Without lazy_preprocess, only tokenize the new lines of consecutive steps of an episode."}
+    )
+    lazy_cache_mb: int = field(
+        default=1024, metadata={"help": "Size of the tokenized sample cache in lazy mode, per DataLoader worker unless shared. 0 disables it."}
+    )
+    lazy_cache_shared: bool = field(
+        default=False, metadata={"help": "One lazy_cache_mb cache in shared memory (/dev/shm) for all DataLoader workers of a rank."}
+    )
+    data_mixture: Optional[str] = field(
+        default=None, metadata={"help": "Mixture spec (JSON) for data_mixer.DataMixer, replaces data_path. Requires --max_steps."}
+    )
+    streaming: bool = field(
+        default=False, metadata={"help": "Stream data_path (a JSONL shard dir from merge_data.py or a .jsonl file), tokenized on the fly. Requires --max_steps."}
+    )
+    shuffle_buffer: int = field(
+        default=10000, metadata={"help": "Shuffle buffer of each DataLoader worker in streaming mode."}
+    )
+    stream_start_sample: int = field(
+        default=0, metadata={"help": "Streaming mode: samples already trained on (global_step * per_device_train_batch_size * gradient_accumulation_steps * world_size), skipped without tokenizing. Not with --resume_from_checkpoint, which skips the trained batches itself (unless --ignore_data_skip)."}
+    )
+    vit_cache: Optional[str] = field(
+        default=None, metadata={"help": "Dir written by vit_cache.py, the vision tower reads the resized screenshots from it."}
+    )
+    packing: Optional[str] = field(
+        default=None, metadata={"help": "Pack the training samples into model_max_length bins: greedy or ffd (first-fit decreasing)."}
+    )
 
 
 @dataclass
@@ -126,40 +165,8 @@ def preprocess(
     max_len: int,
     system_message: str = "You are a helpful assistant."
 ) -> Dict:
-    roles = {"user": "<|im_start|>user", "assistant": "<|im_start|>assistant"}
-
-    im_start = tokenizer.im_start_id
-    im_end = tokenizer.im_end_id
-    nl_tokens = tokenizer('\n').input_ids
-    _system = tokenizer('system').input_ids + nl_tokens
-    _user = tokenizer('user').input_ids + nl_tokens
-    _assistant = tokenizer('assistant').input_ids + nl_tokens
-
-    # Apply prompt templates
     input_ids, targets = [], []
-    for i, source in enumerate(sources):
-        if roles[source[0]["from"]] != roles["user"]:
-            source = source[1:]
-
-        input_id, target = [], []
-        system = [im_start] + _system + tokenizer(system_message).input_ids + [im_end] + nl_tokens
-        input_id += system
-        target += [im_start] + [IGNORE_TOKEN_ID] * (len(system)-3) + [im_end] + nl_tokens
-        assert len(input_id) == len(target)
-        for j, sentence in enumerate(source):
-            role = roles[sentence["from"]]
-            _input_id = tokenizer(role).input_ids + nl_tokens + \
-                tokenizer(sentence["value"]).input_ids + [im_end] + nl_tokens
-            input_id += _input_id
-            if role == '<|im_start|>user':
-                _target = [im_start] + [IGNORE_TOKEN_ID] * (len(_input_id)-3) + [im_end] + nl_tokens
-            elif role == '<|im_start|>assistant':
-                _target = [im_start] + [IGNORE_TOKEN_ID] * len(tokenizer(role).input_ids) + \
-                    _input_id[len(tokenizer(role).input_ids)+1:-2] + [im_end] + nl_tokens
-            else:
-                raise NotImplementedError
-            target += _target
-        assert len(input_id) == len(target)
+    for input_id, target in tokenize_conversations(sources, tokenizer, system_message):
         input_id += [tokenizer.pad_token_id] * (max_len - len(input_id))
         target += [IGNORE_TOKEN_ID] * (max_len - len(target))
         input_ids.append(input_id[:max_len])
@@ -174,19 +181,82 @@ def preprocess(
     )
 
 
+def tokenize_samples(
+    sources,
+    tokenizer: transformers.PreTrainedTokenizer,
+    max_len: int,
+    prefix_cache: PrefixTokenCache = None,
+    episode_ids=None,
+) -> List[Dict]:
+    """Unpadded input_ids/labels of conversations, truncated to max_len."""
+    return [
+        dict(
+            input_ids=torch.tensor(input_id[:max_len], dtype=torch.int),
+            labels=torch.tensor(target[:max_len], dtype=torch.int),
+        )
+        for input_id, target in tokenize_conversations(sources, tokenizer, prefix_cache=prefix_cache, episode_ids=episode_ids)
+    ]
+
+
+def tokenize_sample(
+    source,
+    tokenizer: transformers.PreTrainedTokenizer,
+    max_len: int,
+) -> Dict:
+    return tokenize_samples([source], tokenizer, max_len)[0]
+
+
+@dataclass
+class DataCollatorForSupervisedDataset:
+    """Pads a batch of unpadded (or packed) samples to its longest sequence."""
+
+    pad_token_id: int
+
+    def __call__(self, instances) -> Dict[str, torch.Tensor]:
+        max_len = max(len(instance["input_ids"]) for instance in instances)
+        input_ids = torch.full((len(instances), max_len), self.pad_token_id, dtype=torch.int)
+        labels = torch.full((len(instances), max_len), IGNORE_TOKEN_ID, dtype=torch.int)
+        for i, instance in enumerate(instances):
+            length = len(instance["input_ids"])
+            input_ids[i, :length] = instance["input_ids"]
+            labels[i, :length] = instance["labels"]
+        batch = dict(
+            input_ids=input_ids,
+            labels=labels,
+            attention_mask=input_ids.ne(self.pad_token_id),
+        )
+        if "position_ids" in instances[0]:
+            # packed bins: per-sample positions and the sample of each token, -1 for the padding
+            position_ids = torch.zeros((len(instances), max_len), dtype=torch.long)
+            seq_ids = torch.full((len(instances), max_len), -1, dtype=torch.long)
+            for i, instance in enumerate(instances):
+                position_ids[i, :len(instance["position_ids"])] = instance["position_ids"]
+                seq_ids[i, :len(instance["seq_ids"])] = instance["seq_ids"]
+            batch["position_ids"] = position_ids
+            batch["seq_ids"] = seq_ids
+        return batch
+
+
 class SupervisedDataset(Dataset):
     """Dataset for supervised fine-tuning."""
 
-    def __init__(self, raw_data, tokenizer: transformers.PreTrainedTokenizer, max_len: int):
+    def __init__(self, raw_data, tokenizer: transformers.PreTrainedTokenizer, max_len: int, prefix_cache: bool = False):
         super(SupervisedDataset, self).__init__()
 
         rank0_print("Formatting inputs...")
-        sources = [example["conversations"] for example in raw_data]
-        data_dict = preprocess(sources, tokenizer, max_len)
-
-        self.input_ids = data_dict["input_ids"]
-        self.labels = data_dict["labels"]
-        self.attention_mask = data_dict["attention_mask"]
+        cache = PrefixTokenCache(tokenizer) if prefix_cache else None
+        samples = []
+        for start in range(0, len(raw_data), 1024):
+            chunk = raw_data[start:start + 1024]
+            sources = [example["conversations"] for example in chunk]
+            episode_ids = [episode_id(example) for example in chunk]
+            samples += tokenize_samples(sources, tokenizer, max_len, prefix_cache=cache, episode_ids=episode_ids)
+        if cache is not None and cache.total_chars > 0:
+            rank0_print(f"The prefix cache reused {cache.reused_chars / cache.total_chars:.1%} of the prompt characters")
+
+        self.input_ids = [sample["input_ids"] for sample in samples]
+        self.labels = [sample["labels"] for sample in samples]
+        self.lengths = [len(input_ids) for input_ids in self.input_ids]
 
     def __len__(self):
         return len(self.input_ids)
@@ -195,14 +265,20 @@ class SupervisedDataset(Dataset):
         return dict(
             input_ids=self.input_ids[i],
             labels=self.labels[i],
-            attention_mask=self.attention_mask[i],
         )
 
 
 class LazySupervisedDataset(Dataset):
     """Dataset for supervised fine-tuning."""
 
-    def __init__(self, raw_data, tokenizer: transformers.PreTrainedTokenizer, max_len: int):
+    def __init__(
+        self,
+        raw_data,
+        tokenizer: transformers.PreTrainedTokenizer,
+        max_len: int,
+        cache_mb: int = 1024,
+        shared_cache: bool = False,
+    ):
         super(LazySupervisedDataset, self).__init__()
         self.tokenizer = tokenizer
         self.max_len = max_len
@@ -210,45 +286,246 @@ class LazySupervisedDataset(Dataset):
         rank0_print("Formatting inputs...Skip in lazy mode")
         self.tokenizer = tokenizer
         self.raw_data = raw_data
-        self.cached_data_dict = {}
+        if cache_mb <= 0:
+            self.cache = None
+        elif shared_cache:
+            self.cache = SharedSampleCache(cache_mb << 20, slot_tokens=max_len)
+        else:
+            self.cache = LRUSampleCache(cache_mb << 20)
+        self._lengths = None
 
     def __len__(self):
         return len(self.raw_data)
 
+    @property
+    def lengths(self):
+        # estimated from the characters, only used to group similar lengths
+        if self._lengths is None:
+            self._lengths = [
+                sum(len(sentence["value"]) for sentence in example["conversations"])
+                for example in self.raw_data
+            ]
+        return self._lengths
+
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
-        if i in self.cached_data_dict:
-            return self.cached_data_dict[i]
-
-        ret = preprocess([self.raw_data[i]["conversations"]], self.tokenizer, self.max_len)
-        ret = dict(
-            input_ids=ret["input_ids"][0],
-            labels=ret["labels"][0],
-            attention_mask=ret["attention_mask"][0],
-        )
-        self.cached_data_dict[i] = ret
+        if self.cache is not None:
+            ret = self.cache.get(i)
+            if ret is not None:
+                return ret
+
+        ret = tokenize_sample(self.raw_data[i]["conversations"], self.tokenizer, self.max_len)
+        if self.cache is not None:
+            self.cache.put(i, ret)
 
         return ret
 
 
+class MixedSupervisedDataset(IterableDataset):
+    """Streams a DataMixer, tokenized on the fly."""
+
+    def __init__(self, mixer: DataMixer, tokenizer: transformers.PreTrainedTokenizer, max_len: int):
+        super(MixedSupervisedDataset, self).__init__()
+        self.mixer = mixer
+        self.tokenizer = tokenizer
+        self.max_len = max_len
+
+    def __iter__(self):
+        # every DataLoader worker takes its own share of the mixed stream
+        worker_info = get_worker_info()
+        shard_id, num_shards = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        for record in self.mixer.iter_records(shard_id, num_shards):
+            yield tokenize_sample(record["conversations"], self.tokenizer, self.max_len)
+
+
+class StreamingSupervisedDataset(IterableDataset):
+    """Streams JSONL shards (a merge_data.py output dir or a .jsonl file), tokenized on the fly.
+
+    Every (rank, DataLoader worker) reads its own shards, or every n-th line
+    when there are fewer shards than readers, through a seeded shuffle buffer
+    of raw lines, epoch after epoch. `start_sample` (global) skips the samples
+    the run has already seen without tokenizing them, each worker resumes its
+    own stream (the workers may take turns in another order than before).
+    """
+
+    def __init__(
+        self,
+        data_path,
+        tokenizer: transformers.PreTrainedTokenizer,
+        max_len: int,
+        batch_size: int = 1,
+        seed: int = 0,
+        shuffle_buffer: int = 10000,
+        start_sample: int = 0,
+    ):
+        super(StreamingSupervisedDataset, self).__init__()
+        if os.path.isdir(data_path):
+            index = read_json(os.path.join(data_path, "index.json"))
+            self.shards = [os.path.join(data_path, shard["path"]) for shard in index["shards"]]
+        else:
+            self.shards = [data_path]
+        self.tokenizer = tokenizer
+        self.max_len = max_len
+        self.batch_size = batch_size
+        self.seed = seed
+        self.shuffle_buffer = shuffle_buffer
+        self.start_sample = start_sample
+
+    def _iter_lines(self, epoch, reader, num_readers):
+        # the same shard order on all readers
+        shards = list(self.shards)
+        random.Random(self.seed + epoch).shuffle(shards)
+        if len(shards) >= num_readers:
+            shards, stride, offset = shards[reader::num_readers], 1, 0
+        else:
+            stride, offset = num_readers, reader
+        i = 0
+        for path in shards:
+            with open_text(path, "r") as f:
+                for line in f:
+                    if line.strip() == "":
+                        continue
+                    if i % stride == offset:
+                        yield line
+                    i += 1
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        rank, world_size = int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+        reader, num_readers = rank * num_workers + worker_id, world_size * num_workers
+
+        # the DataLoader takes the batches of the rank from its workers in turn
+        rank_batches = self.start_sample // world_size // self.batch_size
+        skip = len(range(worker_id, rank_batches, num_workers)) * self.batch_size
+
+        rng = random.Random(f"{self.seed}-{reader}")
+        epoch = 0
+        while True:
+            num_lines = 0
+            for line in shuffle_buffer(self._iter_lines(epoch, reader, num_readers), self.shuffle_buffer, rng):
+                num_lines += 1
+                if skip > 0:
+                    skip -= 1
+                    continue
+                yield tokenize_sample(loads(line)["conversations"], self.tokenizer, self.max_len)
+            if num_lines == 0:
+                raise ValueError(f"no samples for reader {reader} of {num_readers}, write more shards")
+            epoch += 1
+
+
 def make_supervised_data_module(
-    tokenizer: transformers.PreTrainedTokenizer, data_args, max_len,
+    tokenizer: transformers.PreTrainedTokenizer, data_args, max_len, batch_size=1, seed=0,
 ) -> Dict:
     """Make dataset and collator for supervised fine-tuning."""
     dataset_cls = (
-        LazySupervisedDataset if data_args.lazy_preprocess else SupervisedDataset
+        partial(LazySupervisedDataset, cache_mb=data_args.lazy_cache_mb, shared_cache=data_args.lazy_cache_shared)
+        if data_args.lazy_preprocess else partial(SupervisedDataset, prefix_cache=data_args.prefix_cache)
     )
     rank0_print("Loading data...")
 
-    train_json = json.load(open(data_args.data_path, "r"))
-    train_dataset = dataset_cls(train_json, tokenizer=tokenizer, max_len=max_len)
+    if data_args.data_mixture:
+        # sources are read and mixed lazily, nothing is materialized
+        train_dataset = MixedSupervisedDataset(DataMixer.from_file(data_args.data_mixture), tokenizer=tokenizer, max_len=max_len)
+    elif data_args.streaming:
+        # only the shuffle buffer is held in memory
+        train_dataset = StreamingSupervisedDataset(
+            data_args.data_path,
+            tokenizer=tokenizer,
+            max_len=max_len,
+            batch_size=batch_size,
+            seed=seed,
+            shuffle_buffer=data_args.shuffle_buffer,
+            start_sample=data_args.stream_start_sample,
+        )
+    elif is_token_cache(data_args.data_path):
+        # tokenized offline, memory-mapped and shared by all ranks
+        train_dataset = MemmapSupervisedDataset(data_args.data_path, tokenizer=tokenizer, max_len=max_len)
+    else:
+        if is_shard_path(data_args.data_path):
+            # records and images are read from the tar files on demand
+            train_json = ShardReader(data_args.data_path)
+        else:
+            train_json = read_json(data_args.data_path)
+        train_dataset = dataset_cls(train_json, tokenizer=tokenizer, max_len=max_len)
+
+    if data_args.packing:
+        if isinstance(train_dataset, LazySupervisedDataset):
+            raise ValueError("packing needs the token lengths, use a token cache or --lazy_preprocess False")
+        if data_args.streaming and data_args.stream_start_sample > 0:
+            # the bins hold a varying number of samples, the trained steps do not tell how many to skip
+            raise ValueError("--stream_start_sample cannot resume a packed stream")
+        train_dataset = pack_dataset(train_dataset, max_len, data_args.packing)
+        if hasattr(train_dataset, "efficiency"):
+            rank0_print(f"Packed {train_dataset.num_samples} samples into {len(train_dataset)} bins, packing efficiency {train_dataset.efficiency:.3f}")
 
     if data_args.eval_data_path:
-        eval_json = json.load(open(data_args.eval_data_path, "r"))
+        eval_json = read_json(data_args.eval_data_path)
         eval_dataset = dataset_cls(eval_json, tokenizer=tokenizer, max_len=max_len)
     else:
         eval_dataset = None
 
-    return dict(train_dataset=train_dataset, eval_dataset=eval_dataset)
+    data_collator = DataCollatorForSupervisedDataset(pad_token_id=tokenizer.pad_token_id)
+    return dict(train_dataset=train_dataset, eval_dataset=eval_dataset, data_collator=data_collator)
+
+
+class SupervisedTrainer(Trainer):
+    """Trainer that groups by the dataset `lengths` and logs the padding ratio and tokens per step."""
+
+    def __init__(self, *args, packed_attention: Optional[PackedAttention] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.packed_attention = packed_attention
+        self.real_tokens = 0
+        self.batch_tokens = 0
+        self.last_logged_step = 0
+
+    def get_train_dataloader(self):
+        if not isinstance(getattr(self.train_dataset, "dataset", self.train_dataset), StreamingSupervisedDataset):
+            return super().get_train_dataloader()
+        # the dataset shards itself by rank, accelerate would only read on rank 0 and dispatch
+        return DataLoader(
+            self.train_dataset,
+            batch_size=self._train_batch_size,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+    def _get_train_sampler(self, *args, **kwargs):
+        # the default sampler would tokenize every sample to get the lengths
+        train_dataset = args[0] if len(args) > 0 else self.train_dataset
+        if self.args.group_by_length and hasattr(train_dataset, "lengths"):
+            return LengthGroupedSampler(
+                self.args.train_batch_size * self.args.gradient_accumulation_steps,
+                dataset=train_dataset,
+                lengths=train_dataset.lengths,
+            )
+        return super()._get_train_sampler(*args, **kwargs)
+
+    def training_step(self, model, inputs, *args, **kwargs):
+        if "attention_mask" in inputs:
+            self.real_tokens += int(inputs["attention_mask"].sum())
+            self.batch_tokens += inputs["attention_mask"].numel()
+        return super().training_step(model, inputs, *args, **kwargs)
+
+    def compute_loss(self, model, inputs, *args, **kwargs):
+        seq_ids = inputs.pop("seq_ids", None)
+        if self.packed_attention is not None:
+            self.packed_attention.set_batch(seq_ids)
+        return super().compute_loss(model, inputs, *args, **kwargs)
+
+    def log(self, logs, *args, **kwargs):
+        # share of pad tokens and real tokens per optimizer step on this rank since the last log
+        if self.batch_tokens > 0:
+            logs["padding_ratio"] = round(1 - self.real_tokens / self.batch_tokens, 4)
+            steps = self.state.global_step - self.last_logged_step
+            if steps > 0:
+                logs["tokens_per_step"] = round(self.real_tokens / steps, 1)
+            self.real_tokens, self.batch_tokens = 0, 0
+            self.last_logged_step = self.state.global_step
+        cache = getattr(self.train_dataset, "cache", None)
+        if cache is not None:
+            logs["sample_cache_hit_rate"] = round(cache.stats.summary()["hit_rate"], 4)
+        super().log(logs, *args, **kwargs)
 
 
 def train():
@@ -264,6 +541,10 @@ def train():
         lora_args,
     ) = parser.parse_args_into_dataclasses()
 
+    if data_args.streaming and data_args.stream_start_sample > 0 and training_args.resume_from_checkpoint and not training_args.ignore_data_skip:
+        # the Trainer also skips the batches of the checkpoint, the samples would be skipped twice
+        raise ValueError("--stream_start_sample and --resume_from_checkpoint both skip the trained samples, use one of them (or --ignore_data_skip True)")
+
     if getattr(training_args, 'deepspeed', None) and getattr(lora_args, 'q_lora', False):
         training_args.distributed_state.distributed_type = DistributedType.DEEPSPEED
 
@@ -346,14 +627,26 @@ def train():
         if training_args.gradient_checkpointing:
             model.enable_input_require_grads()
 
+    # images of tar shard records, then the vit cache in front of them
+    install_shard_images(model)
+    if data_args.vit_cache:
+        install_vit_cache(model, data_args.vit_cache)
+
     # Load data
     data_module = make_supervised_data_module(
-        tokenizer=tokenizer, data_args=data_args, max_len=training_args.model_max_length
+        tokenizer=tokenizer,
+        data_args=data_args,
+        max_len=training_args.model_max_length,
+        batch_size=training_args.per_device_train_batch_size,
+        seed=training_args.seed,
     )
 
+    # a token of a packed bin only attends to its own sample
+    packed_attention = PackedAttention(model) if data_args.packing else None
+
     # Start trainner
-    trainer = Trainer(
-        model=model, tokenizer=tokenizer, args=training_args, **data_module
+    trainer = SupervisedTrainer(
+        model=model, tokenizer=tokenizer, args=training_args, packed_attention=packed_attention, **data_module
     )
 
     trainer.train()
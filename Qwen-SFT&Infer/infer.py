@@ -11,11 +11,18 @@ import os
 import json
 import pandas as pd
 from io import BytesIO
-import base64
 import glob
 
 import re
 
+import sys
+sys.path.append('..')
+from image_store import ImageStore, image_bytes_from_row
+from shards import is_shard_path, ShardReader
+from json_io import read_json, write_json
+from utils import convert_tags_to_qwen_format
+from vit_cache import install_shard_images
+
 
 def load_model_and_tokenizer(path, device):
     tokenizer = AutoTokenizer.from_pretrained(path, trust_remote_code=True)
@@ -32,17 +39,18 @@ def infer(model, tokenizer, image_path, text):
     return response
 
 def load_data(data_path, img_path):
-    with open(data_path, "r", encoding='utf8') as f:
-        data = json.loads(f.read())
+    if is_shard_path(data_path):
+        # records carry their own `image_path` into the tar files, no parquet file is needed
+        return ShardReader(data_path), None
+
+    data = read_json(data_path)
 
-    cur_df = pd.read_parquet(img_path, columns=None)
+    # images are read on demand, only the row group holding an image is loaded
+    cur_df = ImageStore(img_path)
     return data, cur_df
 
 def convert_to_qwen_format(question):
-    for pos in re.findall(r"<box>(.*?)</box>", question):
-        x1, y1, x2, y2 = pos.strip().split()
-        question = question.replace(f"<box>{pos}</box>", f"<box>({x1},{y1}),({x2},{y2})</box>")
-    return question
+    return convert_tags_to_qwen_format(question, tags=("box",))
 
 def infer_one_ckpt(
     data, 
@@ -61,14 +69,17 @@ def infer_one_ckpt(
         # question = convert_to_qwen_format(question)
         label = item["label"]
         image_id = item["image_id"]
-        cur_image_str = cur_df.loc[image_id]["base64"]
-        cur_image = Image.open(BytesIO(base64.urlsafe_b64decode(cur_image_str))).convert("RGB")
-        # breakpoint()
-        device_id = device.split(":")[-1]
-        cur_image.save(f"./tmp_imgs/{device_id}.jpg")
+        if "image_path" in item:
+            image_path = item["image_path"]
+        else:
+            cur_image = Image.open(BytesIO(image_bytes_from_row(cur_df.loc[image_id]))).convert("RGB")
+            # breakpoint()
+            device_id = device.split(":")[-1]
+            image_path = f"./tmp_imgs/{device_id}.jpg"
+            cur_image.save(image_path)
 
         try: 
-            pred = infer(model, tokenizer, f"./tmp_imgs/{device_id}.jpg", question)
+            pred = infer(model, tokenizer, image_path, question)
         except:
             pred = "error"
             infer_error += 1
@@ -85,8 +96,7 @@ def infer_one_ckpt(
             "position_format": item["position_format"]
         })
 
-    with open(res_path, "w", encoding='utf8') as f:
-        f.write(json.dumps(logs, ensure_ascii=False, indent=4))
+    write_json(logs, res_path, indent=4)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("")
@@ -99,9 +109,10 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     model, tokenizer = load_model_and_tokenizer(args.model_path, args.device)
+    install_shard_images(model)
     data, cur_df = load_data(
         data_path=args.data_path,
-        img_path=args.img_path
+        img_path=args.img_path,
     )
 
     infer_one_ckpt(
@@ -0,0 +1,178 @@
+from typing import Dict, List
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, IterableDataset
+
+from token_cache import IGNORE_TOKEN_ID
+
+
+def pack_greedy(lengths, max_len) -> List[List[int]]:
+    """Next-fit in the dataset order, a bin is closed when the next sample does not fit."""
+    bins, current, total = [], [], 0
+    for i, length in enumerate(lengths):
+        if len(current) > 0 and total + length > max_len:
+            bins.append(current)
+            current, total = [], 0
+        current.append(i)
+        total += length
+    if len(current) > 0:
+        bins.append(current)
+    return bins
+
+
+def pack_ffd(lengths, max_len) -> List[List[int]]:
+    """First-fit decreasing, the longest samples first, each into the first bin with room."""
+    size = 1
+    while size < len(lengths):
+        size *= 2
+    # max tree over the free space of the bins, there is at most one bin per sample
+    free = [max_len] * (2 * size)
+    bins = []
+    for i in np.argsort(-np.asarray(lengths), kind="stable").tolist():
+        length = lengths[i]
+        node = 1
+        while node < size:
+            node = 2 * node if free[2 * node] >= length else 2 * node + 1
+        j = node - size
+        if j == len(bins):
+            bins.append([])
+        bins[j].append(i)
+        free[node] -= length
+        node //= 2
+        while node > 0:
+            free[node] = max(free[2 * node], free[2 * node + 1])
+            node //= 2
+    return bins
+
+
+PACKERS = {"greedy": pack_greedy, "ffd": pack_ffd}
+
+
+def pack_samples(samples) -> Dict[str, torch.Tensor]:
+    """
+    Concatenate unpadded samples. The positions restart at 0 for every sample
+    and the first label of a sample is ignored, it would be predicted from the
+    end of the previous sample. `seq_ids` is the index of the sample of each
+    token, see `PackedAttention`.
+    """
+    labels = []
+    for sample in samples:
+        label = sample["labels"].clone()
+        label[0] = IGNORE_TOKEN_ID
+        labels.append(label)
+    seq_lens = [len(sample["input_ids"]) for sample in samples]
+    return dict(
+        input_ids=torch.cat([sample["input_ids"] for sample in samples]),
+        labels=torch.cat(labels),
+        position_ids=torch.cat([torch.arange(length) for length in seq_lens]),
+        seq_ids=torch.repeat_interleave(torch.arange(len(seq_lens)), torch.tensor(seq_lens)),
+    )
+
+
+class PackedSupervisedDataset(Dataset):
+    """Bins of the samples of a dataset with exact token `lengths`, each bin fits in max_len."""
+
+    def __init__(self, dataset, max_len: int, strategy: str = "ffd"):
+        super(PackedSupervisedDataset, self).__init__()
+        self.dataset = dataset
+        self.max_len = max_len
+        self.bins = PACKERS[strategy](dataset.lengths, max_len)
+        self.lengths = [sum(dataset.lengths[i] for i in b) for b in self.bins]
+        self.num_samples = len(dataset.lengths)
+        self.efficiency = sum(self.lengths) / max(len(self.bins) * max_len, 1)
+
+    def __len__(self):
+        return len(self.bins)
+
+    def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        return pack_samples([self.dataset[j] for j in self.bins[i]])
+
+
+class PackedIterableDataset(IterableDataset):
+    """Greedy packing of a stream of samples."""
+
+    def __init__(self, dataset, max_len: int):
+        super(PackedIterableDataset, self).__init__()
+        self.dataset = dataset
+        self.max_len = max_len
+
+    def __iter__(self):
+        current, total = [], 0
+        for sample in self.dataset:
+            length = len(sample["input_ids"])
+            if len(current) > 0 and total + length > self.max_len:
+                yield pack_samples(current)
+                current, total = [], 0
+            current.append(sample)
+            total += length
+        if len(current) > 0:
+            yield pack_samples(current)
+
+
+def pack_dataset(dataset, max_len, strategy="ffd"):
+    if strategy not in PACKERS:
+        raise ValueError(f"unknown packing strategy {strategy}, expected one of {list(PACKERS)}")
+    if isinstance(dataset, IterableDataset):
+        if strategy != "greedy":
+            raise ValueError("a streamed dataset can only be packed with `greedy`")
+        return PackedIterableDataset(dataset, max_len)
+    return PackedSupervisedDataset(dataset, max_len, strategy)
+
+
+def packed_attention_mask(seq_ids, dtype) -> torch.Tensor:
+    """
+    Additive (batch, 1, len, len) mask of a batch of bins, a token only sees the
+    tokens of its own sample. The causal part is left to the model.
+    """
+    same_sample = seq_ids[:, None, :, None] == seq_ids[:, None, None, :]
+    mask = torch.zeros(same_sample.shape, dtype=dtype, device=seq_ids.device)
+    return mask.masked_fill_(~same_sample, torch.finfo(dtype).min)
+
+
+class PackedAttention:
+    """
+    Per-sample attention for packed bins in the Qwen(-VL) attention layers. The
+    rotary embedding of Qwen-VL is relative and computed from the sequence
+    length (`position_ids` are ignored), so masking the other samples of a bin
+    gives every sample the logits it would have alone.
+
+    The `attention_mask` of every `QWenAttention` call is replaced by the block
+    diagonal mask of the `seq_ids` of the current batch. The batch is kept until
+    the next one, gradient checkpointing runs the layers again in the backward.
+    """
+
+    def __init__(self, model):
+        self.seq_ids = None
+        self.masks = {}
+        self.handles = []
+        for module in model.modules():
+            if type(module).__name__ != "QWenAttention":
+                continue
+            if getattr(module, "use_flash_attn", False):
+                raise ValueError("packing needs the attention mask, the flash attention of QWenAttention ignores it")
+            self.handles.append(module.register_forward_pre_hook(self._hook, with_kwargs=True))
+        if len(self.handles) == 0:
+            raise ValueError("packing needs per-sample attention, which is only implemented for the QWenAttention of Qwen(-VL)")
+
+    def set_batch(self, seq_ids):
+        """`seq_ids` of the batch padded with -1, None for a batch of unpacked samples."""
+        self.seq_ids = seq_ids
+        self.masks = {}
+
+    def _hook(self, module, args, kwargs):
+        if self.seq_ids is None:
+            return None
+        hidden_states = args[0] if len(args) > 0 else kwargs["hidden_states"]
+        if hidden_states.shape[:2] != self.seq_ids.shape:
+            # a generation step with a kv cache, not a training batch
+            return None
+        if hidden_states.dtype not in self.masks:
+            self.masks[hidden_states.dtype] = packed_attention_mask(self.seq_ids.to(hidden_states.device), hidden_states.dtype)
+        kwargs["attention_mask"] = self.masks[hidden_states.dtype]
+        return args, kwargs
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
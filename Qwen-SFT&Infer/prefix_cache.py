@@ -0,0 +1,114 @@
+import re
+from collections import OrderedDict
+from typing import List
+
+import transformers
+
+STEP_SUFFIX = re.compile(r"[_-]?step[_-]?\d+$")
+# after a newline followed by a non-space character, no token of the Qwen tokenizer spans it
+SEGMENT_BOUNDARY = re.compile(r"(?<=\n)(?=\S)")
+IMAGE_PREFIX = re.compile(r"<img>[^\n]*?</img>")
+
+
+def episode_id(record):
+    """`episode_id` of a record, else its id without the trailing step number."""
+    if "episode_id" in record:
+        return record["episode_id"]
+    return STEP_SUFFIX.sub("", str(record.get("id", "")))
+
+
+class _Node:
+    __slots__ = ("text", "tokens", "children")
+
+    def __init__(self, text=""):
+        self.text = text
+        self.tokens = None
+        self.children = {}
+
+
+class PrefixTokenCache:
+    """
+    Tokenize texts that share their leading lines with earlier texts of the
+    same episode (the action history of consecutive GUIAct steps) by only
+    tokenizing the new lines.
+
+    A text is cut after each newline followed by a non-space character. The
+    pieces of the texts of an episode form a trie, a node holds the tokens of
+    its piece, so the tokens of a text are the tokens along its path. A
+    leading `<img>...</img>` (a new screenshot at every step) is tokenized on
+    its own. Only the tries of the last `max_episodes` episodes are kept.
+
+    Every cut is checked once, when its piece enters the trie: the piece and
+    the one before it must tokenize like their concatenation. The pieces start
+    at token boundaries of the full text (the first one at 0), so this holds
+    for all texts made of checked pieces. On a difference the cache disables
+    itself and the texts are tokenized in full.
+    """
+
+    def __init__(self, tokenizer: transformers.PreTrainedTokenizer, max_episodes=256):
+        self.tokenizer = tokenizer
+        self.max_episodes = max_episodes
+        self.tries = OrderedDict()
+        self.enabled = True
+        self.num_texts = 0
+        self.reused_chars = 0
+        self.total_chars = 0
+
+    def _trie(self, episode):
+        if episode in self.tries:
+            self.tries.move_to_end(episode)
+        else:
+            self.tries[episode] = _Node()
+            while len(self.tries) > self.max_episodes:
+                self.tries.popitem(last=False)
+        return self.tries[episode]
+
+    def _encode_full(self, texts):
+        return self.tokenizer(texts).input_ids if len(texts) > 0 else []
+
+    def encode_batch(self, texts, episode_ids) -> List[List[int]]:
+        """input_ids of `texts`, the new pieces of all texts are tokenized in one call."""
+        if not self.enabled:
+            return self._encode_full(texts)
+
+        # new nodes and (node before the cut, node after the cut) of their cuts
+        paths, new_nodes, cuts = [], [], []
+        for text, episode in zip(texts, episode_ids):
+            path = []
+            match = IMAGE_PREFIX.match(text)
+            if match is not None:
+                path.append(_Node(match.group(0)))
+                new_nodes.append(path[-1])
+                text = text[match.end():]
+            node = self._trie(episode)
+            for segment in SEGMENT_BOUNDARY.split(text):
+                if segment == "":
+                    continue
+                child = node.children.get(segment)
+                if child is None:
+                    # filled after the tokenizer call, later texts of the batch may share it
+                    child = node.children[segment] = _Node(segment)
+                    new_nodes.append(child)
+                    if len(path) > 0:
+                        cuts.append((path[-1], child))
+                else:
+                    self.reused_chars += len(segment)
+                    if len(path) == 1 and node.text == "":
+                        # the first piece after a new image
+                        cuts.append((path[0], child))
+                path.append(child)
+                node = child
+            paths.append(path)
+            self.total_chars += len(text)
+
+        for node, tokens in zip(new_nodes, self._encode_full([node.text for node in new_nodes])):
+            node.tokens = tokens
+        joined = self._encode_full([before.text + after.text for before, after in cuts])
+        for (before, after), tokens in zip(cuts, joined):
+            if before.tokens + after.tokens != tokens:
+                print(f"the prefix tokenization differs from the full tokenization, the prefix cache is disabled:\n{before.text}{after.text}")
+                self.enabled = False
+                self.tries.clear()
+                return self._encode_full(texts)
+        self.num_texts += len(texts)
+        return [[token for node in path for token in node.tokens] for path in paths]
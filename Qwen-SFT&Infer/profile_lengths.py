@@ -0,0 +1,159 @@
+import json
+import argparse
+from collections import defaultdict
+from multiprocessing import Pool
+
+import numpy as np
+
+from token_cache import iter_chunks, iter_records, load_tokenizer, tokenize_conversations
+from packing import pack_ffd
+
+PERCENTILES = [50, 90, 95, 99]
+HISTOGRAM_EDGES = [0, 256, 512, 1024, 2048, 4096, 8192, 16384]
+
+
+def record_source(record):
+    """
+    `source` of the record if any, GUIAct records carry their `type`, multi-turn
+    conversations are GUIChat and the rest GUIEnv. Name the inputs
+    (`name=path`) for exact sources.
+    """
+    if "source" in record:
+        return record["source"]
+    if "type" in record:
+        return f"guiact-{record['type']}"
+    if len(record["conversations"]) > 2:
+        return "guichat"
+    return "guienv"
+
+
+def iter_sources(inputs):
+    for spec in inputs:
+        name, path = spec.split("=", 1) if "=" in spec else (None, spec)
+        for record in iter_records(path):
+            yield (name or record_source(record)), record
+
+
+_tokenizer = None
+
+def _init_worker(model_name_or_path):
+    global _tokenizer
+    # no truncation, the lengths are what we are after
+    _tokenizer = load_tokenizer(model_name_or_path, 1 << 20)
+
+def _profile_chunk(chunk):
+    """(source, length, number of <img>, image tokens) of each record."""
+    results = tokenize_conversations([record["conversations"] for _, record in chunk], _tokenizer)
+    img_start = getattr(_tokenizer, "img_start_id", None)
+    img_end = getattr(_tokenizer, "img_end_id", None)
+    profiles = []
+    for (source, _), (input_id, _) in zip(chunk, results):
+        num_images, image_tokens = 0, 0
+        if img_start is not None:
+            input_id = np.asarray(input_id)
+            starts, ends = np.flatnonzero(input_id == img_start), np.flatnonzero(input_id == img_end)
+            num_images = min(len(starts), len(ends))
+            image_tokens = int((ends[:num_images] - starts[:num_images] + 1).sum())
+        profiles.append((source, len(input_id), num_images, image_tokens))
+    return profiles
+
+
+def _padded_tokens(lengths, batch_size):
+    """Tokens of the batches of `lengths` (in order) padded to their longest sample."""
+    full = len(lengths) // batch_size * batch_size
+    total = int(lengths[:full].reshape(-1, batch_size).max(axis=1).sum()) * batch_size
+    if full < len(lengths):
+        total += int(lengths[full:].max()) * (len(lengths) - full)
+    return total
+
+
+def _length_grouped(lengths, batch_size, rng):
+    # like transformers' LengthGroupedSampler: shuffle, sort inside megabatches of 50 batches
+    lengths = lengths[rng.permutation(len(lengths))]
+    megabatch = 50 * batch_size
+    return np.concatenate([
+        np.sort(lengths[start:start + megabatch])[::-1]
+        for start in range(0, len(lengths), megabatch)
+    ])
+
+
+def padding_report(lengths, max_len, batch_size, seed=0):
+    """Share of the tokens of a step that are padding, for each way of batching at `max_len`."""
+    rng = np.random.default_rng(seed)
+    kept = np.minimum(lengths, max_len)
+    real = int(kept.sum())
+    bins = pack_ffd(kept.tolist(), max_len)
+    return {
+        "truncated": float((lengths > max_len).mean()),
+        "tokens_lost": 1 - real / max(int(lengths.sum()), 1),
+        "waste_pad_to_max_len": 1 - real / (len(kept) * max_len),
+        "waste_dynamic_padding": 1 - real / _padded_tokens(kept[rng.permutation(len(kept))], batch_size),
+        "waste_group_by_length": 1 - real / _padded_tokens(_length_grouped(kept, batch_size, rng), batch_size),
+        "waste_packing_ffd": 1 - real / (len(bins) * max_len),
+    }
+
+
+def source_report(lengths, num_images, image_tokens, max_lens):
+    counts, _ = np.histogram(lengths, bins=HISTOGRAM_EDGES + [max(int(lengths.max()) + 1, HISTOGRAM_EDGES[-1] + 1)])
+    return {
+        "num_samples": len(lengths),
+        "mean": float(lengths.mean()),
+        "percentiles": {p: int(np.percentile(lengths, p)) for p in PERCENTILES},
+        "max": int(lengths.max()),
+        "histogram": {f">={edge}": int(count) for edge, count in zip(HISTOGRAM_EDGES, counts)},
+        "truncated": {max_len: float((lengths > max_len).mean()) for max_len in max_lens},
+        "images_per_sample": float(num_images.mean()),
+        "tokens_per_image": float(image_tokens.sum() / max(num_images.sum(), 1)),
+        "image_token_share": float(image_tokens.sum() / lengths.sum()),
+    }
+
+
+def profile_lengths(inputs, model_name_or_path, max_lens, batch_size, num_workers=8):
+    columns = defaultdict(list)
+    with Pool(num_workers, initializer=_init_worker, initargs=(model_name_or_path,)) as pool:
+        for profiles in pool.imap(_profile_chunk, iter_chunks(iter_sources(inputs), 64)):
+            for source, length, num_images, image_tokens in profiles:
+                columns[source].append((length, num_images, image_tokens))
+
+    report = {"sources": {}, "padding": {}}
+    all_lengths = []
+    for source, rows in sorted(columns.items()):
+        lengths, num_images, image_tokens = [np.asarray(column, dtype=np.int64) for column in zip(*rows)]
+        report["sources"][source] = source_report(lengths, num_images, image_tokens, max_lens)
+        all_lengths.append(lengths)
+    all_lengths = np.concatenate(all_lengths)
+    for max_len in max_lens:
+        report["padding"][max_len] = padding_report(all_lengths, max_len, batch_size)
+    return report
+
+
+def print_report(report, batch_size):
+    for source, stats in report["sources"].items():
+        percentiles = " ".join(f"p{p}={v}" for p, v in stats["percentiles"].items())
+        print(f"## {source}: {stats['num_samples']} samples, mean {stats['mean']:.0f}, {percentiles}, max {stats['max']}")
+        print("   histogram: " + " ".join(f"{edge}:{count}" for edge, count in stats["histogram"].items()))
+        print("   truncated: " + " ".join(f"{max_len}:{rate:.2%}" for max_len, rate in stats["truncated"].items()))
+        print(f"   {stats['images_per_sample']:.2f} <img> per sample, {stats['tokens_per_image']:.0f} tokens per <img>, "
+              f"{stats['image_token_share']:.1%} image tokens")
+    print(f"## padding waste of the mixture (batch size {batch_size})")
+    print("max_len  truncated  tokens_lost  pad_to_max_len  dynamic  group_by_length  packing_ffd")
+    for max_len, stats in report["padding"].items():
+        print(f"{max_len:>7}  {stats['truncated']:>9.2%}  {stats['tokens_lost']:>11.2%}  {stats['waste_pad_to_max_len']:>14.1%}  "
+              f"{stats['waste_dynamic_padding']:>7.1%}  {stats['waste_group_by_length']:>15.1%}  {stats['waste_packing_ffd']:>11.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("")
+    parser.add_argument("--model_name_or_path", default="Qwen/Qwen-VL-Chat")
+    parser.add_argument("--data_path", nargs="+", default=["../data_preprocess/training_data_qwen.json"], help="json, jsonl or JSONL shard dirs, `name=path` names the source")
+    parser.add_argument("--max_len", type=int, nargs="+", default=[1024, 2048, 4096, 8192], help="candidate model_max_length values")
+    parser.add_argument("--batch_size", type=int, default=4, help="per device batch size for the padding waste")
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--output", default=None, help="also write the report as json")
+    args = parser.parse_args()
+
+    report = profile_lengths(args.data_path, args.model_name_or_path, args.max_len, args.batch_size, args.num_workers)
+    print_report(report, args.batch_size)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf8") as f:
+            f.write(json.dumps(report, ensure_ascii=False, indent=4))
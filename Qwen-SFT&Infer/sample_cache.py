@@ -0,0 +1,151 @@
+import os
+import atexit
+from collections import OrderedDict
+from multiprocessing import Lock
+from multiprocessing.sharedctypes import RawArray
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+
+MAX_WORKERS = 64
+# int64 per slot: sequence number (odd while the slot is written), sample index, length
+HEADER_FIELDS = 3
+
+
+def _stats_row():
+    worker_info = get_worker_info()
+    return 0 if worker_info is None else worker_info.id % MAX_WORKERS + 1
+
+
+def _sample_bytes(sample):
+    return sum(value.numel() * value.element_size() for value in sample.values())
+
+
+class CacheStats:
+    """
+    Hit/miss counters in shared memory, one row per DataLoader worker, so the
+    main process sees the lookups of all its workers.
+    """
+
+    def __init__(self):
+        self.counts = RawArray("q", 2 * (MAX_WORKERS + 1))
+
+    def record(self, hit):
+        self.counts[2 * _stats_row() + (0 if hit else 1)] += 1
+
+    def summary(self):
+        counts = np.frombuffer(self.counts, dtype=np.int64)
+        hits, misses = int(counts[0::2].sum()), int(counts[1::2].sum())
+        return dict(hits=hits, misses=misses, hit_rate=hits / max(hits + misses, 1))
+
+
+class LRUSampleCache:
+    """Tokenized samples of one process, the least recently used go beyond `max_bytes`."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.samples = OrderedDict()
+        self.stats = CacheStats()
+
+    def get(self, i) -> Optional[Dict[str, torch.Tensor]]:
+        sample = self.samples.get(i)
+        self.stats.record(sample is not None)
+        if sample is not None:
+            self.samples.move_to_end(i)
+        return sample
+
+    def put(self, i, sample):
+        size = _sample_bytes(sample)
+        if size > self.max_bytes or i in self.samples:
+            return
+        self.samples[i] = sample
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.samples.popitem(last=False)
+            self.nbytes -= _sample_bytes(evicted)
+
+
+class SharedSampleCache:
+    """
+    Tokenized samples in a shared memory segment created before the DataLoader
+    workers start, so the workers reuse each other's samples.
+
+    Direct-mapped: sample i lives in slot `i % num_slots` and replaces the
+    previous sample of the slot. Readers take no lock, the sequence number of
+    the slot is read before and after the copy and a changed (or odd) number
+    is a miss. Writers skip a slot whose lock is held by another worker.
+    """
+
+    def __init__(self, max_bytes, slot_tokens, num_locks=64):
+        self.slot_tokens = slot_tokens
+        slot_bytes = 8 * HEADER_FIELDS + 2 * 4 * slot_tokens
+        self.num_slots = max(max_bytes // slot_bytes, 1)
+        self.shm = SharedMemory(create=True, size=self.num_slots * slot_bytes)
+        self.owner_pid = os.getpid()
+        self._attach()
+        self.headers[:, 0] = 0
+        self.headers[:, 1] = -1
+        self.locks = [Lock() for _ in range(num_locks)]
+        self.stats = CacheStats()
+        atexit.register(self.close)
+
+    def _attach(self):
+        header_bytes = 8 * HEADER_FIELDS * self.num_slots
+        self.headers = np.ndarray((self.num_slots, HEADER_FIELDS), dtype=np.int64, buffer=self.shm.buf)
+        self.tokens = np.ndarray((self.num_slots, 2, self.slot_tokens), dtype=np.int32, buffer=self.shm.buf, offset=header_bytes)
+
+    def __getstate__(self):
+        # spawned workers attach to the segment by name
+        state = dict(self.__dict__)
+        del state["headers"], state["tokens"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def get(self, i) -> Optional[Dict[str, torch.Tensor]]:
+        slot = i % self.num_slots
+        header = self.headers[slot]
+        seq = int(header[0])
+        sample = None
+        if seq % 2 == 0 and int(header[1]) == i:
+            length = int(header[2])
+            input_ids = self.tokens[slot, 0, :length].copy()
+            labels = self.tokens[slot, 1, :length].copy()
+            if int(header[0]) == seq:
+                sample = dict(input_ids=torch.from_numpy(input_ids), labels=torch.from_numpy(labels))
+        self.stats.record(sample is not None)
+        return sample
+
+    def put(self, i, sample):
+        length = len(sample["input_ids"])
+        if length > self.slot_tokens:
+            return
+        slot = i % self.num_slots
+        lock = self.locks[slot % len(self.locks)]
+        if not lock.acquire(block=False):
+            return
+        try:
+            header = self.headers[slot]
+            header[0] += 1
+            header[1] = i
+            header[2] = length
+            self.tokens[slot, 0, :length] = sample["input_ids"].numpy()
+            self.tokens[slot, 1, :length] = sample["labels"].numpy()
+            header[0] += 1
+        finally:
+            lock.release()
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.headers, self.tokens = None, None
+        self.shm.close()
+        if os.getpid() == self.owner_pid:
+            self.shm.unlink()
+        self.shm = None
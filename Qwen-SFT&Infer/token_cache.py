@@ -0,0 +1,253 @@
+import os
+import json
+import weakref
+import argparse
+from itertools import islice
+from multiprocessing import Pool
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+import transformers
+from transformers.trainer_pt_utils import LabelSmoother
+
+import sys
+sys.path.append('..')
+from json_io import iter_json, iter_jsonl_shards
+from prefix_cache import PrefixTokenCache, episode_id
+
+IGNORE_TOKEN_ID = LabelSmoother.ignore_index
+TOKEN_DTYPE = np.int32
+ROLES = {"user": "<|im_start|>user", "assistant": "<|im_start|>assistant"}
+
+_TEMPLATES = weakref.WeakKeyDictionary()
+
+
+def _template_tokens(tokenizer, system_message):
+    """Token ids of the chat template, computed once per tokenizer and system message."""
+    templates = _TEMPLATES.setdefault(tokenizer, {})
+    if system_message not in templates:
+        im_start = tokenizer.im_start_id
+        im_end = tokenizer.im_end_id
+        nl_tokens = tokenizer('\n').input_ids
+        system = [im_start] + tokenizer('system').input_ids + nl_tokens + \
+            tokenizer(system_message).input_ids + [im_end] + nl_tokens
+        templates[system_message] = dict(
+            im_start=im_start,
+            im_end=im_end,
+            nl_tokens=nl_tokens,
+            system=system,
+            system_target=[im_start] + [IGNORE_TOKEN_ID] * (len(system)-3) + [im_end] + nl_tokens,
+            roles={role: tokenizer(value).input_ids for role, value in ROLES.items()},
+        )
+    return templates[system_message]
+
+
+def _tokenize_values(sources, tokenizer, prefix_cache, episode_ids):
+    if prefix_cache is None:
+        values = [sentence["value"] for source in sources for sentence in source]
+        return tokenizer(values).input_ids if len(values) > 0 else []
+
+    # the user prompts of an episode share their leading lines, the answers don't
+    if episode_ids is None:
+        episode_ids = [""] * len(sources)
+    user, other = [], []
+    for source, episode in zip(sources, episode_ids):
+        for sentence in source:
+            if sentence["from"] == "user":
+                user.append((sentence["value"], episode))
+            else:
+                other.append(sentence["value"])
+    user_ids = iter(prefix_cache.encode_batch([value for value, _ in user], [episode for _, episode in user]))
+    other_ids = iter(tokenizer(other).input_ids if len(other) > 0 else [])
+    return [
+        next(user_ids) if sentence["from"] == "user" else next(other_ids)
+        for source in sources for sentence in source
+    ]
+
+
+def tokenize_conversations(
+    sources,
+    tokenizer: transformers.PreTrainedTokenizer,
+    system_message: str = "You are a helpful assistant.",
+    prefix_cache: PrefixTokenCache = None,
+    episode_ids=None,
+) -> List[Tuple[List[int], List[int]]]:
+    """
+    input_ids and labels of conversations with the Qwen chat template, neither
+    padded nor truncated. All sentences are tokenized in one call, with a
+    `prefix_cache` only the new lines of the user prompts (`episode_ids` is
+    one episode per conversation).
+    """
+    template = _template_tokens(tokenizer, system_message)
+    im_start, im_end, nl_tokens = template["im_start"], template["im_end"], template["nl_tokens"]
+
+    sources = [source if ROLES[source[0]["from"]] == ROLES["user"] else source[1:] for source in sources]
+    value_ids = iter(_tokenize_values(sources, tokenizer, prefix_cache, episode_ids))
+
+    results = []
+    for source in sources:
+        input_id, target = list(template["system"]), list(template["system_target"])
+        for sentence in source:
+            role_ids = template["roles"][sentence["from"]]
+            _input_id = role_ids + nl_tokens + next(value_ids) + [im_end] + nl_tokens
+            input_id += _input_id
+            if sentence["from"] == "user":
+                target += [im_start] + [IGNORE_TOKEN_ID] * (len(_input_id)-3) + [im_end] + nl_tokens
+            else:
+                target += [im_start] + [IGNORE_TOKEN_ID] * len(role_ids) + \
+                    _input_id[len(role_ids)+1:-2] + [im_end] + nl_tokens
+        assert len(input_id) == len(target)
+        results.append((input_id, target))
+    return results
+
+
+def tokenize_conversation(
+    source,
+    tokenizer: transformers.PreTrainedTokenizer,
+    system_message: str = "You are a helpful assistant."
+) -> Tuple[List[int], List[int]]:
+    return tokenize_conversations([source], tokenizer, system_message)[0]
+
+
+def iter_records(data_path):
+    if os.path.isdir(data_path):
+        return iter_jsonl_shards(data_path)
+    return iter_json(data_path)
+
+
+_worker_tokenizer = None
+_worker_max_len = None
+_worker_prefix_cache = None
+
+def _init_worker(model_name_or_path, max_len, use_prefix_cache=False):
+    global _worker_tokenizer, _worker_max_len, _worker_prefix_cache
+    _worker_tokenizer = load_tokenizer(model_name_or_path, max_len)
+    _worker_max_len = max_len
+    if use_prefix_cache:
+        _worker_prefix_cache = PrefixTokenCache(_worker_tokenizer)
+
+def _tokenize_records(records):
+    results = tokenize_conversations(
+        [record["conversations"] for record in records],
+        _worker_tokenizer,
+        prefix_cache=_worker_prefix_cache,
+        episode_ids=[episode_id(record) for record in records],
+    )
+    return [(input_id[:_worker_max_len], target[:_worker_max_len]) for input_id, target in results]
+
+
+def iter_chunks(records, chunk_size):
+    """Lists of up to `chunk_size` records, the work items of the tokenizing pools."""
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def load_tokenizer(model_name_or_path, max_len):
+    # the same settings as finetune.py
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        model_name_or_path,
+        model_max_length=max_len,
+        padding_side="right",
+        use_fast=False,
+        trust_remote_code=True,
+    )
+    tokenizer.pad_token_id = tokenizer.eod_id
+    return tokenizer
+
+
+def write_token_cache(data_path, output_dir, model_name_or_path, max_len, num_workers=8, use_prefix_cache=False):
+    """
+    Tokenize the conversations of `data_path` (json, jsonl or a JSONL shard dir)
+    into flat `input_ids.bin` / `labels.bin` (int32, truncated to `max_len`)
+    and `offsets.npy` (sample i is [offsets[i], offsets[i+1])).
+    use_prefix_cache: only tokenize the new lines of consecutive steps of an
+    episode, pays off when the steps are in order (not on a shuffled merge).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {name: os.path.join(output_dir, name) for name in ["input_ids.bin", "labels.bin", "offsets.npy", "meta.json"]}
+    tmp_paths = {name: f"{path}.tmp" for name, path in paths.items()}
+
+    offsets = [0]
+    with open(tmp_paths["input_ids.bin"], "wb") as f_ids, open(tmp_paths["labels.bin"], "wb") as f_labels, \
+            Pool(num_workers, initializer=_init_worker, initargs=(model_name_or_path, max_len, use_prefix_cache)) as pool:
+        # imap keeps the input order
+        for results in pool.imap(_tokenize_records, iter_chunks(iter_records(data_path), 64)):
+            for input_id, target in results:
+                f_ids.write(np.asarray(input_id, dtype=TOKEN_DTYPE).tobytes())
+                f_labels.write(np.asarray(target, dtype=TOKEN_DTYPE).tobytes())
+                offsets.append(offsets[-1] + len(input_id))
+                if len(offsets) % 10000 == 1:
+                    print(f"{len(offsets) - 1} samples, {offsets[-1]} tokens")
+
+    with open(tmp_paths["offsets.npy"], "wb") as f:
+        np.save(f, np.asarray(offsets, dtype=np.int64))
+    meta = {
+        "data_path": data_path,
+        "model_name_or_path": model_name_or_path,
+        "max_len": max_len,
+        "num_samples": len(offsets) - 1,
+        "num_tokens": offsets[-1],
+        "dtype": np.dtype(TOKEN_DTYPE).name,
+    }
+    with open(tmp_paths["meta.json"], "w", encoding="utf8") as f:
+        f.write(json.dumps(meta, ensure_ascii=False, indent=4))
+    for name in paths:
+        os.replace(tmp_paths[name], paths[name])
+    return meta
+
+
+def is_token_cache(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, "offsets.npy"))
+
+
+class MemmapSupervisedDataset(Dataset):
+    """Dataset for supervised fine-tuning, reads a token cache from `write_token_cache`.
+
+    The arrays are memory-mapped read-only, so ranks and workers share them
+    through the page cache and nothing is tokenized at startup. Samples are
+    returned unpadded.
+    """
+
+    def __init__(self, path, tokenizer: transformers.PreTrainedTokenizer, max_len: int):
+        super(MemmapSupervisedDataset, self).__init__()
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf8") as f:
+            self.meta = json.loads(f.read())
+        if self.meta["max_len"] < max_len:
+            print(f"the token cache {path} is truncated to {self.meta['max_len']} tokens (model_max_length: {max_len})")
+        self.input_ids = np.memmap(os.path.join(path, "input_ids.bin"), dtype=self.meta["dtype"], mode="r")
+        self.labels = np.memmap(os.path.join(path, "labels.bin"), dtype=self.meta["dtype"], mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.max_len = max_len
+        self.lengths = np.minimum(np.diff(self.offsets), max_len).tolist()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        # unpadded, the collator pads the batch
+        start = int(self.offsets[i])
+        end = start + self.lengths[i]
+        return dict(
+            input_ids=torch.from_numpy(np.array(self.input_ids[start:end])),
+            labels=torch.from_numpy(np.array(self.labels[start:end])),
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("")
+    parser.add_argument("--model_name_or_path", default="Qwen/Qwen-VL-Chat")
+    parser.add_argument("--data_path", default="../data_preprocess/training_data_qwen.json", help="json, jsonl or a JSONL shard dir")
+    parser.add_argument("--output_dir", default="./token_cache/training_data_qwen")
+    parser.add_argument("--model_max_length", type=int, default=2048)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--prefix_cache", action="store_true", help="reuse the tokens of the lines shared by the steps of an episode")
+    args = parser.parse_args()
+
+    meta = write_token_cache(args.data_path, args.output_dir, args.model_name_or_path, args.model_max_length, args.num_workers, args.prefix_cache)
+    print(meta)
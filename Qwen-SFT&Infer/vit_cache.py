@@ -0,0 +1,174 @@
+import os
+import argparse
+from io import BytesIO
+from multiprocessing import Pool
+from typing import List
+
+import numpy as np
+import torch
+from PIL import Image
+
+import sys
+sys.path.append('..')
+from json_io import read_json, write_json
+from shards import record_images, is_shard_member, read_shard_member
+from token_cache import iter_records
+
+IMAGE_SIZE = 448
+# the Normalize of Qwen-VL's image_transform (CLIP), used when it cannot be read from the model
+MEAN = (0.48145466, 0.4578275, 0.40821073)
+STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+def load_image(path, image_size=IMAGE_SIZE):
+    """The screenshot as the vision tower sees it before ToTensor: RGB, bicubic resize."""
+    with Image.open(path) as image:
+        image = image.convert("RGB").resize((image_size, image_size), Image.BICUBIC)
+    return np.asarray(image, dtype=np.uint8)
+
+
+def _load_image(args):
+    path, image_size = args
+    try:
+        return load_image(path, image_size)
+    except Exception as e:
+        print(f"skip {path}: {e}")
+        return None
+
+
+def write_vit_cache(data_path, output_dir, image_size=IMAGE_SIZE, num_workers=8):
+    """
+    Decode and resize every `<img>` of `data_path` (json, jsonl or a JSONL shard
+    dir) once into `images.npy`, a uint8 (n, size, size, 3) array, and
+    `index.json` that maps the image paths (as written in the tags) to rows.
+    """
+    paths = list(dict.fromkeys(path for record in iter_records(data_path) for path in record_images(record)))
+    os.makedirs(output_dir, exist_ok=True)
+    images_path = os.path.join(output_dir, "images.npy")
+    tmp_path = os.path.join(output_dir, "images.tmp.npy")
+
+    images = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(len(paths), image_size, image_size, 3))
+    rows = {}
+    with Pool(num_workers) as pool:
+        for row, image in enumerate(pool.imap(_load_image, [(path, image_size) for path in paths], chunksize=16)):
+            if image is not None:
+                images[row] = image
+                rows[paths[row]] = row
+            if (row + 1) % 10000 == 0:
+                print(f"{row + 1}/{len(paths)} images")
+    images.flush()
+    del images
+    os.replace(tmp_path, images_path)
+
+    index = {"image_size": image_size, "num_images": len(paths), "paths": rows}
+    write_json(index, os.path.join(output_dir, "index.json"))
+    return index
+
+
+class VitCache:
+    """Read-only view of a cache written by `write_vit_cache`."""
+
+    def __init__(self, path):
+        index = read_json(os.path.join(path, "index.json"))
+        self.image_size = index["image_size"]
+        self.rows = index["paths"]
+        self.images = np.load(os.path.join(path, "images.npy"), mmap_mode="r")
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, path):
+        return path in self.rows
+
+    def get(self, paths) -> np.ndarray:
+        return np.stack([self.images[self.rows[path]] for path in paths])
+
+
+def _find_visual(model):
+    # the Qwen-VL vision tower, also under peft/deepspeed wrappers
+    for module in model.modules():
+        if hasattr(module, "encode") and hasattr(module, "image_transform"):
+            return module
+    return None
+
+
+def _normalize_params(visual):
+    for transform in getattr(visual.image_transform, "transforms", []):
+        if hasattr(transform, "mean") and hasattr(transform, "std"):
+            return transform.mean, transform.std
+    return MEAN, STD
+
+
+def _resize_size(visual, default):
+    for transform in getattr(visual.image_transform, "transforms", []):
+        if hasattr(transform, "size") and hasattr(transform, "interpolation"):
+            size = transform.size
+            return size if isinstance(size, int) else tuple(size)[0]
+    return default
+
+
+def install_shard_images(model):
+    """
+    Let `visual.encode` open the image paths that point into tar shards
+    (`<shard>.tar#<member>`, see `shards.ShardReader`), read from the tar file
+    by offset. Calls without such a path go to the original `encode`.
+    """
+    visual = _find_visual(model)
+    if visual is None:
+        return
+    encode = visual.encode
+
+    def shard_encode(image_paths: List[str]):
+        if not any(is_shard_member(path) for path in image_paths):
+            return encode(image_paths)
+        images = []
+        for path in image_paths:
+            image = Image.open(BytesIO(read_shard_member(path)) if is_shard_member(path) else path)
+            images.append(visual.image_transform(image.convert("RGB")))
+        return visual(torch.stack(images, dim=0))
+
+    visual.encode = shard_encode
+
+
+def install_vit_cache(model, path):
+    """
+    Serve the screenshots of `visual.encode` from the cache: the uint8 pixels
+    are normalized on the device of the vision tower, like ToTensor + Normalize
+    of `image_transform`. A call with an image that is not cached falls back to
+    the original `encode`.
+    """
+    visual = _find_visual(model)
+    if visual is None:
+        print("the model has no Qwen-VL vision tower, the vit cache is not used")
+        return None
+    cache = VitCache(path)
+    image_size = _resize_size(visual, cache.image_size)
+    if image_size != cache.image_size:
+        raise ValueError(f"the vit cache has {cache.image_size}px images, the vision tower expects {image_size}px")
+
+    encode = visual.encode
+    mean, std = _normalize_params(visual)
+
+    def cached_encode(image_paths: List[str]):
+        if not all(path in cache for path in image_paths):
+            cache.misses += len(image_paths)
+            return encode(image_paths)
+        cache.hits += len(image_paths)
+        device = next(visual.parameters()).device
+        images = torch.from_numpy(cache.get(image_paths)).to(device).permute(0, 3, 1, 2).float().div(255)
+        images = (images - torch.tensor(mean, device=device).view(1, 3, 1, 1)) / torch.tensor(std, device=device).view(1, 3, 1, 1)
+        return visual(images)
+
+    visual.encode = cached_encode
+    return cache
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("")
+    parser.add_argument("--data_path", default="../data_preprocess/training_data_qwen.json", help="json, jsonl or a JSONL shard dir")
+    parser.add_argument("--output_dir", default="./vit_cache/training_data_qwen")
+    parser.add_argument("--image_size", type=int, default=IMAGE_SIZE)
+    parser.add_argument("--num_workers", type=int, default=8)
+    args = parser.parse_args()
+
+    index = write_vit_cache(args.data_path, args.output_dir, args.image_size, args.num_workers)
+    print(f"{len(index['paths'])}/{index['num_images']} images cached")
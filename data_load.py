@@ -1,3 +1,4 @@
+import os
 import json
 import pandas as pd
 from io import BytesIO
@@ -5,29 +6,36 @@ import base64
 from PIL import Image
 import argparse
 
+from image_store import ImageStore, image_bytes_from_row
+from image_cache import decoded_image_cache, image_source_key
+from json_io import read_json
+
 from data_visualization import (
     element_visual,
     elements_visual,
     actions_visual
 )
 
-def read_json(path):
-    with open(path, 'r', encoding='utf8') as f:
-        data = json.loads(f.read())
-    return data
-
-def read_parquet(path):
-    return pd.read_parquet(path, columns=None)
+def read_parquet(path, lazy=False):
+    if lazy:
+        return ImageStore(path)
+    cur_df = pd.read_parquet(path, columns=None)
+    cur_df.attrs["path"] = os.path.abspath(path)
+    return cur_df
 
 def decode_base64_to_image(base64_string):
     return Image.open(BytesIO(base64.b64decode(base64_string))).convert("RGB")
 
+def _image_cache_key(cur_df, image_id, b64decode=True):
+    return image_source_key(cur_df), image_id
+
+@decoded_image_cache(key_fn=_image_cache_key)
 def read_image_from_qarquet(cur_df, image_id, b64decode=True):
-    cur_image_str = cur_df.loc[image_id]["base64"]
-    if b64decode:
-        return decode_base64_to_image(cur_image_str)
-    else:
-        return Image.open(BytesIO(cur_image_str)).convert("RGB")
+    """
+    The image encoding (base64 text, raw bytes or `binary` column) is detected
+    from the data, `b64decode` is only kept for compatibility.
+    """
+    return Image.open(BytesIO(image_bytes_from_row(cur_df.loc[image_id]))).convert("RGB")
 
 
 
@@ -52,10 +60,11 @@ if __name__ == "__main__":
     parser.add_argument("--data_path", default="./data/guichat_data.json")
     parser.add_argument("--img_path", default="./data/guichat_images.parquet")
     parser.add_argument("--dataset", default="guichat")
+    parser.add_argument("--lazy", action="store_true", help="read images on demand instead of loading the whole parquet file")
     args = parser.parse_args()
 
     data = read_json(args.data_path)
-    cur_df = read_parquet(args.img_path)
+    cur_df = read_parquet(args.img_path, lazy=args.lazy)
 
     if args.dataset == "guienv":
         for sample in data:
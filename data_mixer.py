@@ -0,0 +1,118 @@
+import os
+import random
+
+from json_io import read_json, iter_json, iter_jsonl_shards, shuffle_buffer
+from qwen_format import guienv_to_qwen_format, guiact_to_qwen_format, guichat_to_qwen_format
+
+
+DEFAULT_SOURCE = {
+    "name": None,
+    "path": None,
+    # guienv / guiact / guichat instructions, or qwen for converted records
+    "format": "qwen",
+    "image_id2path": None,
+    "type": None,
+    "weight": 1.0,
+    "epochs": 1,
+    "max_samples": None,
+}
+
+
+def _iter_raw_records(path):
+    if os.path.isdir(path):
+        return iter_jsonl_shards(path)
+    return iter_json(path)
+
+
+class DataMixer:
+    """
+    Weighted, seeded interleaving of several instruction files, read lazily.
+
+    A mixture spec (a dict or a JSON file for `from_file`):
+    {
+        "seed": 0,
+        "shuffle_buffer": 10000,
+        "sources": [
+            {"name": "guienv", "format": "guienv", "weight": 1, "epochs": 1, "max_samples": 100000,
+             "path": "./data/ocr_grounding_train_stage2_sft_instructions.json",
+             "image_id2path": "./images/guienv/image_id2path.json"},
+            {"name": "smartphone", "format": "guiact", "weight": 2, "epochs": 2,
+             "path": "./data/smartphone_train_sft_instructions.json",
+             "image_id2path": "./images/guiact/smartphone/image_id2path.json"},
+            {"name": "merged", "format": "qwen", "path": "./training_data_qwen"}
+        ]
+    }
+    Each step picks a source with probability proportional to its weight among
+    the sources that are not exhausted. A source is read `epochs` times and
+    yields at most `max_samples` records. Records are converted to the Qwen-VL
+    format only when they are used (`type` defaults to the source name for
+    guiact). `shuffle_buffer` > 0 shuffles the mixed stream locally.
+    """
+
+    def __init__(self, sources, seed=0, shuffle_buffer=0):
+        self.sources = []
+        for source in sources:
+            source = dict(DEFAULT_SOURCE, **source)
+            if source["name"] is None:
+                source["name"] = source["path"]
+            if source["format"] not in ("guienv", "guiact", "guichat", "qwen"):
+                raise ValueError(f"unknown source format: {source['format']}")
+            self.sources.append(source)
+        self.seed = seed
+        self.shuffle_buffer = shuffle_buffer
+        self.image2paths = {}
+
+    @classmethod
+    def from_file(cls, path):
+        spec = read_json(path)
+        return cls(spec["sources"], seed=spec.get("seed", 0), shuffle_buffer=spec.get("shuffle_buffer", 0))
+
+    def _iter_source(self, source):
+        num = 0
+        for _ in range(source["epochs"]):
+            for item in _iter_raw_records(source["path"]):
+                if source["max_samples"] is not None and num >= source["max_samples"]:
+                    return
+                yield item
+                num += 1
+
+    def _convert(self, source_id, item):
+        source = self.sources[source_id]
+        if source["format"] == "qwen":
+            return item
+        if source_id not in self.image2paths:
+            self.image2paths[source_id] = read_json(source["image_id2path"])
+        image2path = self.image2paths[source_id]
+        if source["format"] == "guienv":
+            return guienv_to_qwen_format(item, image2path)
+        elif source["format"] == "guiact":
+            return guiact_to_qwen_format(item, source["type"] or source["name"], image2path)
+        return guichat_to_qwen_format(item, image2path)
+
+    def _interleave(self, rng):
+        iterators = {i: self._iter_source(source) for i, source in enumerate(self.sources) if source["weight"] > 0}
+        while len(iterators) > 0:
+            active = list(iterators.keys())
+            source_id = rng.choices(active, weights=[self.sources[i]["weight"] for i in active])[0]
+            item = next(iterators[source_id], None)
+            if item is None:
+                del iterators[source_id]
+                continue
+            yield source_id, item
+
+    def iter_records(self, shard_id=0, num_shards=1):
+        """
+        Yield the mixed records, `shard_id`/`num_shards` keeps every
+        `num_shards`-th record (e.g. per DataLoader worker), the others are
+        never converted. The order only depends on the spec and the seed.
+        """
+        rng = random.Random(self.seed)
+        stream = self._interleave(rng)
+        if self.shuffle_buffer > 0:
+            stream = shuffle_buffer(stream, self.shuffle_buffer, rng)
+        for i, (source_id, item) in enumerate(stream):
+            if i % num_shards == shard_id:
+                yield self._convert(source_id, item)
+
+    def __iter__(self):
+        return self.iter_records()
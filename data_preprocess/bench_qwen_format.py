@@ -0,0 +1,73 @@
+import re
+import time
+import random
+import argparse
+
+import sys
+sys.path.append('..')
+from utils import convert_tags_to_qwen_format
+
+
+def legacy_convert(value, image_id2path):
+    """
+    The findall + str.replace loops merge_data used before the single-pass rewrite.
+    """
+    for x in re.findall(r"<image>(.*?)</image>", value):
+        path = image_id2path[x]
+        value = value.replace(f"<image>{x}</image>", f"<img>{path}</img>")
+
+    for pos in re.findall(r"<box>(.*?)</box>", value):
+        x1, y1, x2, y2 = pos.strip().split()
+        value = value.replace(f"<box>{pos}</box>", f"<box>({x1},{y1}),({x2},{y2})</box>")
+    return value
+
+
+def make_guichat_dialogues(num_dialogues, num_turns, boxes_per_turn, seed=0):
+    rng = random.Random(seed)
+    image_id2path = {}
+    dialogues = []
+    for i in range(num_dialogues):
+        image_id = f"uid_record_{i:08d}"
+        image_id2path[image_id] = f"./images/guichat/{i // 999}/{i % 999}.png"
+        turns = []
+        for t in range(num_turns):
+            boxes = " and ".join(
+                "<box>{} {} {} {}</box>".format(*sorted(rng.randrange(1000) for _ in range(4)))
+                for _ in range(boxes_per_turn)
+            )
+            prefix = f"<image>{image_id}</image>\n" if t == 0 else ""
+            turns.append(prefix + f"The answer of turn {t} is located at {boxes}. " * 3)
+        dialogues.append(turns)
+    return dialogues, image_id2path
+
+
+def run(convert, dialogues, image_id2path):
+    start = time.perf_counter()
+    outputs = [[convert(value, image_id2path) for value in turns] for turns in dialogues]
+    return outputs, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("")
+    parser.add_argument("--num_dialogues", type=int, default=2000)
+    parser.add_argument("--num_turns", type=int, default=8)
+    parser.add_argument("--boxes_per_turn", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    dialogues, image_id2path = make_guichat_dialogues(args.num_dialogues, args.num_turns, args.boxes_per_turn)
+    new_convert = lambda value, image_id2path: convert_tags_to_qwen_format(value, tags=("image", "box"), image_id2path=image_id2path)
+
+    legacy_times, new_times = [], []
+    for _ in range(args.repeat):
+        legacy_outputs, legacy_time = run(legacy_convert, dialogues, image_id2path)
+        new_outputs, new_time = run(new_convert, dialogues, image_id2path)
+        assert legacy_outputs == new_outputs, "the outputs differ"
+        legacy_times.append(legacy_time)
+        new_times.append(new_time)
+
+    num_values = args.num_dialogues * args.num_turns
+    legacy_time, new_time = min(legacy_times), min(new_times)
+    print(f"{num_values} GUIChat values, {args.boxes_per_turn * 3} boxes each, outputs are identical")
+    print(f"findall + replace: {legacy_time:.3f}s")
+    print(f"single re.sub:     {new_time:.3f}s ({legacy_time / new_time:.2f}x)")
@@ -1,137 +1,318 @@
-import pandas as pd 
 from PIL import Image
 from io import BytesIO
 import base64
 import os
 import json
 import glob
+import hashlib
+import argparse
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
 
-def write_json(data, path):
-    with open(path, 'w', encoding='utf8') as f:
-        f.write(json.dumps(data, ensure_ascii=False, indent=4))
+import sys
+sys.path.append('..')
+from image_store import ImageStore, image_bytes_from_row, sniff_image_format
+from json_io import read_json, write_json
+from stage_cache import StageCache
 
-def read_data(paths):
-    images = {}
-    for path in paths:
-        df = pd.read_parquet(path)
-        for index, row in df.iterrows():
-            images[index] = row["base64"]
-    return images
+# formats the finetune loader reads as they are, anything else is re-encoded to PNG
+PASSTHROUGH_EXTENSIONS = {
+    "jpeg": ".jpg",
+    "png": ".png",
+}
 
-def write_images(images, base_path):
-    image2path = {}
-    chunk_id = 0
-    os.mkdir(f"{base_path}/chunk_{chunk_id}")
-
-    i = 0
-    for k, v in images.items():
-        image = Image.open(BytesIO(base64.b64decode(v))).convert("RGB")
-        image_path = f"{base_path}/chunk_{chunk_id}/{k}.png"
-        image.save(image_path)
-        image2path[k] = image_path
-
-        i +=1 
-        if i >= 999:
-            i = 0
-            chunk_id += 1
-            os.mkdir(f"{base_path}/chunk_{chunk_id}")
-            print("new chunk")
+def save_image(image_bytes, path_stem, passthrough=False):
+    """
+    Write an image to `path_stem` + extension and return its path.
+    passthrough=True writes the original bytes when the format is in
+    PASSTHROUGH_EXTENSIONS instead of decoding and re-encoding to PNG.
+    """
+    image_format = sniff_image_format(image_bytes) if passthrough else None
+    path = path_stem + PASSTHROUGH_EXTENSIONS.get(image_format, ".png")
+    # several workers may write the same content-addressed file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if image_format in PASSTHROUGH_EXTENSIONS:
+        with open(tmp_path, "wb") as f:
+            f.write(image_bytes)
+    else:
+        Image.open(BytesIO(image_bytes)).convert("RGB").save(tmp_path, format="PNG")
+    os.replace(tmp_path, path)
+    return path
 
-    write_json(image2path, f"{base_path}/image_id2path.json")
+def image_extension(image_bytes, passthrough=False):
+    image_format = sniff_image_format(image_bytes) if passthrough else None
+    return PASSTHROUGH_EXTENSIONS.get(image_format, ".png")
 
+def content_path_stem(image_bytes, objects_path):
+    digest = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+    return f"{objects_path}/{digest[:2]}/{digest}"
 
-def write_images_version1(images, base_path):
-    image2path = {}
-    for k, v in images.items():
-        image = Image.open(BytesIO(base64.b64decode(v))).convert("RGB")
-        
-        _, _, record, _, step = k.split("_")
-        record_path = f"{base_path}/record_{record}"
-        if not os.path.exists(record_path):
-            os.mkdir(record_path)
-
-        path = f"{record_path}/step_{step}.png"
-        image.save(path)
-        image2path[k] = path
-    
-    write_json(image2path, f"{base_path}/image_id2path.json")
+# Parallel, resumable export
+#
+# The rows are streamed row group by row group and decoded/encoded in a process
+# pool. The images are split in chunks of `chunk_size` ids (in the order of
+# `plan_export`), a chunk is committed by writing `<base_path>/.export/chunk_N.json`
+# once all its images are on disk, so a rerun only redoes unfinished chunks.
 
-def write_images_version2(images, base_path):
-    image2path = {}
-    chunk_id = 0
-    os.mkdir(f"{base_path}/chunk_{chunk_id}")
-
-    i = 0
-    for k, v in images.items():
-        image = Image.open(BytesIO(v)).convert("RGB")
-        image_path = f"{base_path}/chunk_{chunk_id}/{k}.png"
-        image.save(image_path)
-        image2path[k] = image_path
-
-        i +=1 
-        if i >= 999:
-            i = 0
-            chunk_id += 1
-            os.mkdir(f"{base_path}/chunk_{chunk_id}")
-            print("new chunk")
+# a layout gives the path of an image without its extension
+
+def chunk_layout(image_id, index, base_path, chunk_size=999):
+    return f"{base_path}/chunk_{index // chunk_size}/{image_id}"
+
+def record_layout(image_id, index, base_path, chunk_size=999):
+    _, _, record, _, step = image_id.split("_")
+    return f"{base_path}/record_{record}/step_{step}"
+
+def plan_export(paths):
+    """
+    image_id -> (file_id, row_group, row), in the order of the files and rows,
+    an id in several files keeps its first position and takes its last row.
+    """
+    locations = {}
+    for file_id, path in enumerate(paths):
+        for image_id, (row_group, row) in ImageStore(path).locations.items():
+            locations[image_id] = (file_id, row_group, row)
+    return locations
+
+def _export_image(image_bytes, path_stem, passthrough=False, objects_path=None):
+    if objects_path is None:
+        return save_image(image_bytes, path_stem, passthrough)
+
+    # content-addressed: identical payloads are decoded and written once
+    path_stem = content_path_stem(image_bytes, objects_path)
+    path = path_stem + image_extension(image_bytes, passthrough)
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return save_image(image_bytes, path_stem, passthrough)
+
+def _export_batch(batch, passthrough=False, objects_path=None):
+    return [
+        (image_id, _export_image(image_bytes_from_row({column: value}), path_stem, passthrough, objects_path))
+        for image_id, path_stem, column, value in batch
+    ]
+
+def dedup_report(image2path):
+    """
+    How many files and bytes the content-addressed layout saved.
+    """
+    sizes = {path: os.path.getsize(path) for path in set(image2path.values())}
+    total_bytes = sum(sizes[path] for path in image2path.values())
+    unique_bytes = sum(sizes.values())
+    return {
+        "images": len(image2path),
+        "unique_images": len(sizes),
+        "duplicate_images": len(image2path) - len(sizes),
+        "total_bytes": total_bytes,
+        "unique_bytes": unique_bytes,
+        "saved_bytes": total_bytes - unique_bytes,
+    }
+
+def _commit_chunk(manifest_path, image2path):
+    tmp_path = f"{manifest_path}.tmp"
+    write_json(image2path, tmp_path)
+    os.replace(tmp_path, manifest_path)
+
+def export_images(
+    paths,
+    base_path,
+    layout=chunk_layout,
+    num_workers=None,
+    chunk_size=999,
+    batch_size=32,
+    passthrough=False,
+    dedup=False,
+    objects_path=None,
+    stage_cache=None,
+    ):
+    """
+    dedup=True stores each unique payload once under `objects_path`
+    (`<base_path>/objects` by default, share it between exports to deduplicate
+    across datasets), image_id2path.json then maps many ids to one file.
+
+    stage_cache: a `StageCache`, the export is skipped (and its images linked
+    back from the cache) when the parquet files and settings did not change.
+    With dedup only the objects the export references are cached with it, not
+    the whole (shared) `objects_path`.
+    """
+    if dedup and objects_path is None:
+        objects_path = f"{base_path}/objects"
+    if not dedup:
+        objects_path = None
 
+    if stage_cache is not None:
+        name = f"export_images {base_path}"
+        key = stage_cache.key(
+            name,
+            paths,
+            params={"layout": layout.__name__, "chunk_size": chunk_size, "passthrough": passthrough, "objects_path": objects_path},
+            code=[__file__, image_bytes_from_row],
+        )
+        if stage_cache.get(name, key) is not None:
+            print(f"{name}: unchanged, restored from {stage_cache.cache_dir}")
+            return read_json(f"{base_path}/image_id2path.json")
+
+        image2path = export_images(paths, base_path, layout, num_workers, chunk_size, batch_size, passthrough, dedup, objects_path)
+        # the files outside base_path are the objects of this export in the shared store
+        inside = os.path.abspath(base_path) + os.sep
+        objects = sorted({path for path in image2path.values() if not os.path.abspath(path).startswith(inside)})
+        stage_cache.put(name, key, [base_path] + objects)
+        return image2path
+
+    locations = plan_export(paths)
+    image_ids = list(locations.keys())
+    targets = {
+        image_id: layout(image_id, i, base_path, chunk_size)
+        for i, image_id in enumerate(image_ids)
+    }
+    num_chunks = (len(image_ids) + chunk_size - 1) // chunk_size
+
+    manifest_dir = f"{base_path}/.export"
+    os.makedirs(manifest_dir, exist_ok=True)
+    manifest_paths = [f"{manifest_dir}/chunk_{c}.json" for c in range(num_chunks)]
+    done_chunks = {c for c in range(num_chunks) if os.path.exists(manifest_paths[c])}
+
+    # manifests written with other settings or inputs can not be reused
+    config = {
+        "layout": layout.__name__,
+        "chunk_size": chunk_size,
+        "passthrough": passthrough,
+        "objects_path": objects_path,
+        "inputs": [[path, os.path.getsize(path), os.stat(path).st_mtime_ns] for path in paths],
+    }
+    config_path = f"{manifest_dir}/config.json"
+    if os.path.exists(config_path) and read_json(config_path) != config:
+        print("export settings changed, start over")
+        done_chunks = set()
+    write_json(config, config_path)
+    print(f"{len(image_ids)} images, {num_chunks} chunks, {len(done_chunks)} already exported")
+
+    # rows to export, grouped by (file, row group)
+    remaining = {}
+    todo = {}
+    for i, image_id in enumerate(image_ids):
+        chunk_id = i // chunk_size
+        if chunk_id in done_chunks:
+            continue
+        remaining[chunk_id] = remaining.get(chunk_id, 0) + 1
+        file_id, row_group, row = locations[image_id]
+        todo.setdefault((file_id, row_group), []).append((row, image_id))
+
+    if objects_path is None:
+        for image_id in {image_id for rows in todo.values() for _, image_id in rows}:
+            os.makedirs(os.path.dirname(targets[image_id]), exist_ok=True)
+
+    chunk_of = {image_id: i // chunk_size for i, image_id in enumerate(image_ids)}
+    exported = {}
+
+    def _finish(exported_paths):
+        for image_id, image_path in exported_paths:
+            chunk_id = chunk_of[image_id]
+            exported[image_id] = image_path
+            remaining[chunk_id] -= 1
+            if remaining[chunk_id] == 0:
+                chunk_ids = image_ids[chunk_id * chunk_size: (chunk_id + 1) * chunk_size]
+                _commit_chunk(manifest_paths[chunk_id], {k: exported.pop(k) for k in chunk_ids})
+                print(f"chunk {chunk_id} done")
+
+    def _batches():
+        for file_id, path in enumerate(paths):
+            parquet_file = pq.ParquetFile(path)
+            column = "binary" if "binary" in parquet_file.schema_arrow.names else "base64"
+            for row_group in range(parquet_file.num_row_groups):
+                if (file_id, row_group) not in todo:
+                    continue
+                values = parquet_file.read_row_group(row_group, columns=[column]).column(0)
+                rows = todo.pop((file_id, row_group))
+                for start in range(0, len(rows), batch_size):
+                    yield [
+                        (image_id, targets[image_id], column, values[row].as_py())
+                        for row, image_id in rows[start: start + batch_size]
+                    ]
+
+    if num_workers == 0:
+        for batch in _batches():
+            _finish(_export_batch(batch, passthrough, objects_path))
+    else:
+        num_workers = num_workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = set()
+            for batch in _batches():
+                # bound the number of decoded row groups held in memory
+                if len(futures) >= 2 * num_workers:
+                    finished, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        _finish(future.result())
+                futures.add(executor.submit(_export_batch, batch, passthrough, objects_path))
+            for future in as_completed(futures):
+                _finish(future.result())
+
+    image2path = {}
+    for manifest_path in manifest_paths:
+        image2path.update(read_json(manifest_path))
     write_json(image2path, f"{base_path}/image_id2path.json")
 
+    if objects_path is not None:
+        report = dedup_report(image2path)
+        write_json(report, f"{base_path}/dedup_report.json")
+        print(report)
+    return image2path
+
 
-def process_ocr_grounding():
+def process_ocr_grounding(**export_kwargs):
     out_path = "./images/guienv"
-    images = read_data([
+    export_images([
         "./data/ocr_grounding_test_images.parquet",
         "./data/ocr_grounding_train_stage1_images.parquet",
         "./data/ocr_grounding_train_stage2_images.parquet"
-    ])
-    print(len(list(images.keys())))
-    os.mkdir(out_path)
-    write_images(images, out_path)
+    ], out_path, layout=chunk_layout, **export_kwargs)
 
-def process_guiact_web_single():
+def process_guiact_web_single(**export_kwargs):
     out_path = "./images/guiact/web-single"
-    images = read_data([
-        "./data/web-single_test_images.parquet"
+    export_images([
+        "./data/web-single_test_images.parquet",
         "./data/web-single_train_images.parquet",
-    ])
-    os.makedirs(out_path)
-    print(len(list(images.keys())))
-    write_images(images, out_path)
+    ], out_path, layout=chunk_layout, **export_kwargs)
 
-def process_guiact_web_multi():
+def process_guiact_web_multi(**export_kwargs):
     out_path = "./images/guiact/web-multi"
-    images = read_data([
-        "./data/web-multi_test_images.parquet"
+    export_images([
+        "./data/web-multi_test_images.parquet",
         "./data/web-multi_train_images.parquet",
-    ])
-    os.makedirs(out_path)
-    print(len(list(images.keys())))
-    write_images_version1(images, out_path)
+    ], out_path, layout=record_layout, **export_kwargs)
 
-def process_guiact_smartphone():
+def process_guiact_smartphone(**export_kwargs):
     out_path = "./images/guiact/smartphone"
-    images = read_data([
-        "./data/smartphone_test_images.parquet"
+    export_images([
+        "./data/smartphone_test_images.parquet",
         "./data/smartphone_train_images.parquet",
-    ])
-    os.makedirs(out_path)
-    print(len(list(images.keys())))
-    write_images_version1(images, out_path)
+    ], out_path, layout=record_layout, **export_kwargs)
 
-def process_guichat():
+def process_guichat(**export_kwargs):
     out_path = "./images/guichat"
-    images = read_data([
+    export_images([
         "./data/guichat_images.parquet"
-    ])
-    os.makedirs(out_path)
-    print(len(list(images.keys())))
-    write_images_version2(images, out_path)
+    ], out_path, layout=chunk_layout, **export_kwargs)
 
 
 if __name__ == "__main__":
-    process_ocr_grounding()
-    process_guiact_web_single()
-    process_guiact_web_multi()
-    process_guiact_smartphone()
-    process_guichat()
+    parser = argparse.ArgumentParser("")
+    parser.add_argument("--num_workers", type=int, default=None, help="default: all cores, 0: export in this process")
+    parser.add_argument("--passthrough", action="store_true", help="keep the original JPEG/PNG bytes instead of re-encoding to PNG")
+    parser.add_argument("--dedup", action="store_true", help="store identical screenshots once in ./images/objects")
+    parser.add_argument("--cache_dir", default="./.stage_cache", help="skip the exports whose parquet files and settings did not change")
+    parser.add_argument("--no_cache", action="store_true")
+    args = parser.parse_args()
+
+    export_kwargs = {
+        "num_workers": args.num_workers,
+        "passthrough": args.passthrough,
+        "dedup": args.dedup,
+        "objects_path": "./images/objects" if args.dedup else None,
+        "stage_cache": None if args.no_cache else StageCache(args.cache_dir),
+    }
+    process_ocr_grounding(**export_kwargs)
+    process_guiact_web_single(**export_kwargs)
+    process_guiact_web_multi(**export_kwargs)
+    process_guiact_smartphone(**export_kwargs)
+    process_guichat(**export_kwargs)
@@ -2,36 +2,165 @@ import json
 import yaml
 import re
 
-def read_json(path):
-    with open(path, 'r', encoding='utf8') as f:
-        data = json.loads(f.read())
-    return data
-
-def write_json(res, path):
-    with open(path, 'w', encoding='utf8') as f:
-        f.write(json.dumps(res, ensure_ascii=False, indent=4))
-
-
-def is_pass_check(item):
-    image_w, image_h = item["image_size"]["width"], item["image_size"]["height"]
-
-    pred_bbox = re.findall(r"(<box>.*?</box>)", item["question"] + str(item["actions_label"]))
-    for bbox in pred_bbox:
-        x1, y1, x2, y2 = parse_box(bbox)
-        if x1 > image_w or x2 > image_w or y1 > image_h or y2 > image_h:
-            return False
-        if x1 < 0 or x2 < 0 or y1 < 0 or y2 < 0:
-            return False
-
-    pred_point = re.findall(r"(<point>.*?</point>)", item["question"] + str(item["actions_label"]))
-    for point in pred_point:
-        x, y = parse_point(point)
-        if x > image_w or y > image_h:
-            return False
-        if x < 0 or y < 0:
-            return False
-    
-    return True
+import os
+import argparse
+import numpy as np
+from operator import methodcaller
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import sys
+sys.path.append('..')
+from json_io import iter_json, JsonWriter
+from stage_cache import StageCache
+
+
+VALID = 0
+BOX_OUT_OF_IMAGE = 1
+POINT_OUT_OF_IMAGE = 2
+MALFORMED_COORDINATES = 3
+REASON_NAMES = ["valid", "box_out_of_image", "point_out_of_image", "malformed_coordinates"]
+
+_TAG_PATTERNS = {
+    "box": re.compile(r"<box>(.*?)</box>"),
+    "point": re.compile(r"<point>(.*?)</point>"),
+}
+
+def _parse_numbers(strings):
+    """
+    float() of every string, NaN for the malformed ones.
+    """
+    try:
+        return np.fromiter(map(float, strings), dtype=np.float64, count=len(strings))
+    except ValueError:
+        values = []
+        for x in strings:
+            try:
+                values.append(float(x))
+            except ValueError:
+                values.append(np.nan)
+        return np.asarray(values, dtype=np.float64)
+
+def _extract_coordinates(text, tag, size):
+    """
+    Positions and values (num_tags x size, NaN rows for malformed contents) of
+    the `tag` tags in `text`, parsed like parse_box/parse_point.
+    """
+    open_tag, close_tag = f"<{tag}>", f"</{tag}>"
+    # [text, content, text, content, ..., text], the match positions follow from the lengths
+    parts = _TAG_PATTERNS[tag].split(text)
+    lengths = np.fromiter(map(len, parts), dtype=np.int64, count=len(parts))
+    lengths[1::2] += len(open_tag) + len(close_tag)
+    positions = np.cumsum(lengths)[0:-1:2]
+    contents = parts[1::2]
+    values = np.full((len(contents), size), np.nan)
+    if len(contents) == 0:
+        return positions, values
+
+    # parse_box/parse_point keep what follows the last open tag
+    if open_tag in "".join(contents):
+        contents = [x.rsplit(open_tag, 1)[-1] for x in contents]
+    num_commas = np.fromiter(map(methodcaller("count", ","), contents), dtype=np.int64, count=len(contents))
+    well_formed = num_commas == size - 1
+    if well_formed.all():
+        values[:] = _parse_numbers(",".join(contents).split(",")).reshape(-1, size)
+    elif well_formed.any():
+        numbers = ",".join(x for x, keep in zip(contents, well_formed.tolist()) if keep).split(",")
+        values[well_formed] = _parse_numbers(numbers).reshape(-1, size)
+    return positions, values
+
+def validate_coordinates(dataset):
+    """
+    Check that the boxes and points of a list of GUIAct records are inside
+    their images.
+
+    The texts `question + str(actions_label)` of all records are joined by
+    newlines (tags never span lines), the boxes and points are extracted in one
+    pass each and their bounds are checked on the truncated values with array
+    ops. Boxes come before points and the first failed coordinate of a record
+    decides its reason code and failed field.
+
+    Returns (mask, reasons, failed_fields): a boolean array (True: keep), an
+    int8 array of REASON_NAMES indices and the failed field per record
+    ("question", "actions_label" or None).
+    Coordinates parse_box/parse_point cannot parse are dropped as
+    MALFORMED_COORDINATES.
+    """
+    num = len(dataset)
+    mask = np.ones(num, dtype=bool)
+    reasons = np.zeros(num, dtype=np.int8)
+    failed_fields = [None] * num
+    if num == 0:
+        return mask, reasons, failed_fields
+
+    texts = [item["question"] + str(item["actions_label"]) for item in dataset]
+    starts = np.cumsum([0] + [len(text) + 1 for text in texts[:-1]])
+    question_ends = starts + np.asarray([len(item["question"]) for item in dataset])
+    widths = np.asarray([item["image_size"]["width"] for item in dataset], dtype=np.float64)
+    heights = np.asarray([item["image_size"]["height"] for item in dataset], dtype=np.float64)
+    text = "\n".join(texts)
+
+    record_ids, failed_positions, codes = [], [], []
+    for tag, size, code in (("box", 4, BOX_OUT_OF_IMAGE), ("point", 2, POINT_OUT_OF_IMAGE)):
+        positions, values = _extract_coordinates(text, tag, size)
+        ids = np.searchsorted(starts, positions, side="right") - 1
+        values = np.trunc(values)
+        limits = np.stack([widths, heights] * (size // 2), axis=1)[ids]
+        malformed = ~np.all(np.isfinite(values), axis=1)
+        out_of_image = np.any((values > limits) | (values < 0), axis=1)
+        failed = malformed | out_of_image
+        record_ids.append(ids[failed])
+        failed_positions.append(positions[failed])
+        codes.append(np.where(malformed[failed], MALFORMED_COORDINATES, code))
+
+    # boxes first, then points, each in text order
+    record_ids = np.concatenate(record_ids)
+    failed_positions = np.concatenate(failed_positions)
+    codes = np.concatenate(codes)
+    records, first = np.unique(record_ids, return_index=True)
+
+    mask[records] = False
+    reasons[records] = codes[first]
+    in_question = failed_positions[first] < question_ends[records]
+    for record, in_q in zip(records.tolist(), in_question.tolist()):
+        failed_fields[record] = "question" if in_q else "actions_label"
+    return mask, reasons, failed_fields
+
+def print_dropped(dataset_name, dropped):
+    """
+    One line for the (reason, field) -> count `dropped` of a dataset.
+    """
+    if len(dropped) > 0:
+        counts = ", ".join(f"{reason} in {field}: {count}" for (reason, field), count in sorted(dropped.items()))
+        print(f"{dataset_name} dropped {sum(dropped.values())} records ({counts})")
+
+def iter_valid_records(dataset, batch_size=1024, dataset_name="", dropped=None):
+    """
+    Stream the records kept by `validate_coordinates`, batch by batch. The
+    dropped records are counted per (reason, field) into `dropped`, without a
+    `dropped` Counter they are summarized at the end.
+    """
+    summarize = dropped is None
+    if summarize:
+        dropped = Counter()
+    batch = []
+    for item in dataset:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield from _valid_records(batch, dropped)
+            batch = []
+    if len(batch) > 0:
+        yield from _valid_records(batch, dropped)
+    if summarize:
+        print_dropped(dataset_name, dropped)
+
+def _valid_records(batch, dropped):
+    mask, reasons, failed_fields = validate_coordinates(batch)
+    for item, keep, reason, field in zip(batch, mask.tolist(), reasons.tolist(), failed_fields):
+        if keep:
+            yield item
+        else:
+            dropped[REASON_NAMES[reason], field] += 1
     
 def parse_box(box_str, keep_float=False, split_token=","):
     """
@@ -58,7 +187,12 @@ def parse_point(point_str, keep_float=False, split_token=","):
         return int(x), int(y)
 
 def convert_related_format_to_related_version1(actions):
+    """
+    Returns new action dicts, `actions` is left unchanged.
+    """
+    res = []
     for action in actions:
+        action = dict(action)
         if "element" in action:
             position = [str(int(x*1000)) for x in parse_box(action["element"], keep_float=True)]
             action["element"] = "<box>{}</box>".format(" ".join(position))
@@ -77,7 +211,8 @@ def convert_related_format_to_related_version1(actions):
                 "down": str(int(float(action["scroll"]["down"])*1000)),
                 "right": str(int(float(action["scroll"]["down"])*1000))
             }
-    return actions
+        res.append(action)
+    return res
 
 def convert_related_format_to_related_version2(actions):
     """
@@ -99,12 +234,15 @@ def action_to_yaml(actions):
 def action_to_csv_string(actions):
     res = ""
     for action in actions:
-        if "dual_point" in action:
-            action["dual_point"] = "from {} to {}".format(action["dual_point"]["from"], action["dual_point"]["to"])
-        if "scroll" in action:
-            action["scroll"] = "down {} right {}".format(action["scroll"]["down"], action["scroll"]["right"])
-
-        res += "{}\n".format(", ".join(list(action.values())))
+        values = []
+        for key, value in action.items():
+            if key == "dual_point":
+                value = "from {} to {}".format(value["from"], value["to"])
+            elif key == "scroll":
+                value = "down {} right {}".format(value["down"], value["right"])
+            values.append(value)
+
+        res += "{}\n".format(", ".join(values))
     return res
     
 def clear_actions(actions, position_format):
@@ -112,80 +250,80 @@ def clear_actions(actions, position_format):
         actions = [actions]
     res = []
     for action in actions: 
-        action["name"] = action["name"].lower()     
-        if action["name"] == "click":
+        name = action["name"].lower()
+        if name == "click":
             action = {
                 "name": "click",
                 "element": action["element"][position_format],
             }
-        elif action["name"] == "hover":
+        elif name == "hover":
             action = {
                 "name": "hover",
                 "element": action["element"][position_format],
             }
-        elif action["name"] == "input":
+        elif name == "input":
             action = {
                 "name": "input",
                 "text": action["text"]
             }
-        elif action["name"] == "enter":
+        elif name == "enter":
             action = {
                 "name": "enter"
             }
-        elif action["name"] == "scroll":
+        elif name == "scroll":
             action = {
                 "name": "scroll",
                 "scroll": action["scroll"][position_format],
             }
-        elif action["name"] == "select_text":
+        elif name == "select_text":
             action = {
                 "name": "select_text",
                 "dual_point": action["dual_point"][position_format],
             }
-        elif action["name"] == "copy_text" or action["name"] == "copy":
+        elif name == "copy_text" or name == "copy":
             action = {
                 "name": "copy",
             }
-        elif action["name"] == "answer":
+        elif name == "answer":
             action = {
                 "name": "answer",
                 "text": action["text"]
             }
-        elif action["name"] == "select":
+        elif name == "select":
             action = {
                 "name": "select",
                 "element": action["element"][position_format],
                 "text": action["text"]
             }
-        elif action["name"] == "tap":
+        elif name == "tap":
             action = {
                 "name": "tap",
                 "point": action["point"][position_format],
             }
-        elif action["name"] == "swipe":
+        elif name == "swipe":
             action = {
                 "name": "swipe",
                 "dual_point": action["dual_point"][position_format],
             }
-        elif action["name"] == "go_back":
+        elif name == "go_back":
             action = {
                 "name": "go_back"
             } 
-        elif action["name"] == "go_home":
+        elif name == "go_home":
             action = {
                 "name": "go_home"
             }
-        elif action["name"] == "task_complete":
+        elif name == "task_complete":
             action = {
                 "name": "task_complete"
             } 
-        elif action["name"] == "task_impossible":
+        elif name == "task_impossible":
             action = {
                 "name": "task_impossible"
             }
 
         else:
-            print(action["name"])
+            print(name)
             print("unsupported action name")
             continue
         res.append(action)
@@ -196,11 +334,10 @@ def element_to_related_version1_format(element):
     position = [str(int(x*1000)) for x in parse_box(element, keep_float=True)]
     return "<box>{}</box>".format(" ".join(position))
 
-def convert_guienv_data_to_instructions(
+def iter_guienv_instructions(
     dataset,
     position_format="related"):
 
-    instructions = []
     for item in dataset:
         if position_format == "absolue":
             if item["task_type"] == "bbox2text":
@@ -229,7 +366,7 @@ def convert_guienv_data_to_instructions(
         else:
             label = item["answer"]
 
-        instructions.append({
+        yield {
             "uid": item["uid"],
             "image_id": item["image_id"],
             "image_size": item["image_size"],
@@ -237,26 +374,42 @@ def convert_guienv_data_to_instructions(
             "prompt": prompt,
             "label": label,
             "position_format": position_format
-        })
-    return instructions
+        }
 
-def convert_guiact_data_to_instructions(
+def convert_guienv_data_to_instructions(
+    dataset,
+    position_format="related"):
+    return list(iter_guienv_instructions(dataset, position_format))
+
+PARSE_FORMATS = ["JSON", "JSONL", "YAML", "CSV_String"]
+POSITION_FORMATS = ["absolute", "related", "related_version1", "related_version2"]
+
+ACTION_SERIALIZERS = {
+    "JSON": action_to_json,
+    "JSONL": action_to_jsonl,
+    "YAML": action_to_yaml,
+    "CSV_String": action_to_csv_string,
+}
+
+def iter_guiact_instruction_variants(
     dataset,
     dataset_name,
+    variants,
     use_history=True,
     use_logs=True,
     use_thoughts=True,
-    parse_format="CSV_String", # json, jsonl, natural string, yaml
-    position_format="related",
+    dropped=None,
     ):
+    """
+    Yield (variant, instruction) for every (parse_format, position_format) of
+    `variants`. Each record is checked and its prompt built once, the actions
+    are cleared once per position family and converted once per position format.
+    `dropped` counts the records that fail the check, see `iter_valid_records`.
+    """
+    variants = [tuple(variant) for variant in variants]
 
-    instructions = []
-    for item in dataset:
-        # check the elements out of image region
-        if not is_pass_check(item):
-            print(item)
-            continue
-
+    # check the elements out of image region
+    for item in iter_valid_records(dataset, dataset_name=dataset_name, dropped=dropped):
         prompt = ""
 
         if use_history and item["actions_history"] != "":
@@ -276,71 +429,264 @@ def convert_guiact_data_to_instructions(
             label += ""
         label += "actions:\n"
 
-        try:
-            if "related" in position_format:
-                actions = clear_actions(item["actions_label"], "related")
-            else:
-                actions = clear_actions(item["actions_label"], "absolute")
-        except:
-            print(item["actions_label"])
-            continue
+        cleared, converted = {}, {}
+        for parse_format, position_format in variants:
+            family = "related" if "related" in position_format else "absolute"
+            if family not in cleared:
+                try:
+                    cleared[family] = clear_actions(item["actions_label"], family)
+                except:
+                    print(item["actions_label"])
+                    cleared[family] = None
+            if cleared[family] is None:
+                continue
+
+            if position_format not in converted:
+                actions = cleared[family]
+                if position_format == "related_version1":
+                    actions = convert_related_format_to_related_version1(actions)
+                if position_format == "related_version2":
+                    actions = convert_related_format_to_related_version2(actions)
+                converted[position_format] = actions
+
+            yield (parse_format, position_format), {
+                "uid": item["uid"],
+                "image_id": item["image_id"],
+                "image_size": item["image_size"],
+                "prompt": prompt,
+                "label": label + ACTION_SERIALIZERS[parse_format](converted[position_format]),
+                "parse_format": parse_format,
+                "position_format": position_format
+            }
 
-        if position_format == "related_version1":
-            actions = convert_related_format_to_related_version1(actions)
-        if position_format == "related_version2":
-            actions = convert_related_format_to_related_version2(actions)
-        
-        if parse_format == "JSON": 
-            action_str = action_to_json(actions)
-        elif parse_format == "JSONL": 
-            action_str = action_to_jsonl(actions)
-        elif parse_format == "YAML":
-            action_str = action_to_yaml(actions)
-        elif parse_format == "CSV_String":
-            action_str = action_to_csv_string(actions)
-
-        label += action_str
-
-        instructions.append({
-            "uid": item["uid"],
-            "image_id": item["image_id"],
-            "image_size": item["image_size"],
-            "prompt": prompt,
-            "label": label,
-            "parse_format": parse_format,
-            "position_format": position_format
-        })
-    return instructions
+def iter_guiact_instructions(
+    dataset,
+    dataset_name,
+    use_history=True,
+    use_logs=True,
+    use_thoughts=True,
+    parse_format="CSV_String", # json, jsonl, natural string, yaml
+    position_format="related",
+    dropped=None,
+    ):
+    for _, instruction in iter_guiact_instruction_variants(
+        dataset,
+        dataset_name,
+        [(parse_format, position_format)],
+        use_history=use_history,
+        use_logs=use_logs,
+        use_thoughts=use_thoughts,
+        dropped=dropped,
+        ):
+        yield instruction
+
+def convert_guiact_data_to_instructions(
+    dataset,
+    dataset_name,
+    use_history=True,
+    use_logs=True,
+    use_thoughts=True,
+    parse_format="CSV_String", # json, jsonl, natural string, yaml
+    position_format="related",
+    ):
+    return list(iter_guiact_instructions(
+        dataset,
+        dataset_name,
+        use_history=use_history,
+        use_logs=use_logs,
+        use_thoughts=use_thoughts,
+        parse_format=parse_format,
+        position_format=position_format,
+    ))
+
+
+def _convert_chunk(kind, chunk, kwargs):
+    """
+    Returns a list of (variant, instruction), variant is None for single-format
+    jobs, and the Counter of the records dropped by the coordinate check.
+    """
+    dropped = Counter()
+    if kind == "guienv":
+        return [(None, x) for x in iter_guienv_instructions(chunk, **kwargs)], dropped
+    if "variants" in kwargs:
+        return list(iter_guiact_instruction_variants(chunk, dropped=dropped, **kwargs)), dropped
+    return [(None, x) for x in iter_guiact_instructions(chunk, dropped=dropped, **kwargs)], dropped
+
+def _job_outputs(job):
+    """
+    variant -> output path. With "variants", "output" is a template with
+    {parse_format} and {position_format}.
+    """
+    if "variants" in job["kwargs"]:
+        return {
+            tuple(variant): job["output"].format(parse_format=variant[0], position_format=variant[1])
+            for variant in job["kwargs"]["variants"]
+        }
+    return {None: job["output"]}
+
+def _iter_json_chunks(path, chunk_size):
+    chunk = []
+    for item in iter_json(path):
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def _round_robin(jobs, chunk_size):
+    """
+    Yield (job_id, chunk_id, chunk), taking one chunk of each job in turn.
+    """
+    readers = [(job_id, _iter_json_chunks(job["input"], chunk_size)) for job_id, job in enumerate(jobs)]
+    chunk_ids = [0] * len(jobs)
+    while len(readers) > 0:
+        for reader in list(readers):
+            job_id, chunks = reader
+            chunk = next(chunks, None)
+            if chunk is None:
+                readers.remove(reader)
+                continue
+            yield job_id, chunk_ids[job_id], chunk
+            chunk_ids[job_id] += 1
+
+def run_conversion_jobs(jobs, num_workers=None, chunk_size=1000, stage_cache=None):
+    """
+    Convert several datasets at once. A job is a dict
+    {"kind": "guienv" | "guiact", "input": path, "output": path, "kwargs": {...}},
+    `kwargs` go to `iter_guienv_instructions` / `iter_guiact_instructions`, or to
+    `iter_guiact_instruction_variants` when they contain "variants".
+
+    Every job is split into chunks of `chunk_size` records and the chunks of all
+    jobs are converted in a process pool. The outputs are written in the input
+    order, so they do not depend on `num_workers` (0: convert in this process).
+    With a `StageCache`, jobs whose input, kwargs and code did not change are
+    restored from the cache instead.
+    The records dropped by the coordinate check are summarized once per job.
+    Returns {output path: number of instructions} for each job.
+    """
+    if stage_cache is not None:
+        counts, todo = [None] * len(jobs), []
+        for job_id, job in enumerate(jobs):
+            name = f"sft_instructions {job['output']}"
+            outputs = list(_job_outputs(job).values())
+            key = stage_cache.key(name, [job["input"]], params={"kind": job["kind"], "kwargs": job["kwargs"]}, code=[__file__, JsonWriter])
+            manifest = stage_cache.get(name, key, outputs)
+            if manifest is not None:
+                print(f"{job['input']}: unchanged, restored from {stage_cache.cache_dir}")
+                counts[job_id] = manifest["result"]
+            else:
+                todo.append((job_id, name, key, outputs))
+
+        todo_counts = run_conversion_jobs([jobs[job_id] for job_id, _, _, _ in todo], num_workers, chunk_size)
+        for (job_id, name, key, outputs), job_counts in zip(todo, todo_counts):
+            stage_cache.put(name, key, outputs, job_counts)
+            counts[job_id] = job_counts
+        return counts
+
+    writers = [
+        {variant: JsonWriter(path) for variant, path in _job_outputs(job).items()}
+        for job in jobs
+    ]
+    results = [{} for _ in jobs]
+    dropped = [Counter() for _ in jobs]
+    next_chunk = [0] * len(jobs)
+    submitted = 0
+    flushed = 0
+
+    def _finish(job_id, chunk_id, converted):
+        nonlocal flushed
+        results[job_id][chunk_id], chunk_dropped = converted
+        dropped[job_id].update(chunk_dropped)
+        while next_chunk[job_id] in results[job_id]:
+            for variant, instruction in results[job_id].pop(next_chunk[job_id]):
+                writers[job_id][variant].write(instruction)
+            next_chunk[job_id] += 1
+            flushed += 1
+
+    if num_workers == 0:
+        for job_id, chunk_id, chunk in _round_robin(jobs, chunk_size):
+            _finish(job_id, chunk_id, _convert_chunk(jobs[job_id]["kind"], chunk, jobs[job_id]["kwargs"]))
+    else:
+        num_workers = num_workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {}
+
+            def _collect(return_when):
+                finished, _ = wait(futures, return_when=return_when)
+                for future in finished:
+                    _finish(*futures.pop(future), future.result())
+
+            for job_id, chunk_id, chunk in _round_robin(jobs, chunk_size):
+                # bound the chunks held in memory, including the finished ones
+                # waiting for an earlier chunk of the same job
+                while submitted - flushed >= 2 * num_workers:
+                    _collect(FIRST_COMPLETED)
+                future = executor.submit(_convert_chunk, jobs[job_id]["kind"], chunk, jobs[job_id]["kwargs"])
+                futures[future] = (job_id, chunk_id)
+                submitted += 1
+            while len(futures) > 0:
+                _collect(FIRST_COMPLETED)
+
+    for job, job_dropped in zip(jobs, dropped):
+        print_dropped(job["input"], job_dropped)
+    return [
+        {writer.path: writer.close() for writer in job_writers.values()}
+        for job_writers in writers
+    ]
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser("")
+    parser.add_argument("--num_workers", type=int, default=None, help="default: all cores, 0: convert in this process")
+    parser.add_argument("--chunk_size", type=int, default=1000)
+    parser.add_argument("--all_variants", action="store_true", help="write GUIAct instructions for every parse_format x position_format")
+    parser.add_argument("--cache_dir", default="./.stage_cache", help="skip the files whose input, options and code did not change")
+    parser.add_argument("--no_cache", action="store_true")
+    args = parser.parse_args()
+
+    base_path = "./data/"
+    jobs = []
+
     # convert guienv data to QA instructions
     data_name = "ocr_grounding"
     for tag in ["train_stage1", "train_stage2", 'test']: # "train_stage1", "train_stage2", 'test'
-        base_path = "./data/"
-        path = f"{base_path}/{data_name}_{tag}_data.json"
-        out_path = f"{base_path}/{data_name}_{tag}_sft_instructions.json"
-        data = read_json(path)
-        print(len(data))
-        insturctions = convert_guienv_data_to_instructions(
-            data, 
-            position_format = "related_version1"
-        )
-        write_json(insturctions, out_path)
-
+        jobs.append({
+            "kind": "guienv",
+            "input": f"{base_path}/{data_name}_{tag}_data.json",
+            "output": f"{base_path}/{data_name}_{tag}_sft_instructions.json",
+            "kwargs": {"position_format": "related_version1"},
+        })
 
     # convert guiact data to QA instructions
     for data_name in ["smartphone", "web-single", "web-multi"]:
         for tag in ["train", "test"]:  # "train", "test" 
-            base_path = "./data/"
-            path = f"{base_path}/{data_name}_{tag}_data.json"
-            out_path = f"{base_path}/{data_name}_{tag}_sft_instructions.json"
-            data = read_json(path)
-            print(len(data))
-            insturctions = convert_guiact_data_to_instructions(
-                data, 
-                data_name, 
-                parse_format = "CSV_String", 
-                position_format = "related_version1"
-            )
-            write_json(insturctions, out_path)
\ No newline at end of file
+            if args.all_variants:
+                # one pass per file, one output per variant
+                jobs.append({
+                    "kind": "guiact",
+                    "input": f"{base_path}/{data_name}_{tag}_data.json",
+                    "output": f"{base_path}/{data_name}_{tag}_{{parse_format}}_{{position_format}}_sft_instructions.json",
+                    "kwargs": {
+                        "dataset_name": data_name,
+                        "variants": [(x, y) for x in PARSE_FORMATS for y in POSITION_FORMATS],
+                    },
+                })
+                continue
+            jobs.append({
+                "kind": "guiact",
+                "input": f"{base_path}/{data_name}_{tag}_data.json",
+                "output": f"{base_path}/{data_name}_{tag}_sft_instructions.json",
+                "kwargs": {
+                    "dataset_name": data_name,
+                    "parse_format": "CSV_String",
+                    "position_format": "related_version1",
+                },
+            })
+
+    # all (dataset, split) jobs run concurrently, the outputs keep the input order
+    stage_cache = None if args.no_cache else StageCache(args.cache_dir)
+    counts = run_conversion_jobs(jobs, num_workers=args.num_workers, chunk_size=args.chunk_size, stage_cache=stage_cache)
+    for job_counts in counts:
+        for out_path, num in job_counts.items():
+            print(out_path, num)
@@ -1,146 +1,190 @@
 import json
 import re
+import os
+import glob
+import random
+import argparse
 
-def read_json(path):
-    with open(path, 'r', encoding='utf8') as f:
-        data = json.loads(f.read())
-    return data
-
-def write_json(data, path):
-    with open(path, 'w', encoding='utf8') as f:
-        f.write(json.dumps(data, ensure_ascii=False, indent=4))
+import sys
+sys.path.append('..')
+from json_io import read_json, write_json, iter_json, iter_jsonl_shards, dumps
+from utils import convert_tags_to_qwen_format
+from qwen_format import guienv_to_qwen_format, guiact_to_qwen_format, guichat_to_qwen_format
+from stage_cache import StageCache
 
 
 def convert_guienv_to_qwen_format(data, image2path):
-    new_data = []
-    for item in data:
-        conversations = []
-
-        question = item["prompt"]
-        answer = item["label"]
-
-        path = image2path[item["image_id"]]
-        question = f"<img>{path}</img>" + question
-
-        for pos in re.findall(r"<box>(.*?)</box>", question):
-            x1, y1, x2, y2 = pos.strip().split()
-            question = question.replace(f"<box>{pos}</box>", f"<box>({x1},{y1}),({x2},{y2})</box>")
-
-        for pos in re.findall(r"<box>(.*?)</box>", answer):
-            x1, y1, x2, y2 = pos.strip().split()
-            answer = answer.replace(f"<box>{pos}</box>", f"<box>({x1},{y1}),({x2},{y2})</box>")
-
-        conversations = [
-            {
-                "from": "user",
-                "value": question
-            },
-            {
-                "from": "assistant",
-                "value": answer
-            }
-        ]
-
-        new_data.append({
-            "id": item["uid"],
-            "conversations": conversations
-        })
-    return new_data
+    return [guienv_to_qwen_format(item, image2path) for item in data]
 
 def convert_guiact_to_qwen_format(data, data_type, image2path):
-    new_data = []
-    for item in data:
-        image_id = item["image_id"]
-        path = image2path[image_id]
-
-        question = f"<img>{path}</img>\n" + item["prompt"]
-        answer = item["label"]
-
-        for pos in re.findall(r"<point>(.*?)</point>", answer):
-            x1, y1 = pos.strip().split()
-            answer = answer.replace(f"<point>{pos}</point>", f"<point>({x1},{y1})</point>")
-            
-        for pos in re.findall(r"<box>(.*?)</box>", answer):
-            x1, y1, x2, y2 = pos.strip().split()
-            answer = answer.replace(f"<box>{pos}</box>", f"<box>({x1},{y1}),({x2},{y2})</box>")
-
-        conversations = [
-            {
-                "from": "user",
-                "value": question
-            },
-            {
-                "from": "assistant",
-                "value": answer
-            }
-        ]
-
-        new_data.append({
-            "id": item["uid"],
-            "type": data_type,
-            "conversations": conversations
-        })
-    return new_data
+    return [guiact_to_qwen_format(item, data_type, image2path) for item in data]
 
 def convert_guichat_to_qwen_format(data, image_id2path):
-    new_data = []
-    for item in data:
-        conversations = []
-        for content in item["text"]:
-            if content["from"] == "human":
-                res_from = "user"
-            elif content["from"] == "gpt":
-                res_from = "assistant"
-            else:
-                print(content["from"])
-            
-            res_value = content["value"]
-            for x in re.findall(r"<image>(.*?)</image>", res_value):
-                path = image_id2path[x]
-                res_value = res_value.replace(f"<image>{x}</image>", f"<img>{path}</img>")
-
-            for pos in re.findall(r"<box>(.*?)</box>", res_value):
-                x1, y1, x2, y2 = pos.strip().split()
-                res_value = res_value.replace(f"<box>{pos}</box>", f"<box>({x1},{y1}),({x2},{y2})</box>")
-
-            conversations.append({
-                "from": res_from,
-                "value": res_value
-            })
-
-        new_data.append({
-            "id": item["uid"],
-            "conversations": conversations
-        })
-    return new_data
+    return [guichat_to_qwen_format(item, image_id2path) for item in data]
 
-if __name__ == "__main__":
-    all_instructions = []
 
+# (converter, instructions, image_id2path, extra arguments of the converter)
+SOURCES = [
     # guienv
-    tag = "train_stage2" 
-    ins_data = read_json(f"./data/ocr_grounding_{tag}_sft_instructions.json")
-    image2path = read_json(f"./images/guienv/image_id2path.json")
-    new_data = convert_guienv_to_qwen_format(ins_data, image2path)
-    all_instructions.extend(new_data)
-
+    ("guienv", "./data/ocr_grounding_train_stage2_sft_instructions.json", "./images/guienv/image_id2path.json", ()),
     # guiact
-    tag = "train" 
-    for data_name in ["smartphone", "web-single", "web-multi"]:
-        ins_data = read_json(f"./data/{data_name}_{tag}_sft_instructions.json")
-        image2path = read_json(f"./images/guiact/{data_name}/image_id2path.json")
-        new_data = convert_guiact_to_qwen_format(ins_data, data_name, image2path)
-        all_instructions.extend(new_data)
-
+    ("guiact", "./data/smartphone_train_sft_instructions.json", "./images/guiact/smartphone/image_id2path.json", ("smartphone",)),
+    ("guiact", "./data/web-single_train_sft_instructions.json", "./images/guiact/web-single/image_id2path.json", ("web-single",)),
+    ("guiact", "./data/web-multi_train_sft_instructions.json", "./images/guiact/web-multi/image_id2path.json", ("web-multi",)),
     # guichat
-    ins_data = read_json(f"./data/guichat_data.json")
-    image2path = read_json(f"./images/guiact/image_id2path.json")
-    new_data = convert_guichat_to_qwen_format(ins_data, image2path)
-    all_instructions.extend(new_data)
-
-    print(len(all_instructions))
-    import random
-    random.seed(0)
-    random.shuffle(all_instructions)
-    write_json(all_instructions, "training_data_qwen.json")
-    
+    ("guichat", "./data/guichat_data.json", "./images/guiact/image_id2path.json", ()),
+]
+
+def iter_qwen_records(sources=SOURCES):
+    """
+    Stream the converted records of all sources, one source at a time.
+    """
+    for kind, path, image2path_path, args in sources:
+        image2path = read_json(image2path_path)
+        for item in iter_json(path):
+            if kind == "guienv":
+                yield guienv_to_qwen_format(item, image2path)
+            elif kind == "guiact":
+                yield guiact_to_qwen_format(item, *args, image2path)
+            else:
+                yield guichat_to_qwen_format(item, image2path)
+
+
+KEY_WIDTH = 16  # 64-bit sort keys as fixed-width hex
+
+def _spill(lines, bucket_paths, bit_offset, bucket_bits):
+    files = [open(path, "w", encoding="utf8") for path in bucket_paths]
+    shift = 64 - bit_offset - bucket_bits
+    mask = (1 << bucket_bits) - 1
+    for line in lines:
+        files[(int(line[:KEY_WIDTH], 16) >> shift) & mask].write(line)
+    for f in files:
+        f.close()
+
+def _sorted_lines(path, bit_offset, memory_budget, bucket_bits):
+    """
+    Yield the lines of a bucket file sorted by key. A bucket larger than
+    `memory_budget` is split again on the next key bits first.
+    """
+    if os.path.getsize(path) <= memory_budget or bit_offset + bucket_bits > 64:
+        with open(path, "r", encoding="utf8") as f:
+            lines = f.readlines()
+        os.remove(path)
+        lines.sort()
+        yield from lines
+        return
+
+    sub_paths = [f"{path}.{i}" for i in range(1 << bucket_bits)]
+    with open(path, "r", encoding="utf8") as f:
+        _spill(f, sub_paths, bit_offset, bucket_bits)
+    os.remove(path)
+    for sub_path in sub_paths:
+        yield from _sorted_lines(sub_path, bit_offset + bucket_bits, memory_budget, bucket_bits)
+
+def external_shuffle(
+    records,
+    out_dir,
+    seed=0,
+    samples_per_shard=10000,
+    memory_budget=1 << 30,
+    bucket_bits=6,
+    ):
+    """
+    Shuffle a stream of records out of core into JSONL shards
+    `out_dir/part-xxxxx.jsonl` plus `out_dir/index.json`.
+
+    Every record gets a seeded random 64-bit key and is spilled to one of
+    2**bucket_bits bucket files by the top bits of the key. The buckets are
+    sorted by key in memory one by one, a bucket file larger than
+    `memory_budget` bytes is split again on the next bits. The order is the
+    global key order: it only depends on `seed` and the input order, not on the
+    budget or the number of buckets.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for old_path in glob.glob(os.path.join(out_dir, "part-*.jsonl")):
+        os.remove(old_path)
+
+    rng = random.Random(seed)
+    spill_dir = os.path.join(out_dir, f".spill.{os.getpid()}")
+    os.makedirs(spill_dir, exist_ok=True)
+    bucket_paths = [os.path.join(spill_dir, f"bucket-{i}") for i in range(1 << bucket_bits)]
+    lines = (
+        "{:016x}{}\n".format(rng.getrandbits(64), dumps(record))
+        for record in records
+    )
+    _spill(lines, bucket_paths, 0, bucket_bits)
+
+    shards = []
+    f = None
+    for bucket_path in bucket_paths:
+        for line in _sorted_lines(bucket_path, bucket_bits, memory_budget, bucket_bits):
+            if f is None or shards[-1]["num_samples"] >= samples_per_shard:
+                if f is not None:
+                    f.close()
+                    os.replace(tmp_path, shard_path)
+                name = "part-{:05d}.jsonl".format(len(shards))
+                shard_path = os.path.join(out_dir, name)
+                tmp_path = f"{shard_path}.tmp"
+                f = open(tmp_path, "w", encoding="utf8")
+                shards.append({"path": name, "num_samples": 0})
+            f.write(line[KEY_WIDTH:])
+            shards[-1]["num_samples"] += 1
+    if f is not None:
+        f.close()
+        os.replace(tmp_path, shard_path)
+    os.rmdir(spill_dir)
+
+    index = {"format": "jsonl", "num_samples": sum(x["num_samples"] for x in shards), "shards": shards}
+    write_json(index, os.path.join(out_dir, "index.json"), indent=4)
+    return index
+
+def merge_all(out_dir, seed=0, output=None, samples_per_shard=10000, memory_budget=1 << 30):
+    """
+    Convert and shuffle all sources into JSONL shards in `out_dir`,
+    `output` also gets the shuffled records as a single JSON file.
+    """
+    index = external_shuffle(
+        iter_qwen_records(),
+        out_dir,
+        seed=seed,
+        samples_per_shard=samples_per_shard,
+        memory_budget=memory_budget,
+    )
+    print(index["num_samples"])
+    if output:
+        write_json(iter_jsonl_shards(out_dir), output)
+    return index["num_samples"]
+
+MERGE_INPUTS = [path for _, ins_path, image2path_path, _ in SOURCES for path in (ins_path, image2path_path)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("")
+    parser.add_argument("--output_dir", default="./training_data_qwen", help="shuffled JSONL shards")
+    parser.add_argument("--output", default="training_data_qwen.json", help="also write a single JSON file, \"\" to skip")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--samples_per_shard", type=int, default=10000)
+    parser.add_argument("--memory_budget", type=float, default=1.0, help="GB of records sorted in memory at once")
+    parser.add_argument("--cache_dir", default="./.stage_cache", help="skip the merge when its inputs and code did not change")
+    parser.add_argument("--no_cache", action="store_true")
+    args = parser.parse_args()
+
+    def _merge():
+        return merge_all(
+            args.output_dir,
+            seed=args.seed,
+            output=args.output,
+            samples_per_shard=args.samples_per_shard,
+            memory_budget=int(args.memory_budget * 2**30),
+        )
+
+    if args.no_cache:
+        _merge()
+    else:
+        StageCache(args.cache_dir).run(
+            f"merge_data {args.output_dir}",
+            _merge,
+            inputs=MERGE_INPUTS,
+            outputs=[args.output_dir] + ([args.output] if args.output else []),
+            params={"seed": args.seed, "samples_per_shard": args.samples_per_shard},
+            code=[__file__, convert_tags_to_qwen_format, guienv_to_qwen_format, write_json],
+        )
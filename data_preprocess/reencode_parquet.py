@@ -0,0 +1,120 @@
+import os
+import json
+import argparse
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import sys
+sys.path.append('..')
+from image_store import image_bytes_from_row
+
+
+def _binary_schema(schema):
+    """
+    Replace the `base64` field by a `binary` field, keep the pandas metadata
+    consistent so `pd.read_parquet` still restores the `image_id` index.
+    """
+    fields = [
+        pa.field("binary", pa.binary()) if field.name == "base64" else field
+        for field in schema
+    ]
+    metadata = dict(schema.metadata or {})
+    if b"pandas" in metadata:
+        pandas_metadata = json.loads(metadata[b"pandas"])
+        for column in pandas_metadata["columns"]:
+            if column["name"] == "base64":
+                column["name"] = "binary"
+                column["field_name"] = "binary"
+                column["pandas_type"] = "bytes"
+                column["numpy_type"] = "object"
+        metadata[b"pandas"] = json.dumps(pandas_metadata).encode("utf8")
+    return pa.schema(fields, metadata=metadata)
+
+
+def _reencode_table(table, schema):
+    images = [
+        image_bytes_from_row({"base64": value})
+        for value in table.column("base64").to_pylist()
+    ]
+    columns = [
+        pa.array(images, pa.binary()) if name == "base64" else table.column(name)
+        for name in table.column_names
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def reencode_parquet(
+    in_path,
+    out_path,
+    row_group_size=256,
+    compression="zstd",
+    compression_level=3,
+    ):
+    """
+    Rewrite an images parquet file with raw image bytes in a `binary` column.
+
+    Small row groups keep point lookups in `ImageStore` cheap, zstd shrinks the
+    other columns (the JPEG bytes themselves barely compress).
+    """
+    in_size = os.path.getsize(in_path)
+    parquet_file = pq.ParquetFile(in_path)
+    if "base64" not in parquet_file.schema_arrow.names:
+        print(f"{in_path} has no base64 column, skip.")
+        return
+
+    schema = _binary_schema(parquet_file.schema_arrow)
+    other_columns = [name for name in schema.names if name != "binary"]
+
+    tmp_path = f"{out_path}.tmp"
+    writer = pq.ParquetWriter(
+        tmp_path,
+        schema,
+        compression=compression,
+        compression_level=compression_level,
+        use_dictionary=other_columns,
+        write_statistics=other_columns,
+    )
+
+    pending, pending_rows = [], 0
+    for batch in parquet_file.iter_batches(batch_size=row_group_size):
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        if pending_rows >= row_group_size:
+            table = pa.Table.from_batches(pending)
+            writer.write_table(_reencode_table(table, schema), row_group_size=row_group_size)
+            pending, pending_rows = [], 0
+    if pending_rows > 0:
+        table = pa.Table.from_batches(pending)
+        writer.write_table(_reencode_table(table, schema), row_group_size=row_group_size)
+    writer.close()
+
+    os.replace(tmp_path, out_path)
+    out_size = os.path.getsize(out_path)
+    print(f"{in_path}: {in_size / 2**20:.1f}MB -> {out_path}: {out_size / 2**20:.1f}MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("")
+    parser.add_argument("--input", nargs="+", default=["./data/ocr_grounding_test_images.parquet"])
+    parser.add_argument("--output_dir", default=None, help="default: next to the input with the suffix `_binary`")
+    parser.add_argument("--inplace", action="store_true", help="replace the input files")
+    parser.add_argument("--row_group_size", type=int, default=256)
+    parser.add_argument("--compression_level", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    for in_path in args.input:
+        if args.inplace:
+            out_path = in_path
+        elif args.output_dir is not None:
+            out_path = os.path.join(args.output_dir, os.path.basename(in_path))
+        else:
+            out_path = in_path.replace(".parquet", "_binary.parquet")
+        reencode_parquet(
+            in_path,
+            out_path,
+            row_group_size=args.row_group_size,
+            compression_level=args.compression_level,
+        )
@@ -0,0 +1,43 @@
+import argparse
+
+import sys
+sys.path.append('..')
+from shards import write_shards
+from json_io import read_json, iter_json
+
+def attach_image_paths(records, image_id2path):
+    """
+    Instruction records (e.g. the test sets used by infer.py) refer to their
+    screenshot by `image_id`, store the image with the record.
+    """
+    for record in records:
+        if "image_id" in record and "image_path" not in record:
+            record = dict(record, image_path=image_id2path[record["image_id"]])
+        yield record
+
+
+if __name__ == "__main__":
+    """
+    python write_shards.py --input training_data_qwen.json --output_dir ./shards/training_data_qwen
+    python write_shards.py --input ./data/smartphone_test_sft_instructions.json \
+        --image_id2path ./images/guiact/smartphone/image_id2path.json --output_dir ./shards/smartphone_test
+    """
+    parser = argparse.ArgumentParser("")
+    parser.add_argument("--input", default="training_data_qwen.json")
+    parser.add_argument("--output_dir", default="./shards/training_data_qwen")
+    parser.add_argument("--image_id2path", default=None)
+    parser.add_argument("--image_root", default=".")
+    parser.add_argument("--samples_per_shard", type=int, default=1000)
+    args = parser.parse_args()
+
+    records = iter_json(args.input)
+    if args.image_id2path is not None:
+        records = attach_image_paths(records, read_json(args.image_id2path))
+
+    index = write_shards(
+        records,
+        args.output_dir,
+        samples_per_shard=args.samples_per_shard,
+        image_root=args.image_root,
+    )
+    print(f"{index['num_samples']} samples, {len(index['shards'])} shards")
@@ -0,0 +1,136 @@
+import os
+import numpy as np
+import pyarrow.parquet as pq
+
+from image_store import _index_column_name, _file_signature
+
+
+ELEMENT_FIELDS = ["uid", "x", "y", "width", "height"]
+
+
+def _element_keys(element):
+    id_key = "uid" if "uid" in element else "id"
+    rect_key = "rect" if "rect" in element else "position"
+    return id_key, rect_key
+
+
+def _element_to_row(element, id_key, rect_key):
+    rect = element[rect_key]
+    x = rect["x"] if "x" in rect else rect["left"]
+    y = rect["y"] if "y" in rect else rect["top"]
+    width = rect["width"] if "width" in rect else rect["right"] - rect["left"]
+    height = rect["height"] if "height" in rect else rect["bottom"] - rect["top"]
+    return int(element[id_key]), x, y, width, height
+
+
+def extract_elements(parquet_path, out_path=None):
+    """
+    Write the `elements` column of an images parquet file to a compact sidecar:
+    flat uid/x/y/width/height arrays for all elements plus per-image offsets.
+    The base64 column is never read.
+    """
+    if out_path is None:
+        out_path = f"{parquet_path}.elements.npz"
+
+    parquet_file = pq.ParquetFile(parquet_path)
+    index_column = _index_column_name(parquet_file)
+
+    image_ids = []
+    offsets = [0]
+    rows = []
+    id_key, rect_key = "uid", "rect"
+    for row_group in range(parquet_file.num_row_groups):
+        table = parquet_file.read_row_group(row_group, columns=[index_column, "elements"])
+        for image_id, elements in zip(table.column(index_column).to_pylist(), table.column("elements").to_pylist()):
+            elements = elements or []
+            if len(rows) == 0 and len(elements) > 0:
+                id_key, rect_key = _element_keys(elements[0])
+            rows.extend(_element_to_row(e, id_key, rect_key) for e in elements)
+            image_ids.append(image_id)
+            offsets.append(len(rows))
+
+    columns = list(zip(*rows)) if len(rows) > 0 else [[] for _ in ELEMENT_FIELDS]
+    signature = _file_signature(parquet_path)
+    tmp_path = f"{out_path}.tmp.npz"
+    np.savez(
+        tmp_path,
+        image_ids=np.frombuffer("\n".join(image_ids).encode("utf8"), dtype=np.uint8),
+        offsets=np.asarray(offsets, dtype=np.int64),
+        uid=np.asarray(columns[0], dtype=np.int64),
+        x=np.asarray(columns[1], dtype=np.float64),
+        y=np.asarray(columns[2], dtype=np.float64),
+        width=np.asarray(columns[3], dtype=np.float64),
+        height=np.asarray(columns[4], dtype=np.float64),
+        keys=np.asarray([id_key, rect_key]),
+        signature=np.asarray([signature["size"], signature["mtime_ns"]], dtype=np.int64),
+    )
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+class _ElementsLocator:
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, image_id):
+        return {"elements": self.store.elements(image_id)}
+
+
+class ElementsStore:
+    """
+    Read-only view of an elements sidecar written by `extract_elements`.
+
+    `store.loc[image_id]["elements"]` rebuilds the element dicts (id and
+    rect/position only), so a store can replace `cur_df` in
+    `process_guiact_results`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with np.load(path) as data:
+            self.image_ids = bytes(data["image_ids"]).decode("utf8").split("\n")
+            self.offsets = data["offsets"]
+            self.fields = {name: data[name] for name in ELEMENT_FIELDS}
+            self.id_key, self.rect_key = [str(x) for x in data["keys"]]
+            self.signature = tuple(int(x) for x in data["signature"])
+        if len(self.offsets) == 1:
+            self.image_ids = []
+        self.positions = {image_id: i for i, image_id in enumerate(self.image_ids)}
+        self.loc = _ElementsLocator(self)
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __contains__(self, image_id):
+        return image_id in self.positions
+
+    def elements(self, image_id):
+        i = self.positions[image_id]
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        uid, x, y, width, height = [self.fields[name][start:end].tolist() for name in ELEMENT_FIELDS]
+
+        elements = []
+        for e_uid, e_x, e_y, e_w, e_h in zip(uid, x, y, width, height):
+            rect = {"x": e_x, "y": e_y, "width": e_w, "height": e_h}
+            if self.rect_key == "rect":
+                rect.update({"left": e_x, "top": e_y, "right": e_x + e_w, "bottom": e_y + e_h})
+            elements.append({self.id_key: e_uid, self.rect_key: rect})
+        return elements
+
+
+def load_elements(parquet_path, sidecar_path=None):
+    """
+    Load the elements sidecar of an images parquet file, (re)building it when it
+    is missing or older than the parquet file.
+    """
+    if sidecar_path is None:
+        sidecar_path = f"{parquet_path}.elements.npz"
+    if os.path.exists(sidecar_path):
+        store = ElementsStore(sidecar_path)
+        if not os.path.exists(parquet_path):
+            return store
+        signature = _file_signature(parquet_path)
+        if store.signature == (signature["size"], signature["mtime_ns"]):
+            return store
+    extract_elements(parquet_path, sidecar_path)
+    return ElementsStore(sidecar_path)
@@ -20,6 +20,10 @@ from eval_single_action import (
 
 from data_visualization import draw_rectangle, actions_visual
 from data_load import read_image_from_qarquet
+from image_cache import decoded_image_cache
+from image_store import ImageStore
+from elements_store import load_elements
+from json_io import read_json, write_json
 
 def visualize_text2bbox_error_sample(path, cur_image, pred_boxes, label_boxes):
     draw = ImageDraw.Draw(cur_image)
@@ -40,17 +44,12 @@ def visualize_task2action_error_sample(path, cur_image, prompt, pred_action_grou
     cur_image.save(f"{path}_pred.png")
 
 
-def read_json(path):
-    with open(path, 'r', encoding='utf8') as f:
-        data = json.loads(f.read())
-    return data
-
-def read_parquet(path):
-    return pd.read_parquet(path, columns=None)
-
-def write_to_json(data, path):
-    with open(path, "w", encoding='utf8') as f:
-        f.write(json.dumps(data, ensure_ascii=False, indent=4))
+def read_parquet(path, lazy=False):
+    if lazy:
+        return ImageStore(path)
+    cur_df = pd.read_parquet(path, columns=None)
+    cur_df.attrs["path"] = os.path.abspath(path)
+    return cur_df
 
 def eval_guienv_prediction_file(
     pred_data,
@@ -173,6 +172,8 @@ def eval_guienv_prediction_file(
     logs += f"score_text2bbox_iou@0.7: {score_text2bbox_iou07}\n"
     logs += f"score_text2bbox_iou@0.9: {score_text2bbox_iou09}\n"
     logs += f"text2bbox_num: {text2bbox_num}\n\n"
+    if visualize_error_samples:
+        logs += f"image_cache: {decoded_image_cache.stats()}\n"
 
     if output_path is not None:
         with open(f"{output_path}/results.log", "w", encoding='utf8') as f:
@@ -181,8 +182,8 @@ def eval_guienv_prediction_file(
         print(logs)
 
     if log_error_samples:
-        write_to_json(error_text, f"{output_path}/bbox2text_error.json")
-        write_to_json(error_bbox, f"{output_path}/text2bbox_error.json")
+        write_json(error_text, f"{output_path}/bbox2text_error.json", indent=4)
+        write_json(error_bbox, f"{output_path}/text2bbox_error.json", indent=4)
 
 
 def eval_guiact_prediction_file(
@@ -297,6 +298,8 @@ def eval_guiact_prediction_file(
     logs += f"action_num: {action_num}\n"
     logs += str(score_action_split) + "\n"
     logs += str(action_split_num) + "\n"
+    if visualize_error_samples:
+        logs += f"image_cache: {decoded_image_cache.stats()}\n"
     # breakpoint()
     if output_path is not None:
         with open(f"{output_path}/results.log", "w", encoding='utf8') as f:
@@ -305,25 +308,25 @@ def eval_guiact_prediction_file(
         print(logs)
 
     if log_error_samples:
-        write_to_json(error_action, f"{output_path}/task2action_error.json")
+        write_json(error_action, f"{output_path}/task2action_error.json", indent=4)
 
 
 def one_file_evaluation(file_name, task):
     if task == "guienv":
         label_data = read_json("../data/ocr_grounding_test_data.json")
-        cur_df = read_parquet("../data/ocr_grounding_test_images.parquet")
+        cur_df = read_parquet("../data/ocr_grounding_test_images.parquet", lazy=True)
 
     elif task == "guiact_web_single":
         label_data = read_json("../data/web-single_test_data.json")
-        cur_df = read_parquet("../data/web-single_test_images.parquet")
+        cur_df = read_parquet("../data/web-single_test_images.parquet", lazy=True)
 
     elif task == "guiact_web_multi":
         label_data = read_json("../data/web-multi_test_data.json")
-        cur_df = read_parquet("../data/web-multi_test_images.parquet")
+        cur_df = read_parquet("../data/web-multi_test_images.parquet", lazy=True)
     
     elif task == "guiact_smartphone":
         label_data = read_json("../data/smartphone_test_data.json")
-        cur_df = read_parquet("../data/smartphone_test_images.parquet")
+        cur_df = read_parquet("../data/smartphone_test_images.parquet", lazy=True)
 
     else:
         print("unsupported task.")
@@ -341,7 +344,9 @@ def one_file_evaluation(file_name, task):
             visualize_error_samples=False) 
 
     elif "guiact" in task:
-        pred_data = process_guiact_results(pred_results, label_data, cur_df)
+        # only the elements are needed here, read them from the sidecar instead of the images
+        elements_df = load_elements(cur_df.path)
+        pred_data = process_guiact_results(pred_results, label_data, elements_df)
         eval_guiact_prediction_file(
             pred_data,
             label_data,
@@ -196,6 +196,10 @@ def convert_pred_string_to_action_group(
     return action_group
     
 def process_guiact_results(pred_results, label_data, cur_df):
+    """
+    cur_df: anything with `cur_df.loc[image_id]["elements"]`, e.g. the images
+    DataFrame or an `ElementsStore` sidecar.
+    """
     new_res = {}
     pred_dict = convert_list_to_dict(pred_results)
 
@@ -0,0 +1,104 @@
+import os
+import functools
+from collections import OrderedDict
+
+
+def image_nbytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+def image_source_key(cur_df):
+    """
+    Identify the parquet file behind a `cur_df` (DataFrame or ImageStore).
+    """
+    attrs = getattr(cur_df, "attrs", None)
+    if attrs is not None:
+        return attrs.get("path", id(cur_df))
+    path = getattr(cur_df, "path", None)
+    return os.path.abspath(path) if path is not None else id(cur_df)
+
+
+class DecodedImageCache:
+    """
+    LRU cache of decoded PIL images, bounded by the total pixel bytes.
+
+    Cached images are never handed out directly, callers get a copy and can
+    draw on it freely.
+    """
+
+    def __init__(self, max_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.images)
+
+    def get(self, key):
+        image = self.images.get(key)
+        if image is None:
+            self.misses += 1
+            return None
+        self.images.move_to_end(key)
+        self.hits += 1
+        return image.copy()
+
+    def put(self, key, image):
+        nbytes = image_nbytes(image)
+        if nbytes > self.max_bytes:
+            return
+        if key in self.images:
+            self.total_bytes -= image_nbytes(self.images.pop(key))
+        self.images[key] = image
+        self.total_bytes += nbytes
+        while self.total_bytes > self.max_bytes:
+            _, old_image = self.images.popitem(last=False)
+            self.total_bytes -= image_nbytes(old_image)
+            self.evictions += 1
+
+    def clear(self):
+        self.images.clear()
+        self.total_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.images),
+            "bytes": self.total_bytes,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+    def wrap(self, fn, key_fn=None):
+        """
+        Cache the images returned by `fn`. The key is `key_fn(*args, **kwargs)`,
+        by default the positional arguments, e.g. the base64 string for
+        `decode_base64_to_image`.
+        """
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = key_fn(*args, **kwargs) if key_fn is not None else args
+            image = self.get(key)
+            if image is not None:
+                return image
+            image = fn(*args, **kwargs)
+            self.put(key, image)
+            return image.copy()
+        wrapper.cache = self
+        return wrapper
+
+    def __call__(self, fn=None, key_fn=None):
+        """
+        Use as `@cache` or `@cache(key_fn=...)`.
+        """
+        if fn is None:
+            return functools.partial(self.wrap, key_fn=key_fn)
+        return self.wrap(fn, key_fn)
+
+
+decoded_image_cache = DecodedImageCache()
@@ -0,0 +1,151 @@
+import os
+import json
+import base64
+import binascii
+import pyarrow.parquet as pq
+
+
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+]
+
+
+def sniff_image_format(data):
+    """
+    Return the image format of raw bytes, or None if they are not an image.
+    """
+    for signature, image_format in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return image_format
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def image_bytes_from_row(row):
+    """
+    Raw image bytes of a parquet row, whatever the encoding of the split:
+    - `binary` column (written by `reencode_parquet.py`): raw bytes
+    - `base64` column with raw bytes (GUIChat)
+    - `base64` column with base64 text (GUIEnv, GUIAct), standard or URL-safe
+      alphabet
+    """
+    if "binary" in row:
+        return row["binary"]
+    value = row["base64"]
+    if isinstance(value, (bytes, bytearray)) and sniff_image_format(value) is not None:
+        return value
+    # b64decode would silently drop the `-` and `_` of the URL-safe alphabet
+    try:
+        return base64.b64decode(value, validate=True)
+    except binascii.Error:
+        return base64.urlsafe_b64decode(value)
+
+
+def _index_column_name(parquet_file):
+    """
+    The parquet files are written by pandas with `image_id` as the index,
+    pandas keeps the name of that column in the schema metadata.
+    """
+    metadata = parquet_file.schema_arrow.metadata or {}
+    if b"pandas" in metadata:
+        index_columns = json.loads(metadata[b"pandas"])["index_columns"]
+        if len(index_columns) > 0 and isinstance(index_columns[0], str):
+            return index_columns[0]
+    return "image_id"
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+class _RowLocator:
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, image_id):
+        return self.store.read_row(image_id)
+
+
+class ImageStore:
+    """
+    Lazy, point-lookup access to a `*_images.parquet` file.
+
+    Only the row group holding the requested image is read. The
+    `image_id -> (row_group, row)` index is kept in a sidecar file
+    (`<path>.index.json` by default) and rebuilt when the parquet file changes.
+
+    `store.loc[image_id]` returns the row as a dict, so a store can be passed
+    wherever a `cur_df` from `read_parquet` is expected.
+    """
+
+    def __init__(self, path, columns=None, index_path=None):
+        self.path = path
+        self.columns = columns
+        self.index_path = index_path if index_path is not None else f"{path}.index.json"
+        self.parquet_file = pq.ParquetFile(path)
+        self.index_column = _index_column_name(self.parquet_file)
+        self.locations = self._load_or_build_index()
+        self.loc = _RowLocator(self)
+        self._row_group_id = None
+        self._row_group = None
+
+    def _load_or_build_index(self):
+        signature = _file_signature(self.path)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf8") as f:
+                sidecar = json.loads(f.read())
+            if sidecar["signature"] == signature and sidecar["index_column"] == self.index_column:
+                return {k: tuple(v) for k, v in sidecar["locations"].items()}
+
+        locations = {}
+        for row_group in range(self.parquet_file.num_row_groups):
+            ids = self.parquet_file.read_row_group(row_group, columns=[self.index_column]).column(0).to_pylist()
+            for row, image_id in enumerate(ids):
+                locations[image_id] = (row_group, row)
+
+        sidecar = {
+            "signature": signature,
+            "index_column": self.index_column,
+            "locations": locations,
+        }
+        # a read-only data dir just means the index is rebuilt next time
+        try:
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "w", encoding="utf8") as f:
+                f.write(json.dumps(sidecar, ensure_ascii=False))
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            print(f"warning: can not write the index sidecar {self.index_path}")
+        return locations
+
+    @property
+    def index(self):
+        return list(self.locations.keys())
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, image_id):
+        return image_id in self.locations
+
+    def _read_row_group(self, row_group):
+        # consecutive samples usually hit the same row group, keep the last one
+        if self._row_group_id != row_group:
+            self._row_group = self.parquet_file.read_row_group(row_group, columns=self.columns)
+            self._row_group_id = row_group
+        return self._row_group
+
+    def read_row(self, image_id):
+        row_group, row = self.locations[image_id]
+        table = self._read_row_group(row_group)
+        return {
+            name: table.column(name)[row].as_py()
+            for name in table.column_names
+            if name != self.index_column
+        }
@@ -0,0 +1,276 @@
+import os
+import re
+import json
+import gzip
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def _strip_compression(path):
+    for suffix in (".gz", ".zst"):
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def is_jsonl(path):
+    return _strip_compression(path).endswith(".jsonl")
+
+
+def open_text(path, mode="r"):
+    """
+    Open a text file, `.gz` and `.zst` files are (de)compressed on the fly.
+    """
+    mode = mode.replace("t", "")
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf8")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError("reading/writing .zst files requires `pip install zstandard`")
+        return zstandard.open(path, mode + "t", encoding="utf8")
+    return open(path, mode, encoding="utf8")
+
+
+def _tmp_path(path):
+    # keep the suffix, open_text picks the compression from it
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, f".{basename}.{os.getpid()}.tmp{os.path.splitext(basename)[1]}")
+
+
+def loads(s):
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
+
+
+# a JSON string, or a float `json.dumps` writes differently from orjson
+_FLOAT_PATTERN = re.compile(r'"(?:[^"\\]|\\.)*"|(-?\d+(?:\.\d+)?e-\d+|NaN|-?Infinity)')
+
+
+def _orjson_float(match):
+    text = match.group(1)
+    if text is None:
+        return match.group(0)
+    if text in ("NaN", "Infinity", "-Infinity"):
+        return "null"
+    mantissa, exponent = text.split("e")
+    if int(exponent) == -5:
+        # orjson writes 1e-5 <= |x| < 1e-4 in decimal, repr does not
+        sign, digits = ("-", mantissa[1:]) if mantissa.startswith("-") else ("", mantissa)
+        return f"{sign}0.0000{digits.replace('.', '')}"
+    return f"{mantissa}e{int(exponent)}"
+
+
+def _numpy_default(obj):
+    if type(obj).__module__ != "numpy":
+        raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+    if obj.dtype.kind == "f" and obj.dtype.itemsize < 8:
+        # the shortest digits of the float32 value, like orjson
+        return obj.astype(str).astype(float).tolist()
+    return obj.tolist()
+
+
+_COMPACT_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"), default=_numpy_default)
+
+
+def dumps(obj, indent=None):
+    """
+    ensure_ascii=False, uses orjson when it is installed (compact or indent=2).
+    The json fallback writes the same text as orjson: compact separators,
+    orjson's float format (NaN/Infinity as null), numpy arrays and scalars.
+    orjson before 3.12 wrote floats from 1e16 on without the "+" of the
+    exponent (1e16, not 1e+16).
+    """
+    if orjson is not None and indent in (None, 2):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if indent == 2:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option).decode("utf8")
+    if indent is None:
+        text = _COMPACT_ENCODER.encode(obj)
+    else:
+        text = json.dumps(obj, ensure_ascii=False, indent=indent, separators=(",", ": "), default=_numpy_default)
+    # most records have no float to rewrite, skip the scan of their strings
+    if "e-" not in text and "NaN" not in text and "Infinity" not in text:
+        return text
+    return _FLOAT_PATTERN.sub(_orjson_float, text)
+
+
+def iter_jsonl(path):
+    with open_text(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line != "":
+                yield loads(line)
+
+
+def _iter_json_array(f, chunk_size=1 << 20):
+    """
+    Yield the items of a top-level JSON array without reading the whole file.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+
+    def _skip(chars):
+        nonlocal buffer, pos, eof
+        while True:
+            while pos < len(buffer) and buffer[pos] in chars:
+                pos += 1
+            if pos < len(buffer) or eof:
+                return
+            buffer, pos = f.read(chunk_size), 0
+            eof = buffer == ""
+
+    _skip(" \t\r\n")
+    if eof or buffer[pos] != "[":
+        raise ValueError("the file is not a JSON array, use read_json")
+    pos += 1
+
+    while True:
+        _skip(" \t\r\n,")
+        if eof:
+            raise ValueError("unexpected end of the JSON array")
+        if buffer[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+            # a number may be cut by the end of the buffer (e.g. `1.5` of `1.5e-7`),
+            # only accept an item followed by a delimiter
+            complete = (end < len(buffer) and buffer[end] in ",] \t\r\n") or eof
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            complete = False
+        if not complete:
+            more = f.read(chunk_size)
+            eof = more == ""
+            buffer, pos = buffer[pos:] + more, 0
+            continue
+        yield item
+        pos = end
+
+
+def iter_json(path):
+    """
+    Stream the records of a `.json` array or a `.jsonl` file (optionally .gz/.zst).
+    """
+    if is_jsonl(path):
+        yield from iter_jsonl(path)
+        return
+    with open_text(path, "r") as f:
+        yield from _iter_json_array(f)
+
+
+def iter_jsonl_shards(path):
+    """
+    Stream the records of a JSONL shard dir (`index.json` + `part-xxxxx.jsonl`).
+    """
+    index = read_json(os.path.join(path, "index.json"))
+    for shard in index["shards"]:
+        yield from iter_jsonl(os.path.join(path, shard["path"]))
+
+
+def shuffle_buffer(stream, buffer_size, rng):
+    """
+    Approximate shuffle of a stream with a buffer of `buffer_size` items and
+    a `random.Random`.
+    """
+    buffer = []
+    for x in stream:
+        if len(buffer) < buffer_size:
+            buffer.append(x)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = x
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def read_json(path):
+    if is_jsonl(path):
+        return list(iter_jsonl(path))
+    with open_text(path, "r") as f:
+        return loads(f.read())
+
+
+class JsonWriter:
+    """
+    Write records one at a time to a `.json` array or a `.jsonl` file, for
+    producers that cannot hand `write_json` a single iterator.
+    The file is written next to `path` and moved in place by `close`, an
+    existing file is replaced, never rewritten (it may be hard-linked).
+    """
+
+    def __init__(self, path, indent=None):
+        self.path = path
+        self.tmp_path = _tmp_path(path)
+        self.jsonl = is_jsonl(path)
+        self.indent = indent
+        self.num = 0
+        self.f = open_text(self.tmp_path, "w")
+        if not self.jsonl:
+            self.f.write("[")
+
+    def write(self, record):
+        if self.jsonl:
+            self.f.write(dumps(record))
+            self.f.write("\n")
+        else:
+            self.f.write(",\n" if self.num > 0 else "\n")
+            text = dumps(record, indent=self.indent)
+            if self.indent is not None:
+                text = "\n".join(" " * self.indent + line for line in text.split("\n"))
+            self.f.write(text)
+        self.num += 1
+
+    def close(self):
+        if not self.jsonl:
+            self.f.write("\n]" if self.num > 0 else "]")
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+        return self.num
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            os.remove(self.tmp_path)
+
+
+def write_jsonl(records, path):
+    with JsonWriter(path) as writer:
+        for record in records:
+            writer.write(record)
+    return writer.num
+
+
+def write_json(data, path, indent=None):
+    """
+    Lists and iterators are written item by item, so a generator of records is
+    never materialized. `.jsonl` paths are written as JSON lines.
+    Returns the number of records for lists/iterators.
+    """
+    if isinstance(data, dict) and not is_jsonl(path):
+        tmp_path = _tmp_path(path)
+        with open_text(tmp_path, "w") as f:
+            f.write(dumps(data, indent=indent))
+        os.replace(tmp_path, path)
+        return None
+
+    with JsonWriter(path, indent=indent) as writer:
+        for item in data:
+            writer.write(item)
+    return writer.num
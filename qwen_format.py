@@ -0,0 +1,74 @@
+from utils import convert_tags_to_qwen_format
+
+
+def guienv_to_qwen_format(item, image2path):
+    question = item["prompt"]
+    answer = item["label"]
+
+    path = image2path[item["image_id"]]
+    question = f"<img>{path}</img>" + question
+
+    question = convert_tags_to_qwen_format(question, tags=("box",))
+    answer = convert_tags_to_qwen_format(answer, tags=("box",))
+
+    conversations = [
+        {
+            "from": "user",
+            "value": question
+        },
+        {
+            "from": "assistant",
+            "value": answer
+        }
+    ]
+
+    return {
+        "id": item["uid"],
+        "conversations": conversations
+    }
+
+def guiact_to_qwen_format(item, data_type, image2path):
+    image_id = item["image_id"]
+    path = image2path[image_id]
+
+    question = f"<img>{path}</img>\n" + item["prompt"]
+    answer = convert_tags_to_qwen_format(item["label"], tags=("box", "point"))
+
+    conversations = [
+        {
+            "from": "user",
+            "value": question
+        },
+        {
+            "from": "assistant",
+            "value": answer
+        }
+    ]
+
+    return {
+        "id": item["uid"],
+        "type": data_type,
+        "conversations": conversations
+    }
+
+def guichat_to_qwen_format(item, image_id2path):
+    conversations = []
+    for content in item["text"]:
+        if content["from"] == "human":
+            res_from = "user"
+        elif content["from"] == "gpt":
+            res_from = "assistant"
+        else:
+            print(content["from"])
+        
+        res_value = convert_tags_to_qwen_format(content["value"], tags=("image", "box"), image_id2path=image_id2path)
+
+        conversations.append({
+            "from": res_from,
+            "value": res_value
+        })
+
+    return {
+        "id": item["uid"],
+        "conversations": conversations
+    }
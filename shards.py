@@ -0,0 +1,231 @@
+import os
+import re
+import io
+import json
+import bisect
+import tarfile
+
+
+IMG_PATTERN = re.compile(r"<img>(.*?)</img>")
+# `<shard>.tar#<member>`, the image paths of the records read from shards
+MEMBER_SEPARATOR = "#"
+
+
+def record_images(record):
+    """
+    Image paths used by a record: the `<img>` tags of the conversations
+    (Qwen-VL format) and the `image_path` field (instructions for inference).
+    """
+    paths = []
+    for sentence in record.get("conversations", []):
+        paths.extend(IMG_PATTERN.findall(sentence["value"]))
+    if "image_path" in record:
+        paths.append(record["image_path"])
+    return list(dict.fromkeys(paths))
+
+
+def _replace_images(record, path2name):
+    record = dict(record)
+    if "conversations" in record:
+        record["conversations"] = [
+            dict(sentence, value=IMG_PATTERN.sub(lambda m: f"<img>{path2name[m.group(1)]}</img>", sentence["value"]))
+            for sentence in record["conversations"]
+        ]
+    if "image_path" in record:
+        record["image_path"] = path2name[record["image_path"]]
+    return record
+
+
+def _add_member(tar, name, data):
+    """Add `data` as `name`, return [offset, size] of the data in the tar file."""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+    # the data ends with the padding to the last written block
+    padded = (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+    return [tar.offset - padded, len(data)]
+
+
+class ShardWriter:
+    """
+    Write records and their images to WebDataset-style tar shards.
+
+    Each sample `<key>` is stored as `<key>.json` followed by its images
+    `<key>.<i><ext>`, the image paths in the record are replaced by the member
+    names. `index.json` lists the shards and their sample counts,
+    `<shard>.members.json` the offsets of the members of a shard.
+    """
+
+    def __init__(self, out_dir, samples_per_shard=1000, image_root="."):
+        self.out_dir = out_dir
+        self.samples_per_shard = samples_per_shard
+        self.image_root = image_root
+        self.shards = []
+        self.num_samples = 0
+        self.tar = None
+        self.samples = []
+        os.makedirs(out_dir, exist_ok=True)
+
+    def _next_shard(self):
+        self.close_shard()
+        name = "shard-{:06d}.tar".format(len(self.shards))
+        self.tar = tarfile.open(os.path.join(self.out_dir, name), "w")
+        self.shards.append({"path": name, "first_sample": self.num_samples, "num_samples": 0})
+
+    def close_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+            members_path = os.path.join(self.out_dir, self.shards[-1]["path"] + ".members.json")
+            with open(members_path, "w", encoding="utf8") as f:
+                f.write(json.dumps({"samples": self.samples}, ensure_ascii=False))
+            self.samples = []
+
+    def write(self, record):
+        if self.tar is None or self.shards[-1]["num_samples"] >= self.samples_per_shard:
+            self._next_shard()
+
+        key = "{:09d}".format(self.num_samples)
+        path2name = {}
+        images = []
+        for i, path in enumerate(record_images(record)):
+            ext = os.path.splitext(path)[1] or ".png"
+            path2name[path] = f"{key}.{i}{ext}"
+            with open(os.path.join(self.image_root, path), "rb") as f:
+                images.append((path2name[path], f.read()))
+
+        record = _replace_images(record, path2name)
+        sample = {"json": _add_member(self.tar, f"{key}.json", json.dumps(record, ensure_ascii=False).encode("utf8")), "images": []}
+        for name, data in images:
+            sample["images"].append([name] + _add_member(self.tar, name, data))
+        self.samples.append(sample)
+
+        self.shards[-1]["num_samples"] += 1
+        self.num_samples += 1
+
+    def close(self):
+        self.close_shard()
+        index = {"num_samples": self.num_samples, "shards": self.shards}
+        with open(os.path.join(self.out_dir, "index.json"), "w", encoding="utf8") as f:
+            f.write(json.dumps(index, ensure_ascii=False, indent=4))
+        return index
+
+
+def write_shards(records, out_dir, samples_per_shard=1000, image_root="."):
+    writer = ShardWriter(out_dir, samples_per_shard=samples_per_shard, image_root=image_root)
+    for record in records:
+        writer.write(record)
+    return writer.close()
+
+
+def read_shard_index(path):
+    """
+    `path` is a shard directory or its `index.json`.
+    """
+    index_path = os.path.join(path, "index.json") if os.path.isdir(path) else path
+    with open(index_path, "r", encoding="utf8") as f:
+        index = json.loads(f.read())
+    index["dir"] = os.path.dirname(os.path.abspath(index_path))
+    return index
+
+
+def is_shard_path(path):
+    """
+    A tar shard dir written by `write_shards` or its index.json: an index that
+    lists `.tar` shards which exist (JSONL shards from merge_data and plain
+    directories are not).
+    """
+    index_path = os.path.join(path, "index.json") if os.path.isdir(path) else path
+    if os.path.basename(index_path) != "index.json" or not os.path.exists(index_path):
+        return False
+    with open(index_path, "r", encoding="utf8") as f:
+        index = json.loads(f.read())
+    if not isinstance(index, dict) or index.get("format", "tar") != "tar" or "shards" not in index:
+        return False
+    shard_dir = os.path.dirname(os.path.abspath(index_path))
+    return all(
+        shard["path"].endswith(".tar") and os.path.isfile(os.path.join(shard_dir, shard["path"]))
+        for shard in index["shards"]
+    )
+
+
+def _scan_shard(shard_path):
+    """Member offsets of a shard written without `.members.json`, from the tar headers only."""
+    samples = []
+    with tarfile.open(shard_path, "r:") as tar:
+        for member in tar:
+            if member.name.endswith(".json"):
+                samples.append({"json": [member.offset_data, member.size], "images": []})
+            else:
+                samples[-1]["images"].append([member.name, member.offset_data, member.size])
+    return {"samples": samples}
+
+
+_MEMBER_INDEXES = {}
+_FDS = {}
+
+
+def _member_index(shard_path):
+    if shard_path not in _MEMBER_INDEXES:
+        members_path = shard_path + ".members.json"
+        if os.path.exists(members_path):
+            with open(members_path, "r", encoding="utf8") as f:
+                index = json.loads(f.read())
+        else:
+            index = _scan_shard(shard_path)
+        index["members"] = {name: (offset, size) for sample in index["samples"] for name, offset, size in sample["images"]}
+        _MEMBER_INDEXES[shard_path] = index
+    return _MEMBER_INDEXES[shard_path]
+
+
+def _read_range(path, offset, size):
+    # pread has no file position, the descriptors can be shared by forked DataLoader workers
+    if path not in _FDS:
+        _FDS[path] = os.open(path, os.O_RDONLY)
+    return os.pread(_FDS[path], size, offset)
+
+
+def is_shard_member(path):
+    return f".tar{MEMBER_SEPARATOR}" in path
+
+
+def read_shard_member(path):
+    """Bytes of an image path `<shard>.tar#<member>` of a record read by `ShardReader`."""
+    shard_path, name = path.rsplit(MEMBER_SEPARATOR, 1)
+    offset, size = _member_index(shard_path)["members"][name]
+    return _read_range(shard_path, offset, size)
+
+
+class ShardReader:
+    """
+    Random and sequential access to the records of a shard dir, nothing is
+    extracted. The image paths of a record point into the tar files
+    (`<shard>.tar#<member>`), `read_shard_member` reads them by offset.
+    """
+
+    def __init__(self, path):
+        index = read_shard_index(path)
+        self.shard_paths = [os.path.join(index["dir"], shard["path"]) for shard in index["shards"]]
+        self.first_samples = [shard["first_sample"] for shard in index["shards"]]
+        self.num_samples = index["num_samples"]
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        j = bisect.bisect_right(self.first_samples, i) - 1
+        shard_path = self.shard_paths[j]
+        sample = _member_index(shard_path)["samples"][i - self.first_samples[j]]
+        record = json.loads(_read_range(shard_path, *sample["json"]))
+        name2path = {name: f"{shard_path}{MEMBER_SEPARATOR}{name}" for name, _, _ in sample["images"]}
+        return _replace_images(record, name2path)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
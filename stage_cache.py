@@ -0,0 +1,162 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import inspect
+
+
+def _hash_file(path, chunk_size=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def code_version(*sources):
+    """
+    Hash of the source files a stage depends on, given as paths (`__file__`)
+    or as functions/classes/modules of the files.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for source in sources:
+        path = source if isinstance(source, str) else inspect.getsourcefile(source)
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _link_file(src, dst):
+    """
+    Hard-link `src` to `dst` (copy across filesystems), replacing `dst`.
+    """
+    tmp_path = f"{dst}.{os.getpid()}.tmp"
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def _link_tree(src, dst):
+    if os.path.isfile(src):
+        os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+        if not (os.path.exists(dst) and os.path.samefile(src, dst)):
+            _link_file(src, dst)
+        return
+    for root, _, files in os.walk(src):
+        out_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(out_root, exist_ok=True)
+        for name in files:
+            _link_tree(os.path.join(root, name), os.path.join(out_root, name))
+
+
+class StageCache:
+    """
+    Skip pipeline stages whose inputs, parameters and code did not change.
+
+    The key of a stage is the content hash of its input files (memoized by
+    size and mtime), its parameters and `code_version` of its sources. The
+    outputs (files or directories) are hard-linked into
+    `cache_dir/stages/<name>/<key>` and linked back on a hit, so switching
+    between recipes is cheap too. Outputs must be replaced (tmp + os.replace,
+    like json_io and the image export), not rewritten in place, or the cached
+    copy changes with them.
+    """
+
+    def __init__(self, cache_dir="./.stage_cache", keep_entries=3):
+        self.cache_dir = cache_dir
+        self.keep_entries = keep_entries
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hashes_path = os.path.join(cache_dir, "file_hashes.json")
+        self.file_hashes = {}
+        if os.path.exists(self.hashes_path):
+            with open(self.hashes_path, "r", encoding="utf8") as f:
+                self.file_hashes = json.loads(f.read())
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        entry = self.file_hashes.get(os.path.abspath(path))
+        if entry is not None and entry["signature"] == signature:
+            return entry["hash"]
+        file_hash = _hash_file(path)
+        self.file_hashes[os.path.abspath(path)] = {"signature": signature, "hash": file_hash}
+        tmp_path = f"{self.hashes_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            f.write(json.dumps(self.file_hashes))
+        os.replace(tmp_path, self.hashes_path)
+        return file_hash
+
+    def key(self, name, inputs, params=None, code=None):
+        fingerprint = {
+            "name": name,
+            "inputs": [[path, self.file_hash(path)] for path in inputs],
+            "params": params,
+            "code": code_version(*code) if code else None,
+        }
+        text = json.dumps(fingerprint, sort_keys=True, default=str)
+        return hashlib.blake2b(text.encode("utf8"), digest_size=16).hexdigest()
+
+    def _stage_dir(self, name):
+        return os.path.join(self.cache_dir, "stages", re.sub(r"[^\w.-]+", "_", name).strip("_"))
+
+    def get(self, name, key, outputs=None):
+        """
+        Restore the outputs of a cached run, returns its manifest or None.
+        outputs=None restores the outputs the run recorded, for stages that
+        only know them once they ran.
+        """
+        entry_dir = os.path.join(self._stage_dir(name), key)
+        manifest_path = os.path.join(entry_dir, "manifest.json")
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, "r", encoding="utf8") as f:
+            manifest = json.loads(f.read())
+        if outputs is None:
+            outputs = manifest["outputs"]
+        if manifest["outputs"] != list(outputs):
+            return None
+        for i, out_path in enumerate(outputs):
+            _link_tree(os.path.join(entry_dir, "outputs", str(i)), out_path)
+        os.utime(manifest_path)
+        return manifest
+
+    def put(self, name, key, outputs, result=None):
+        stage_dir = self._stage_dir(name)
+        entry_dir = os.path.join(stage_dir, key)
+        tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        for i, out_path in enumerate(outputs):
+            if not os.path.exists(out_path):
+                raise FileNotFoundError(f"{name}: the output {out_path} was not written")
+            _link_tree(out_path, os.path.join(tmp_dir, "outputs", str(i)))
+        os.makedirs(tmp_dir, exist_ok=True)
+        with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding="utf8") as f:
+            f.write(json.dumps({"name": name, "outputs": list(outputs), "result": result}, ensure_ascii=False))
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+
+        # drop the least recently used entries of this stage
+        entries = [
+            os.path.join(stage_dir, x) for x in os.listdir(stage_dir)
+            if os.path.exists(os.path.join(stage_dir, x, "manifest.json"))
+        ]
+        entries.sort(key=lambda x: os.path.getmtime(os.path.join(x, "manifest.json")), reverse=True)
+        for old_dir in entries[self.keep_entries:]:
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+    def run(self, name, fn, inputs, outputs, params=None, code=None):
+        """
+        `fn()` writes `outputs` from `inputs`, it only runs when the key changed.
+        Returns its (JSON-serializable) result, from the cache on a hit.
+        """
+        key = self.key(name, inputs, params=params, code=code)
+        manifest = self.get(name, key, outputs)
+        if manifest is not None:
+            print(f"{name}: unchanged, restored from {self.cache_dir}")
+            return manifest["result"]
+        result = fn()
+        self.put(name, key, outputs, result)
+        return result
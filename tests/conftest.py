@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the scripts import each other and the root modules by their dir, like when run from it
+for path in (ROOT, os.path.join(ROOT, "data_preprocess"), os.path.join(ROOT, "Qwen-SFT&Infer")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture(scope="session")
+def qwen_tokenizer():
+    """The Qwen-VL tokenizer of $QWEN_VL_PATH (default Qwen/Qwen-VL-Chat), set up like finetune.py."""
+    pytest.importorskip("transformers")
+    from token_cache import load_tokenizer
+
+    path = os.environ.get("QWEN_VL_PATH", "Qwen/Qwen-VL-Chat")
+    try:
+        return load_tokenizer(path, 8192)
+    except Exception as e:
+        pytest.skip(f"no Qwen-VL tokenizer at {path}: {e}")
@@ -0,0 +1,97 @@
+"""Fixed records of the three datasets, in the format of qwen_format.py."""
+from qwen_format import guiact_to_qwen_format, guichat_to_qwen_format, guienv_to_qwen_format
+
+IMAGE2PATH = {
+    "env_0": "./images/guienv/uid_text2bbox_0041.png",
+    "act_0": "./images/guiact/uid_episode_10270193012375700035_step_00.png",
+    "act_1": "./images/guiact/uid_episode_10270193012375700035_step_01.png",
+    "act_2": "./images/guiact/uid_episode_10270193012375700035_step_02.png",
+    "act_3": "./images/guiact/uid_episode_12220552989760792145_step_01.png",
+    "chat_0": "./images/guichat/uid_chat_000017_0.png",
+    "chat_1": "./images/guichat/uid_chat_000017_1.png",
+}
+
+GUIENV = [
+    {
+        "uid": "uid_text2bbox_0041",
+        "image_id": "env_0",
+        "prompt": "## Your Task\nIf the input is a string, please give me the element regions including this string. "
+                  "Else if the input is a region, please give me the string (text) in this region.## Input\nSign in\n## Output\n",
+        "label": "<box>712 31 781 58</box>\n<box>402 880 598 921</box>",
+    },
+    {
+        "uid": "uid_bbox2text_0042",
+        "image_id": "env_0",
+        "prompt": "## Your Task\nIf the input is a string, please give me the element regions including this string. "
+                  "Else if the input is a region, please give me the string (text) in this region.## Input\n<box>120 45 380 90</box>\n## Output\n",
+        "label": "Free shipping on orders over $35 — 日本語のテキスト",
+    },
+]
+
+_TASK = "Your Task\nFind a vegetarian lasagna recipe with more than 100 reviews and save it.\nGenerate next actions to do this task."
+_LOGS = "Informations\nThe search box is focused.\n"
+
+# the consecutive steps of two episodes, the history grows by one line per step
+GUIACT_EPISODES = [
+    {
+        "uid": "uid_episode_10270193012375700035_step_00",
+        "image_id": "act_0",
+        "prompt": _TASK,
+        "label": "thoughts: open the search first\nactions:\nclick, <box>845 12 903 44</box>\n",
+    },
+    {
+        "uid": "uid_episode_10270193012375700035_step_01",
+        "image_id": "act_1",
+        "prompt": "Actions History\nclick, <box>845 12 903 44</box>\n" + _LOGS + _TASK,
+        "label": "actions:\ninput, vegetarian lasagna\n",
+    },
+    {
+        "uid": "uid_episode_10270193012375700035_step_02",
+        "image_id": "act_2",
+        "prompt": "Actions History\nclick, <box>845 12 903 44</box>\ninput, vegetarian lasagna\n" + _LOGS + _TASK,
+        "label": "actions:\nscroll, down 500 right 0\ntap, <point>512 640</point>\n",
+    },
+    {
+        "uid": "uid_episode_12220552989760792145_step_01",
+        "image_id": "act_3",
+        "prompt": "Actions History\n  click, <box>10 10 90 40</box>\n\n" + _TASK,
+        "label": "actions:\nanswer, 4.8 stars   \n",
+    },
+]
+
+GUICHAT = [
+    {
+        "uid": "uid_chat_000017",
+        "text": [
+            {"from": "human", "value": "<image>chat_0</image>\nWhat can I do on this page?"},
+            {"from": "gpt", "value": "You can log in at <box>712 31 781 58</box> or browse the deals."},
+            {"from": "human", "value": "And here? <image>chat_1</image>"},
+            {"from": "gpt", "value": "This is the cart.\n\n1. Remove an item\n2. Check out"},
+        ],
+    },
+    {
+        # a conversation opened by the assistant, its first turn is dropped
+        "uid": "uid_chat_000018",
+        "text": [
+            {"from": "gpt", "value": "Hello!"},
+            {"from": "human", "value": "<image>chat_0</image>Describe the header."},
+            {"from": "gpt", "value": ""},
+        ],
+    },
+]
+
+
+def guienv_records():
+    return [guienv_to_qwen_format(item, IMAGE2PATH) for item in GUIENV]
+
+
+def guiact_records():
+    return [guiact_to_qwen_format(item, "web-multi", IMAGE2PATH) for item in GUIACT_EPISODES]
+
+
+def guichat_records():
+    return [guichat_to_qwen_format(item, IMAGE2PATH) for item in GUICHAT]
+
+
+def all_records():
+    return guienv_records() + guiact_records() + guichat_records()
@@ -0,0 +1,54 @@
+import os
+from io import BytesIO
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+Image = pytest.importorskip("PIL.Image")
+
+from convert_parquet_to_png import export_images
+from stage_cache import StageCache
+
+
+def png_bytes(color):
+    buffer = BytesIO()
+    Image.new("RGB", (4, 4), color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def write_parquet(path, images):
+    table = pa.table({"image_id": list(images.keys()), "binary": list(images.values())})
+    pq.write_table(table, str(path))
+    return str(path)
+
+
+@pytest.fixture
+def two_datasets(tmp_path):
+    # "b" is in both datasets, the shared store keeps it once
+    first = write_parquet(tmp_path / "first_images.parquet", {"a_0": png_bytes("red"), "a_1": png_bytes("blue")})
+    second = write_parquet(tmp_path / "second_images.parquet", {"b_0": png_bytes("blue"), "b_1": png_bytes("green")})
+    return first, second
+
+
+def test_dedup_stage_cache_keeps_the_objects_of_each_export(tmp_path, capsys, two_datasets):
+    first, second = two_datasets
+    objects_path = str(tmp_path / "images" / "objects")
+    cache = StageCache(str(tmp_path / "cache"))
+    kwargs = dict(num_workers=0, dedup=True, objects_path=objects_path, stage_cache=cache)
+
+    second_paths = export_images([second], str(tmp_path / "images" / "second"), **kwargs)
+    first_paths = export_images([first], str(tmp_path / "images" / "first"), **kwargs)
+    assert first_paths["a_1"] == second_paths["b_0"]
+    assert len(os.listdir(objects_path)) == 3
+
+    capsys.readouterr()
+    assert export_images([second], str(tmp_path / "images" / "second"), **kwargs) == second_paths
+    assert "unchanged" in capsys.readouterr().out
+
+    # a hit restores the objects of its export only
+    for image_path in set(first_paths.values()) | set(second_paths.values()):
+        os.remove(image_path)
+    export_images([first], str(tmp_path / "images" / "first"), **kwargs)
+    assert all(os.path.exists(image_path) for image_path in first_paths.values())
+    assert not os.path.exists(second_paths["b_1"])
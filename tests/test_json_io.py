@@ -0,0 +1,52 @@
+import pytest
+
+import json_io
+from json_io import dumps, write_json
+
+from samples import all_records
+
+OBJECTS = [
+    {"uid": "uid_episode_1_step_00", "text": "日本語 \"quoted\"\n\t\\   😀", "size": {"width": 1280, "height": 720}},
+    {1: "int key", "empty": [], "nested": {"a": [1, {"b": None}], "c": {}}, "flags": [True, False]},
+    [0.1, -0.0, 1.0, 100.0, 1e-4, 1e-5, 1.2345e-5, -9.99e-5, 1e-6, -1.5e-7, 5e-324, 1e15, 123456.789],
+    [float("nan"), float("inf"), -float("inf"), 2 ** 63 - 1, -2 ** 63],
+] + all_records()
+
+
+@pytest.fixture
+def stdlib_json(monkeypatch):
+    monkeypatch.setattr(json_io, "orjson", None)
+
+
+def test_fallback_format(stdlib_json):
+    assert dumps({"a": [1, 2.5], "b": "é"}) == '{"a":[1,2.5],"b":"é"}'
+    assert dumps([1e-5, 1.2345e-5, -2e-7, 1e-4, 1e16]) == "[0.00001,0.000012345,-2e-7,0.0001,1e+16]"
+    assert dumps([float("nan"), float("inf")]) == "[null,null]"
+    assert dumps({1: [], "s": "1e-05 NaN"}) == '{"1":[],"s":"1e-05 NaN"}'
+    assert dumps({"a": [1, {}]}, indent=2) == '{\n  "a": [\n    1,\n    {}\n  ]\n}'
+
+
+def test_fallback_numpy(stdlib_json):
+    np = pytest.importorskip("numpy")
+    values = [np.float32(0.1), np.array([0.1, 1e-5], dtype=np.float32), np.int64(3), np.array([[1, 2]]), np.bool_(True)]
+    assert dumps(values) == "[0.1,[0.1,0.00001],3,[[1,2]],true]"
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_same_text_as_orjson(monkeypatch, indent):
+    pytest.importorskip("orjson")
+    for obj in OBJECTS:
+        expected = dumps(obj, indent=indent)
+        with monkeypatch.context() as m:
+            m.setattr(json_io, "orjson", None)
+            assert dumps(obj, indent=indent) == expected
+
+
+def test_same_file_with_either_backend(tmp_path, monkeypatch):
+    write_json(OBJECTS, str(tmp_path / "a.json"))
+    write_json(OBJECTS, str(tmp_path / "a.jsonl"))
+    monkeypatch.setattr(json_io, "orjson", None)
+    write_json(OBJECTS, str(tmp_path / "b.json"))
+    write_json(OBJECTS, str(tmp_path / "b.jsonl"))
+    assert (tmp_path / "a.json").read_bytes() == (tmp_path / "b.json").read_bytes()
+    assert (tmp_path / "a.jsonl").read_bytes() == (tmp_path / "b.jsonl").read_bytes()
@@ -0,0 +1,147 @@
+import math
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+nn = torch.nn
+
+from packing import PackedAttention, pack_ffd, pack_greedy, pack_samples
+
+VOCAB = 50
+HIDDEN = 32
+HEADS = 4
+
+
+def rotate_half(x):
+    x1, x2 = x.chunk(2, dim=-1)
+    return torch.cat((-x2, x1), dim=-1)
+
+
+class QWenAttention(nn.Module):
+    """The attention of Qwen-VL's modeling_qwen.py: rotary from the sequence length, additive mask kwarg."""
+
+    def __init__(self):
+        super().__init__()
+        self.c_attn = nn.Linear(HIDDEN, 3 * HIDDEN)
+        self.c_proj = nn.Linear(HIDDEN, HIDDEN)
+
+    def forward(self, hidden_states, rotary_pos_emb, registered_causal_mask=None, attention_mask=None):
+        batch_size, seq_len, _ = hidden_states.shape
+        query, key, value = self.c_attn(hidden_states).view(batch_size, seq_len, 3, HEADS, -1).permute(2, 0, 3, 1, 4)
+        cos, sin = rotary_pos_emb
+        query, key = query * cos + rotate_half(query) * sin, key * cos + rotate_half(key) * sin
+        weights = query @ key.transpose(-1, -2) / math.sqrt(query.shape[-1])
+        causal = registered_causal_mask[:, :, :seq_len, :seq_len]
+        weights = torch.where(causal, weights, torch.finfo(weights.dtype).min)
+        if attention_mask is not None:
+            weights = weights + attention_mask
+        output = weights.softmax(dim=-1) @ value
+        return self.c_proj(output.transpose(1, 2).reshape(batch_size, seq_len, HIDDEN))
+
+
+class QWenBlock(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.ln = nn.LayerNorm(HIDDEN)
+        self.attn = QWenAttention()
+        self.mlp = nn.Sequential(nn.Linear(HIDDEN, 2 * HIDDEN), nn.GELU(), nn.Linear(2 * HIDDEN, HIDDEN))
+
+    def forward(self, hidden_states, rotary_pos_emb, registered_causal_mask, attention_mask):
+        hidden_states = hidden_states + self.attn(
+            self.ln(hidden_states),
+            rotary_pos_emb,
+            registered_causal_mask=registered_causal_mask,
+            attention_mask=attention_mask,
+        )
+        return hidden_states + self.mlp(hidden_states)
+
+
+class QWenLM(nn.Module):
+    def __init__(self, num_layers=2, max_len=64):
+        super().__init__()
+        self.wte = nn.Embedding(VOCAB, HIDDEN)
+        self.h = nn.ModuleList([QWenBlock() for _ in range(num_layers)])
+        self.lm_head = nn.Linear(HIDDEN, VOCAB)
+        self.register_buffer("registered_causal_mask", torch.tril(torch.ones(max_len, max_len, dtype=torch.bool))[None, None])
+
+    def forward(self, input_ids, attention_mask=None, position_ids=None):
+        # like Qwen-VL, position_ids are ignored
+        batch_size, seq_len = input_ids.shape
+        if attention_mask is not None:
+            attention_mask = attention_mask.view(batch_size, -1)[:, None, None, :].float()
+            attention_mask = (1.0 - attention_mask) * torch.finfo(torch.float).min
+        dim = HIDDEN // HEADS
+        inv_freq = 1.0 / 10000 ** (torch.arange(0, dim, 2).float() / dim)
+        freqs = torch.outer(torch.arange(seq_len).float(), inv_freq)
+        emb = torch.cat((freqs, freqs), dim=-1)
+        rotary_pos_emb = emb.cos()[None, None], emb.sin()[None, None]
+        hidden_states = self.wte(input_ids)
+        for block in self.h:
+            hidden_states = block(hidden_states, rotary_pos_emb, self.registered_causal_mask, attention_mask)
+        return self.lm_head(hidden_states)
+
+
+def make_samples(lengths, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    samples = []
+    for length in lengths:
+        input_ids = torch.randint(1, VOCAB, (length,), generator=generator)
+        samples.append(dict(input_ids=input_ids, labels=input_ids.clone()))
+    return samples
+
+
+def collate(bins):
+    # the padding of finetune.DataCollatorForSupervisedDataset, pad token 0
+    max_len = max(len(b["input_ids"]) for b in bins)
+    input_ids = torch.zeros((len(bins), max_len), dtype=torch.long)
+    seq_ids = torch.full((len(bins), max_len), -1, dtype=torch.long)
+    for i, b in enumerate(bins):
+        input_ids[i, :len(b["input_ids"])] = b["input_ids"]
+        seq_ids[i, :len(b["seq_ids"])] = b["seq_ids"]
+    return input_ids, input_ids.ne(0), seq_ids
+
+
+def test_packed_logits_match_unpacked():
+    torch.manual_seed(0)
+    model = QWenLM().eval()
+    samples = make_samples([7, 12, 5, 9, 3])
+    groups = [[0, 1, 2], [3, 4]]
+    input_ids, attention_mask, seq_ids = collate([pack_samples([samples[i] for i in group]) for group in groups])
+
+    packed_attention = PackedAttention(model)
+    packed_attention.set_batch(seq_ids)
+    with torch.no_grad():
+        packed = model(input_ids, attention_mask=attention_mask)
+        packed_attention.set_batch(None)
+        crossed = model(input_ids, attention_mask=attention_mask)
+        for row, group in enumerate(groups):
+            start = 0
+            for i in group:
+                alone = model(samples[i]["input_ids"][None])[0]
+                end = start + len(alone)
+                torch.testing.assert_close(packed[row, start:end], alone, rtol=1e-5, atol=1e-5)
+                if start > 0:
+                    # without the mask the later samples of a bin see the earlier ones
+                    assert not torch.allclose(crossed[row, start:end], alone, atol=1e-3)
+                start = end
+
+
+def test_packed_attention_needs_qwen_attention():
+    with pytest.raises(ValueError):
+        PackedAttention(nn.Linear(2, 2))
+
+
+def test_pack_samples():
+    packed = pack_samples(make_samples([3, 2]))
+    assert packed["position_ids"].tolist() == [0, 1, 2, 0, 1]
+    assert packed["seq_ids"].tolist() == [0, 0, 0, 1, 1]
+    assert packed["labels"][0] == -100 and packed["labels"][3] == -100
+
+
+def test_packers_fit_every_sample_once():
+    lengths = [5, 9, 3, 8, 1, 7, 2, 10, 4]
+    for packer in (pack_greedy, pack_ffd):
+        bins = packer(lengths, 10)
+        assert sorted(i for b in bins for i in b) == list(range(len(lengths)))
+        assert all(sum(lengths[i] for i in b) <= 10 for b in bins)
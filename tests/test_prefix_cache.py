@@ -0,0 +1,93 @@
+import os
+from collections import OrderedDict
+
+import pytest
+
+pytest.importorskip("transformers")
+
+from json_io import read_json
+from prefix_cache import PrefixTokenCache, episode_id
+from qwen_format import guiact_to_qwen_format
+
+RESULTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "results")
+
+
+def guiact_results(name):
+    return read_json(os.path.join(RESULTS, f"minicpm_guiagent_{name}.json"))
+
+
+@pytest.mark.parametrize("name", ["smartphone", "web_multi"])
+def test_episode_id_groups_the_steps(name):
+    uids = [item["uid"] for item in guiact_results(name)]
+    episodes = OrderedDict()
+    for uid in uids:
+        episodes.setdefault(episode_id({"id": uid}), []).append(uid)
+    assert len(episodes) == len({uid.rsplit("_step_", 1)[0] for uid in uids})
+    assert len(episodes) < len(uids) / 2
+    for episode, steps in episodes.items():
+        assert "step" not in episode
+        assert all(uid.startswith(episode + "_step_") for uid in steps)
+
+
+def test_episode_id_keeps_single_step_uids():
+    for item in guiact_results("web_single")[:100]:
+        assert episode_id({"id": item["uid"]}) == item["uid"]
+
+
+def test_episode_id_field_first():
+    assert episode_id({"id": "uid_record_03567_step_02", "episode_id": "e1"}) == "e1"
+
+
+def guiact_episode_records(name, num_episodes):
+    """The steps of the first episodes of the results, the prompts with the actions history like convert_to_sft_instructions.py."""
+    episodes = OrderedDict()
+    for item in guiact_results(name):
+        episodes.setdefault(episode_id({"id": item["uid"]}), []).append(item)
+    records = []
+    for steps in list(episodes.values())[:num_episodes]:
+        history = []
+        for item in steps:
+            prompt = ""
+            if len(history) > 0:
+                prompt += "Actions History\n{}\n".format("\n".join(history))
+            prompt += item["prompt"]
+            raw = {"uid": item["uid"], "image_id": item["image_id"], "prompt": prompt, "label": item["pred"]}
+            records.append(guiact_to_qwen_format(raw, name, {item["image_id"]: f"./images/{item['image_id']}.png"}))
+            history.append(item["pred"].split("actions:\n", 1)[-1].strip())
+    return records
+
+
+@pytest.mark.parametrize("name", ["smartphone", "web_multi"])
+@pytest.mark.parametrize("batch_size", [1, 16])
+def test_same_tokens_as_full_tokenization(qwen_tokenizer, name, batch_size):
+    records = guiact_episode_records(name, 40)
+    texts = [record["conversations"][0]["value"] for record in records]
+    episodes = [episode_id(record) for record in records]
+    cache = PrefixTokenCache(qwen_tokenizer)
+    results = []
+    for start in range(0, len(texts), batch_size):
+        results += cache.encode_batch(texts[start:start + batch_size], episodes[start:start + batch_size])
+    assert cache.enabled
+    assert results == qwen_tokenizer(texts).input_ids
+    # the history lines of the later steps come from the cache
+    assert cache.reused_chars > 0.2 * cache.total_chars
+
+
+def test_tokenize_conversations_with_prefix_cache(qwen_tokenizer):
+    pytest.importorskip("torch")
+    from token_cache import tokenize_conversations
+
+    records = guiact_episode_records("smartphone", 20) + guiact_episode_records("web_multi", 20)
+    sources = [record["conversations"] for record in records]
+    cache = PrefixTokenCache(qwen_tokenizer)
+    cached = tokenize_conversations(sources, qwen_tokenizer, prefix_cache=cache, episode_ids=[episode_id(record) for record in records])
+    assert cache.enabled
+    assert cached == tokenize_conversations(sources, qwen_tokenizer)
+
+
+def test_a_token_across_a_cut_disables_the_cache(qwen_tokenizer):
+    # the image tag spans the cut after "\n", the pieces alone do not expand it
+    texts = ["<img>./images/a\nb.png</img>\nYour Task\nfind it", "<img>./images/a\nb.png</img>\nYour Task\nfind it again"]
+    cache = PrefixTokenCache(qwen_tokenizer)
+    assert cache.encode_batch(texts, ["e", "e"]) == qwen_tokenizer(texts).input_ids
+    assert not cache.enabled
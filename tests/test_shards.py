@@ -0,0 +1,56 @@
+import os
+
+from json_io import write_json
+from shards import ShardReader, is_shard_path, read_shard_member, record_images, write_shards
+
+
+def write_image(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_record_images():
+    record = {
+        "conversations": [
+            {"from": "user", "value": "Picture 1: <img>a.png</img>\nPicture 2: <img>b.png</img>\n"},
+            {"from": "assistant", "value": "<img>a.png</img>"},
+        ],
+        "image_path": "c.png",
+    }
+    assert record_images(record) == ["a.png", "b.png", "c.png"]
+    assert record_images({"conversations": [{"from": "user", "value": "no image"}]}) == []
+
+
+def test_write_and_read_shards(tmp_path):
+    write_image(str(tmp_path / "images" / "a.png"), b"first")
+    write_image(str(tmp_path / "images" / "b.png"), b"second")
+    records = [
+        {"id": str(i), "conversations": [{"from": "user", "value": f"<img>images/{name}</img>\nfind it"}]}
+        for i, name in enumerate(["a.png", "b.png", "a.png"])
+    ]
+    write_shards(records, str(tmp_path / "shards"), samples_per_shard=2, image_root=str(tmp_path))
+
+    assert is_shard_path(str(tmp_path / "shards"))
+    assert is_shard_path(str(tmp_path / "shards" / "index.json"))
+    reader = ShardReader(str(tmp_path / "shards"))
+    assert len(reader) == 3
+    for record, data in zip(reader, [b"first", b"second", b"first"]):
+        assert [read_shard_member(path) for path in record_images(record)] == [data]
+
+
+def test_other_paths_are_not_shards(tmp_path):
+    # a plain image directory
+    write_image(str(tmp_path / "images" / "a.png"), b"first")
+    assert not is_shard_path(str(tmp_path / "images"))
+    # JSONL shards from merge_data
+    os.makedirs(tmp_path / "jsonl")
+    write_json({"format": "jsonl", "num_samples": 0, "shards": [{"path": "part-00000.jsonl", "num_samples": 0}]},
+               str(tmp_path / "jsonl" / "index.json"))
+    assert not is_shard_path(str(tmp_path / "jsonl"))
+    # an index whose tar files are missing
+    os.makedirs(tmp_path / "missing")
+    write_json({"num_samples": 1, "shards": [{"path": "shard-000000.tar", "first_sample": 0, "num_samples": 1}]},
+               str(tmp_path / "missing" / "index.json"))
+    assert not is_shard_path(str(tmp_path / "missing"))
+    assert not is_shard_path(str(tmp_path / "data.json"))
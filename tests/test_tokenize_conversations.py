@@ -0,0 +1,98 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from token_cache import IGNORE_TOKEN_ID, tokenize_conversation, tokenize_conversations
+
+from samples import all_records, guiact_records, guichat_records, guienv_records
+
+
+def preprocess(
+    sources,
+    tokenizer,
+    max_len: int,
+    system_message: str = "You are a helpful assistant."
+):
+    """The original per-sentence preprocess of finetune.py."""
+    roles = {"user": "<|im_start|>user", "assistant": "<|im_start|>assistant"}
+
+    im_start = tokenizer.im_start_id
+    im_end = tokenizer.im_end_id
+    nl_tokens = tokenizer('\n').input_ids
+    _system = tokenizer('system').input_ids + nl_tokens
+
+    # Apply prompt templates
+    input_ids, targets = [], []
+    for i, source in enumerate(sources):
+        if roles[source[0]["from"]] != roles["user"]:
+            source = source[1:]
+
+        input_id, target = [], []
+        system = [im_start] + _system + tokenizer(system_message).input_ids + [im_end] + nl_tokens
+        input_id += system
+        target += [im_start] + [IGNORE_TOKEN_ID] * (len(system)-3) + [im_end] + nl_tokens
+        assert len(input_id) == len(target)
+        for j, sentence in enumerate(source):
+            role = roles[sentence["from"]]
+            _input_id = tokenizer(role).input_ids + nl_tokens + \
+                tokenizer(sentence["value"]).input_ids + [im_end] + nl_tokens
+            input_id += _input_id
+            if role == '<|im_start|>user':
+                _target = [im_start] + [IGNORE_TOKEN_ID] * (len(_input_id)-3) + [im_end] + nl_tokens
+            elif role == '<|im_start|>assistant':
+                _target = [im_start] + [IGNORE_TOKEN_ID] * len(tokenizer(role).input_ids) + \
+                    _input_id[len(tokenizer(role).input_ids)+1:-2] + [im_end] + nl_tokens
+            else:
+                raise NotImplementedError
+            target += _target
+        assert len(input_id) == len(target)
+        input_id += [tokenizer.pad_token_id] * (max_len - len(input_id))
+        target += [IGNORE_TOKEN_ID] * (max_len - len(target))
+        input_ids.append(input_id[:max_len])
+        targets.append(target[:max_len])
+    input_ids = torch.tensor(input_ids, dtype=torch.int)
+    targets = torch.tensor(targets, dtype=torch.int)
+
+    return dict(
+        input_ids=input_ids,
+        labels=targets,
+        attention_mask=input_ids.ne(tokenizer.pad_token_id),
+    )
+
+
+def padded(results, pad_token_id, max_len):
+    input_ids = [input_id[:max_len] + [pad_token_id] * (max_len - len(input_id)) for input_id, _ in results]
+    labels = [target[:max_len] + [IGNORE_TOKEN_ID] * (max_len - len(target)) for _, target in results]
+    return input_ids, labels
+
+
+@pytest.mark.parametrize("records", [guienv_records, guiact_records, guichat_records, all_records])
+@pytest.mark.parametrize("max_len", [2048, 300])
+def test_same_tokens_as_preprocess(qwen_tokenizer, records, max_len):
+    sources = [record["conversations"] for record in records()]
+    expected = preprocess(sources, qwen_tokenizer, max_len)
+    input_ids, labels = padded(tokenize_conversations(sources, qwen_tokenizer), qwen_tokenizer.pad_token_id, max_len)
+    assert input_ids == expected["input_ids"].tolist()
+    assert labels == expected["labels"].tolist()
+
+
+def test_system_message(qwen_tokenizer):
+    sources = [record["conversations"] for record in all_records()]
+    system_message = "You are a GUI agent.\nAnswer with actions."
+    expected = preprocess(sources, qwen_tokenizer, 2048, system_message)
+    input_ids, labels = padded(tokenize_conversations(sources, qwen_tokenizer, system_message), qwen_tokenizer.pad_token_id, 2048)
+    assert input_ids == expected["input_ids"].tolist()
+    assert labels == expected["labels"].tolist()
+
+
+def test_one_conversation_like_a_batch(qwen_tokenizer):
+    sources = [record["conversations"] for record in all_records()]
+    batch = tokenize_conversations(sources, qwen_tokenizer)
+    assert [tokenize_conversation(source, qwen_tokenizer) for source in sources] == batch
+
+
+def test_images_and_turns_are_covered():
+    records = all_records()
+    assert any("<img>" in sentence["value"] for record in records for sentence in record["conversations"][2:])
+    assert any(len(record["conversations"]) > 2 for record in records)
+    assert any(record["conversations"][0]["from"] == "assistant" for record in records)
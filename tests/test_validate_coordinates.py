@@ -0,0 +1,164 @@
+import re
+import random
+
+import pytest
+
+from json_io import read_json, write_json
+from convert_to_sft_instructions import (
+    REASON_NAMES,
+    iter_valid_records,
+    parse_box,
+    parse_point,
+    run_conversion_jobs,
+    validate_coordinates,
+)
+
+
+def is_pass_check(item):
+    """The per-record check `validate_coordinates` replaces."""
+    image_w, image_h = item["image_size"]["width"], item["image_size"]["height"]
+
+    pred_bbox = re.findall(r"(<box>.*?</box>)", item["question"] + str(item["actions_label"]))
+    for bbox in pred_bbox:
+        x1, y1, x2, y2 = parse_box(bbox)
+        if x1 > image_w or x2 > image_w or y1 > image_h or y2 > image_h:
+            return False
+        if x1 < 0 or x2 < 0 or y1 < 0 or y2 < 0:
+            return False
+
+    pred_point = re.findall(r"(<point>.*?</point>)", item["question"] + str(item["actions_label"]))
+    for point in pred_point:
+        x, y = parse_point(point)
+        if x > image_w or y > image_h:
+            return False
+        if x < 0 or y < 0:
+            return False
+
+    return True
+
+
+def keeps(item):
+    try:
+        return is_pass_check(item)
+    except Exception:
+        # validate_coordinates drops what is_pass_check cannot parse
+        return False
+
+
+def record(question="click it", actions=(), width=1280, height=720):
+    return {
+        "question": question,
+        "actions_label": list(actions),
+        "image_size": {"width": width, "height": height},
+    }
+
+
+FIXED = [
+    record(),
+    record(actions=[{"name": "click", "element": "<box>10, 20, 30, 40</box>"}]),
+    record(actions=[{"name": "click", "element": "<box>10, 20, 1281, 40</box>"}]),
+    record(actions=[{"name": "click", "element": "<box>10, 20, 1280.9, 720.5</box>"}]),
+    record(actions=[{"name": "click", "element": "<box>-0.5, 0, 30, 40</box>"}]),
+    record(actions=[{"name": "click", "element": "<box>-1, 0, 30, 40</box>"}]),
+    record(actions=[{"name": "tap", "point": "<point>640, 360</point>"}]),
+    record(actions=[{"name": "tap", "point": "<point>640, 721</point>"}]),
+    record(actions=[{"name": "tap", "point": "<point>640</point>"}]),
+    record(actions=[{"name": "tap", "point": "<point>a, b</point>"}]),
+    record(actions=[{"name": "tap", "point": "<point>nan, 1</point>"}]),
+    record(actions=[{"name": "tap", "point": "<point><point>1, 2</point>"}]),
+    record(question="what is at <box>0, 0, 2000, 10</box>?"),
+    record(question="what is at <point>5, 5</point>?", actions=[{"name": "click", "element": "<box>0, 0, 5000, 10</box>"}]),
+    record(actions=[
+        {"name": "drag", "dual_point": {"from": "<point>1, 1</point>", "to": "<point>10, 900</point>"}},
+    ]),
+    record(actions=[{"name": "click", "element": "<box>1, 2, 3</box>"}, {"name": "tap", "point": "<point>1, 2</point>"}]),
+]
+
+
+def random_records(num, seed=0):
+    rng = random.Random(seed)
+
+    def coordinate(limit):
+        return rng.choice([
+            str(rng.randint(0, limit)),
+            str(rng.randint(limit - 2, limit + 2)),
+            f"{rng.uniform(-1.5, limit + 1.5):.2f}",
+            str(-rng.randint(1, 5)),
+            rng.choice(["x", "", " 3 ", "1e2"]),
+        ])
+
+    records = []
+    for _ in range(num):
+        width, height = rng.randint(100, 2000), rng.randint(100, 2000)
+        actions = []
+        for _ in range(rng.randint(0, 3)):
+            if rng.random() < 0.5:
+                actions.append({"name": "click", "element": "<box>{}, {}, {}, {}</box>".format(
+                    coordinate(width), coordinate(height), coordinate(width), coordinate(height))})
+            else:
+                actions.append({"name": "tap", "point": "<point>{}, {}</point>".format(coordinate(width), coordinate(height))})
+        question = rng.choice(["click the button", "point at <point>{}, {}</point>".format(coordinate(width), coordinate(height))])
+        records.append(record(question, actions, width, height))
+    return records
+
+
+def test_same_decisions_as_is_pass_check():
+    dataset = FIXED + random_records(2000)
+    mask, reasons, failed_fields = validate_coordinates(dataset)
+    assert mask.tolist() == [keeps(item) for item in dataset]
+    for keep, reason, field in zip(mask.tolist(), reasons.tolist(), failed_fields):
+        assert (reason == 0) == keep
+        assert (field is None) == keep
+
+
+def test_reasons_and_fields():
+    _, reasons, failed_fields = validate_coordinates(FIXED)
+    assert REASON_NAMES[reasons[2]] == "box_out_of_image" and failed_fields[2] == "actions_label"
+    assert REASON_NAMES[reasons[7]] == "point_out_of_image"
+    assert REASON_NAMES[reasons[9]] == "malformed_coordinates"
+    assert REASON_NAMES[reasons[12]] == "box_out_of_image" and failed_fields[12] == "question"
+    # boxes are checked before points
+    assert REASON_NAMES[reasons[13]] == "box_out_of_image" and failed_fields[13] == "actions_label"
+
+
+def test_iter_valid_records_summarizes_drops(capsys):
+    dataset = FIXED + random_records(500, seed=1)
+    kept = list(iter_valid_records(dataset, batch_size=64, dataset_name="guiact"))
+    assert kept == [item for item in dataset if keeps(item)]
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    assert lines[0].startswith(f"guiact dropped {len(dataset) - len(kept)} records")
+
+
+def guiact_item(i, x2):
+    return {
+        "uid": f"uid_record_{i:05d}_step_00",
+        "image_id": f"uid_record_{i:05d}_step_00",
+        "image_size": {"width": 1280, "height": 720},
+        "question": "open the menu",
+        "actions_label": [{"name": "click", "element": {
+            "absolute": f"<box>10, 20, {x2}, 40</box>",
+            "related": "<box>0.01, 0.03, 0.5, 0.06</box>",
+        }}],
+        "actions_history": "",
+        "logs": "",
+        "thoughts": "",
+    }
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_run_conversion_jobs_summarizes_drops_once(tmp_path, capsys, num_workers):
+    # one dropped record in each chunk of 2
+    items = [guiact_item(i, 1300 if i % 2 else 300) for i in range(6)]
+    write_json(items, str(tmp_path / "web-multi_test_data.json"))
+    jobs = [{
+        "kind": "guiact",
+        "input": str(tmp_path / "web-multi_test_data.json"),
+        "output": str(tmp_path / "web-multi_test_sft_instructions.json"),
+        "kwargs": {"dataset_name": "web-multi", "position_format": "related"},
+    }]
+    counts = run_conversion_jobs(jobs, num_workers=num_workers, chunk_size=2)
+    assert list(counts[0].values()) == [3]
+    assert [x["uid"] for x in read_json(jobs[0]["output"])] == [item["uid"] for item in items[0::2]]
+    lines = [line for line in capsys.readouterr().out.splitlines() if "dropped" in line]
+    assert lines == [f"{jobs[0]['input']} dropped 3 records (box_out_of_image in actions_label: 3)"]
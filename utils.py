@@ -1,3 +1,4 @@
+import re
 import json
 import yaml
 import math
@@ -272,4 +273,31 @@ def convert_list_to_dict(results):
     new_res = {}
     for res in results:
         new_res[res['uid']] = res
-    return new_res
\ No newline at end of file
+    return new_res
+
+_QWEN_TAG_PATTERNS = {}
+
+def _qwen_tag_pattern(tags):
+    key = "|".join(sorted(tags))
+    if key not in _QWEN_TAG_PATTERNS:
+        _QWEN_TAG_PATTERNS[key] = re.compile(r"<({})>(.*?)</\1>".format(key))
+    return _QWEN_TAG_PATTERNS[key]
+
+def convert_tags_to_qwen_format(text, tags=("box", "point"), image_id2path=None):
+    """
+    Rewrite the tags of `tags` in a single pass:
+    <box>x1 y1 x2 y2</box>  -> <box>(x1,y1),(x2,y2)</box>
+    <point>x y</point>      -> <point>(x,y)</point>
+    <image>image_id</image> -> <img>path</img>
+    """
+    def _replace(match):
+        tag, content = match.groups()
+        if tag == "box":
+            x1, y1, x2, y2 = content.split()
+            return f"<box>({x1},{y1}),({x2},{y2})</box>"
+        elif tag == "point":
+            x, y = content.split()
+            return f"<point>({x},{y})</point>"
+        return f"<img>{image_id2path[content]}</img>"
+
+    return _qwen_tag_pattern(tags).sub(_replace, text)